@@ -1,9 +1,16 @@
 """
 Main Flask application entry point.
-Initializes the app, configurations, and registers blueprints.
+Creates the app, its configuration and extensions, and registers blueprints.
+
+The app is built by create_app(); wsgi.py and asgi.py create the instance the
+servers load. Creating it does not touch the database schema: run the
+migrations with ``alembic upgrade head`` before starting a new version (see
+migrations/). AI providers are set up on first use (see
+routes.chat_routes.get_chat_services), so a process starts serving quickly.
 """
 import logging
 import os
+from typing import Any, Dict, Optional
 
 from dotenv import load_dotenv
 
@@ -13,64 +20,79 @@ from flask import Flask
 from flask_login import LoginManager
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from flask_session import Session
-from models import User, db
+from models import db
 from routes.auth_routes import auth_bp
-from routes.chat_routes import chat_bp
+from routes.chat_routes import chat_bp, run_chat_job
+from routes.metrics_routes import metrics_bp
+from utils.chat_jobs import init_chat_jobs
+from utils.logging_config import configure_logging
+from utils.message_archive import init_message_retention
+from utils.message_writer import init_message_writer
+from utils.metrics import init_metrics
+from utils.session_store import configure_session_store
+from utils.tracing import init_tracing
+from utils.user_cache import get_cached_user
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Create the Flask app
-app = Flask(__name__)
-
-# Configure the app
-app.config.update(
-    SECRET_KEY=os.environ.get("SESSION_SECRET", "dev-secret-key"),
-    SESSION_TYPE="filesystem",
-    SESSION_PERMANENT=False,
-    SESSION_USE_SIGNER=True,
-    SESSION_FILE_DIR=os.path.join(os.getcwd(), "flask_session"),
-    PERMANENT_SESSION_LIFETIME=86400,  # 24 hours
-)
-
-# Configure the database
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-
-# Configure ProxyFix for proper URL generation behind proxies
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
-
-# Initialize extensions
-db.init_app(app)
-Session(app)
-
 # Initialize Flask-Login
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 login_manager.login_message_category = 'info'
 
 @login_manager.user_loader
 def load_user(user_id):
-    """Load user by ID for Flask-Login."""
-    return User.query.get(int(user_id))
-
-# Register blueprints
-app.register_blueprint(chat_bp)
-app.register_blueprint(auth_bp)
-
-with app.app_context():
-    # Create database tables
-    db.create_all()
-    logger.info("Database tables created successfully")
-
-logger.info("Application initialized successfully")
-
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    """Load user by ID for Flask-Login, from the identity cache when possible."""
+    return get_cached_user(int(user_id))
+
+def create_app(config: Optional[Dict[str, Any]] = None) -> Flask:
+    """
+    Create the Flask app.
+
+    Args:
+        config: Overrides of the configuration read from the environment
+
+    Returns:
+        The configured app
+    """
+    configure_logging()
+
+    app = Flask(__name__)
+
+    # Configure the app
+    app.config.update(
+        SECRET_KEY=os.environ.get("SESSION_SECRET", "dev-secret-key"),
+        SESSION_PERMANENT=False,
+        SESSION_USE_SIGNER=True,
+        PERMANENT_SESSION_LIFETIME=86400,  # 24 hours
+    )
+
+    # Configure the database
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    }
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.update(config or {})
+
+    # Configure ProxyFix for proper URL generation and client IPs behind proxies
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
+
+    # Initialize extensions
+    db.init_app(app)
+    configure_session_store(app)
+    init_metrics(app)
+    init_tracing(app)
+    init_message_writer(app)
+    init_chat_jobs(app, run_chat_job)
+    init_message_retention(app)
+    login_manager.init_app(app)
+
+    # Register blueprints
+    app.register_blueprint(chat_bp)
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(metrics_bp)
+
+    logger.info("Application initialized successfully")
+    return app
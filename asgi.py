@@ -0,0 +1,280 @@
+"""
+ASGI entry point.
+
+In this mode the chat endpoints run on the event loop: while a reply is being
+generated the request only holds a coroutine waiting on the AI provider, so
+one process can serve hundreds of concurrent conversations instead of one per
+worker. The short synchronous steps around the AI call (rate limiting, session
+and database access) run in a thread pool inside a regular Flask request
+context, so authentication and the session behave exactly as in the Flask
+routes. Every other route is served by the Flask app through a WSGI adapter.
+
+Launch with:
+    gunicorn -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:5000 asgi:application
+
+or, for development:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --reload
+"""
+import asyncio
+import contextvars
+import io
+import logging
+import sys
+from typing import Any, AsyncIterator, Callable, Dict, List, Tuple
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from flask import Response as FlaskResponse, request as flask_request, session
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from wsgi import app
+from routes import chat_routes
+from routes.chat_routes import (
+    EMPTY_RESPONSE_FALLBACK, SSE_HEADERS, enqueue_chat_turn, finish_chat_turn, format_sse,
+    get_error_headers, get_error_response, prepare_chat_turn, use_job_mode
+)
+from utils.rate_limiter import refund_message
+from utils.session_utils import establish_session
+
+logger = logging.getLogger(__name__)
+
+def build_environ(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+    """
+    Build a WSGI environ from an ASGI HTTP scope and request body, applying
+    the Flask app's ProxyFix settings so client addresses match the WSGI routes.
+    """
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode("utf8").decode("latin1"),
+        "PATH_INFO": path[len(root_path):].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "SERVER_NAME": scope["server"][0] if scope.get("server") else "localhost",
+        "SERVER_PORT": str(scope["server"][1]) if scope.get("server") else "80",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1")
+        value = value.decode("latin1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name != "content-length":
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+    # ProxyFix may be wrapped by other middleware (e.g. tracing)
+    proxy_fix = app.wsgi_app
+    while not isinstance(proxy_fix, ProxyFix) and hasattr(proxy_fix, 'wsgi_app'):
+        proxy_fix = proxy_fix.wsgi_app
+    if isinstance(proxy_fix, ProxyFix):
+        fixed: Dict[str, Any] = {}
+        ProxyFix(
+            lambda env, start_response: fixed.update(env) or [],
+            x_for=proxy_fix.x_for, x_proto=proxy_fix.x_proto, x_host=proxy_fix.x_host,
+            x_port=proxy_fix.x_port, x_prefix=proxy_fix.x_prefix
+        )(environ, None)
+        environ = fixed
+
+    return environ
+
+class FlaskRequestBridge:
+    """
+    Run the synchronous phases of an ASGI request in a Flask request context.
+
+    The same request context (and so the same session) is reused for every
+    phase; after each phase the session is saved and its cookie kept for the
+    ASGI response. Database connections are released between phases, so none
+    is held while waiting on the AI provider.
+    """
+
+    def __init__(self, request: Request, body: bytes):
+        self.context = app.request_context(build_environ(request.scope, body))
+        self.cookie_headers: List[Tuple[bytes, bytes]] = []
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Run a function in the request context on the thread pool."""
+        return await run_in_threadpool(self._call, func, *args)
+
+    def _call(self, func: Callable[..., Any], *args: Any) -> Any:
+        with self.context:
+            try:
+                return func(*args)
+            finally:
+                response = FlaskResponse()
+                app.session_interface.save_session(app, session, response)
+                cookies = response.headers.getlist('Set-Cookie')
+                if cookies:
+                    self.cookie_headers = [(b'set-cookie', cookie.encode('latin1')) for cookie in cookies]
+
+    def json_response(self, payload: Dict[str, Any], status_code: int = 200) -> JSONResponse:
+        """Build a JSON response carrying the session cookie."""
+        response = JSONResponse(payload, status_code=status_code)
+        response.raw_headers.extend(self.cookie_headers)
+        return response
+
+def _prepare_from_request() -> Tuple[Any, Any]:
+    turn, error = prepare_chat_turn(flask_request.get_json())
+    if error is None:
+        # The turn is saved to the session after the headers are sent
+        establish_session()
+    return turn, error
+
+def _start_from_request() -> Tuple[Any, Any, Any]:
+    data = flask_request.get_json()
+    if use_job_mode(data):
+        return None, None, enqueue_chat_turn(data)
+    turn, error = prepare_chat_turn(data)
+    return turn, error, None
+
+async def chat(request: Request):
+    """Async version of the /api/chat route."""
+    bridge = FlaskRequestBridge(request, await request.body())
+    turn = None
+    try:
+        turn, error, queued = await bridge.run(_start_from_request)
+        if queued:
+            payload, status_code, headers = queued
+            response = bridge.json_response(payload, status_code)
+            response.headers.update(headers)
+            return response
+        if error:
+            payload, status_code = error
+            return bridge.json_response(payload, status_code)
+
+        ai_response, provider = await chat_routes.get_chat_services().provider_router.aget_chat_response(
+            turn['messages'], use_cache=turn['use_cache']
+        )
+
+        result = await bridge.run(finish_chat_turn, turn, ai_response, provider)
+        return bridge.json_response({'response': ai_response, **result})
+
+    except Exception as e:
+        error_message = str(e)
+        logger.error("Error in chat endpoint: %s", error_message)
+
+        # Failed requests don't count against the quota
+        if turn is not None:
+            await bridge.run(refund_message)
+
+        payload, status_code = get_error_response(error_message)
+        response = bridge.json_response(payload, status_code)
+        response.headers.update(get_error_headers(e))
+        return response
+
+async def chat_stream(request: Request):
+    """Async version of the /api/chat/stream route."""
+    bridge = FlaskRequestBridge(request, await request.body())
+    try:
+        turn, error = await bridge.run(_prepare_from_request)
+    except Exception as e:
+        logger.error("Error in chat stream: %s", e)
+        payload, status_code = get_error_response(str(e))
+        return bridge.json_response(payload, status_code)
+
+    if error:
+        payload, status_code = error
+        return bridge.json_response(payload, status_code)
+
+    try:
+        provider, stream = await chat_routes.get_chat_services().provider_router.aopen_stream(
+            turn['messages'], use_cache=turn['use_cache']
+        )
+    except Exception as e:
+        error_message = str(e)
+        logger.error("Error in chat stream: %s", error_message)
+
+        # Failed requests don't count against the quota
+        await bridge.run(refund_message)
+
+        payload, status_code = get_error_response(error_message)
+        response = bridge.json_response(payload, status_code)
+        response.headers.update(get_error_headers(e))
+        return response
+
+    async def generate() -> AsyncIterator[str]:
+        chunks = []
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield format_sse('delta', {'content': chunk})
+        except Exception as e:
+            error_message = str(e)
+            logger.error("Error in chat stream: %s", error_message)
+            payload, _ = get_error_response(error_message)
+
+            # Failed requests don't count against the quota
+            await bridge.run(refund_message)
+
+            yield format_sse('error', payload)
+            return
+
+        ai_response = ''.join(chunks)
+        if not ai_response:
+            ai_response = EMPTY_RESPONSE_FALLBACK
+            yield format_sse('delta', {'content': ai_response})
+
+        result = await bridge.run(finish_chat_turn, turn, ai_response, provider)
+        yield format_sse('done', result)
+
+    response = StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
+    response.raw_headers.extend(bridge.cookie_headers)
+    return response
+
+class WsgiMount:
+    """
+    Serve the Flask app through asgiref's WSGI adapter, each request in a
+    fresh context with a thread of its own.
+
+    The adapter records its sync bridge in a context variable that can leak
+    into the next request on a keep-alive connection, which then fails with
+    "CurrentThreadExecutor already quit"; and by default every WSGI request
+    of the process would run on one shared thread. The adapter also never
+    closes the response body, which is what runs the response's close
+    callbacks (e.g. the request metrics), so the body is closed once sent.
+    """
+
+    def __init__(self, wsgi_app: Callable[..., Any]):
+        self.adapter = WsgiToAsgi(self._closing(wsgi_app))
+
+    @staticmethod
+    def _closing(wsgi_app: Callable[..., Any]) -> Callable[..., Any]:
+        def closing_app(environ, start_response):
+            body = wsgi_app(environ, start_response)
+            try:
+                for chunk in body:
+                    yield chunk
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+        return closing_app
+
+    async def __call__(self, scope, receive, send) -> None:
+        await asyncio.get_running_loop().create_task(
+            self._serve(scope, receive, send), context=contextvars.Context()
+        )
+
+    async def _serve(self, scope, receive, send) -> None:
+        async with ThreadSensitiveContext():
+            await self.adapter(scope, receive, send)
+
+application = Starlette(routes=[
+    Route('/api/chat', chat, methods=['POST']),
+    Route('/api/chat/stream', chat_stream, methods=['POST']),
+    Mount('/', app=WsgiMount(app)),
+])
@@ -0,0 +1,96 @@
+"""
+Import-time budget check.
+
+Imports the app module in fresh interpreters with ``python -X importtime``,
+which also times the module bodies (so creating the app is included), and
+fails when the fastest run exceeds the budget. Every process start, and so
+every scale-up, pays this time before serving its first request.
+
+The packages taking the most time are listed, to show what to make lazy.
+
+Usage:
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --budget 800 --runs 5
+    python -m benchmarks.import_time --module asgi
+"""
+import argparse
+import collections
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Default budget in milliseconds
+DEFAULT_BUDGET_MS = float(os.environ.get("IMPORT_TIME_BUDGET_MS", "1000"))
+
+# A line of -X importtime output: self and cumulative microseconds, then the
+# module indented by its nesting depth
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+def measure(module: str, env: Dict[str, str]) -> Tuple[float, Dict[str, float]]:
+    """
+    Import a module in a fresh interpreter.
+
+    Returns:
+        The cumulative import time of the module in milliseconds, and the
+        self time of every top-level package it imported
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    total = 0.0
+    packages: Dict[str, float] = collections.defaultdict(float)
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        packages[name.split('.')[0]] += int(self_us) / 1000
+        if name == module and not indent:
+            total = int(cumulative_us) / 1000
+    return total, packages
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='wsgi', help="Module to import (default: wsgi)")
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_MS, help="Budget in milliseconds")
+    parser.add_argument('--runs', type=int, default=3, help="Imports measured; the fastest counts")
+    parser.add_argument('--top', type=int, default=10, help="Slowest packages listed")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='import-time-')
+    env = dict(
+        os.environ,
+        DATABASE_URL=os.environ.get('DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'import_time.db')}"),
+        SESSION_SECRET=os.environ.get('SESSION_SECRET', 'import-time'),
+    )
+    try:
+        # The first import also compiles bytecode; it is not counted
+        measure(args.module, env)
+        runs: List[Tuple[float, Dict[str, float]]] = [measure(args.module, env) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    total, packages = min(runs, key=lambda run: run[0])
+    print(f"import {args.module}: {total:.0f} ms (budget {args.budget:.0f} ms, "
+          f"runs: {', '.join(f'{run[0]:.0f}' for run in runs)} ms)")
+    print(f"\n{'package':<30}{'ms':>8}")
+    for name, ms in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<30}{ms:>8.1f}")
+
+    if total > args.budget:
+        print(f"\nOver budget by {total - args.budget:.0f} ms")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
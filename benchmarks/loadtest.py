@@ -0,0 +1,486 @@
+"""
+Load test of the chat endpoints against mock AI providers.
+
+Starts two mock providers (see benchmarks/mock_provider.py) standing in for
+DeepSeek and OpenAI, then the app under gunicorn with a scratch SQLite
+database pointed at them, and runs the load scenarios one after the other.
+Each scenario keeps --concurrency virtual users sending requests for
+--duration seconds and reports throughput (requests per second, in total and
+per worker) and latency percentiles.
+
+Scenarios:
+    anonymous     Anonymous visitors, each request from a new address
+    logged_in     Registered users chatting in their conversation
+    long_history  Registered users whose conversation already has many messages
+    streaming     Registered users on the streaming endpoint (time to first byte too)
+    rate_limited  Anonymous visitors sending past their quota (mostly 429s)
+    failover      DeepSeek failing on every call, so turns are served by OpenAI
+
+Results are compared with a stored baseline (benchmarks/baseline.json): a
+scenario whose p95 latency grew, or whose throughput dropped, by more than
+--tolerance is a regression and the exit status is 1. Baselines depend on
+the machine; record one with --save-baseline before comparing changes.
+
+Usage:
+    python -m benchmarks.loadtest
+    python -m benchmarks.loadtest --scenarios logged_in,streaming --duration 30
+    python -m benchmarks.loadtest --save-baseline
+    python -m benchmarks.loadtest --url http://localhost:5000 --workers 4
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from benchmarks.mock_provider import MockProvider, start_mock_provider
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Quota of anonymous visitors on the app started by the load test; registered
+# users get an unlimited one so that only rate_limited hits the limit
+ANONYMOUS_LIMIT = 5
+
+BENCHMARK_PASSWORD = 'benchmark-password'
+
+CSRF_PATTERN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+# A sample: latency and time to first byte in seconds, and the status code
+Sample = Tuple[float, Optional[float], int]
+
+class VirtualUser:
+    """A client with its own cookies, used by one load thread."""
+
+    def __init__(self, base_url: str, name: str, address: str):
+        self.client = httpx.Client(base_url=base_url, timeout=60)
+        self.name = name
+        self.address = address
+        self.sent = itertools.count()
+
+    def next_message(self) -> Dict[str, Any]:
+        """A chat request body; unique so that no cached response is served."""
+        return {'message': f"Question {next(self.sent)} from {self.name}: how do I speed this up?", 'cache': False}
+
+    def register(self) -> None:
+        """Register the user and log in."""
+        email = f"{self.name}@example.com"
+        self._submit_form('/auth/register', {
+            'username': self.name, 'email': email,
+            'password': BENCHMARK_PASSWORD, 'password2': BENCHMARK_PASSWORD,
+        })
+        self._submit_form('/auth/login', {'username': self.name, 'password': BENCHMARK_PASSWORD})
+
+    def _submit_form(self, path: str, form: Dict[str, str]) -> None:
+        page = self.client.get(path)
+        match = CSRF_PATTERN.search(page.text)
+        if match is None:
+            raise RuntimeError(f"No CSRF token on {path}")
+        response = self.client.post(path, data=dict(form, csrf_token=match.group(1)))
+        if response.status_code != 302:
+            raise RuntimeError(f"{path} failed for {self.name} with status {response.status_code}")
+
+    def chat(self, headers: Optional[Dict[str, str]] = None) -> Sample:
+        started = time.perf_counter()
+        response = self.client.post('/api/chat', json=self.next_message(), headers=headers)
+        return time.perf_counter() - started, None, response.status_code
+
+    def chat_stream(self) -> Sample:
+        started = time.perf_counter()
+        first_byte = None
+        with self.client.stream('POST', '/api/chat/stream', json=self.next_message()) as response:
+            for _ in response.iter_bytes():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+        return time.perf_counter() - started, first_byte, response.status_code
+
+    def close(self) -> None:
+        self.client.close()
+
+class Scenario:
+    """A load scenario: how a virtual user is prepared and what it sends."""
+
+    name = ''
+    # Statuses that are not counted as errors
+    expected_statuses: Tuple[int, ...] = (200,)
+
+    def prepare(self, user: VirtualUser) -> None:
+        """Set up a virtual user before the measurement (not timed)."""
+
+    def step(self, user: VirtualUser) -> Sample:
+        """Send one request."""
+        raise NotImplementedError
+
+    def start(self, mocks: Dict[str, MockProvider]) -> None:
+        """Called before the scenario runs."""
+
+    def stop(self, mocks: Dict[str, MockProvider]) -> None:
+        """Called after the scenario ran."""
+
+class AnonymousScenario(Scenario):
+    name = 'anonymous'
+
+    def __init__(self):
+        self.addresses = itertools.count(random.randrange(1 << 20))
+
+    def step(self, user: VirtualUser) -> Sample:
+        # A new address per request keeps every visitor under the quota
+        number = next(self.addresses) % (1 << 24)
+        address = f"10.{number >> 16}.{(number >> 8) & 255}.{number & 255}"
+        return user.chat(headers={'X-Forwarded-For': address})
+
+class LoggedInScenario(Scenario):
+    name = 'logged_in'
+
+    def prepare(self, user: VirtualUser) -> None:
+        user.register()
+
+    def step(self, user: VirtualUser) -> Sample:
+        return user.chat()
+
+class LongHistoryScenario(LoggedInScenario):
+    name = 'long_history'
+
+    def __init__(self, history: int):
+        self.history = history
+
+    def prepare(self, user: VirtualUser) -> None:
+        user.register()
+        for _ in range(self.history):
+            user.chat()
+
+class StreamingScenario(LoggedInScenario):
+    name = 'streaming'
+
+    def step(self, user: VirtualUser) -> Sample:
+        return user.chat_stream()
+
+class RateLimitedScenario(Scenario):
+    name = 'rate_limited'
+    expected_statuses = (200, 429)
+
+    def step(self, user: VirtualUser) -> Sample:
+        return user.chat(headers={'X-Forwarded-For': user.address})
+
+class FailoverScenario(LoggedInScenario):
+    name = 'failover'
+
+    def start(self, mocks: Dict[str, MockProvider]) -> None:
+        mocks['deepseek'].configure(error_rate=1.0)
+
+    def stop(self, mocks: Dict[str, MockProvider]) -> None:
+        mocks['deepseek'].configure(error_rate=0.0)
+
+def make_scenarios(history: int) -> Dict[str, Scenario]:
+    """All scenarios by name, in the order they run."""
+    scenarios = [
+        AnonymousScenario(),
+        LoggedInScenario(),
+        LongHistoryScenario(history),
+        StreamingScenario(),
+        RateLimitedScenario(),
+        # Last, since it leaves DeepSeek's circuit breaker open for a while
+        FailoverScenario(),
+    ]
+    return {scenario.name: scenario for scenario in scenarios}
+
+def percentile(values: List[float], q: float) -> float:
+    """The q-th percentile of the values (nearest rank)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Percentiles of durations in seconds, in milliseconds."""
+    return {
+        'p50': round(percentile(values, 50) * 1000, 1),
+        'p95': round(percentile(values, 95) * 1000, 1),
+        'p99': round(percentile(values, 99) * 1000, 1),
+        'max': round(max(values, default=0.0) * 1000, 1),
+    }
+
+def run_scenario(
+    scenario: Scenario,
+    base_url: str,
+    concurrency: int,
+    duration: float,
+    warmup: float,
+    workers: int,
+    mocks: Dict[str, MockProvider],
+) -> Dict[str, Any]:
+    """
+    Run a scenario and summarize its samples.
+
+    Args:
+        scenario: The scenario
+        base_url: URL of the app
+        concurrency: Number of virtual users
+        duration: Seconds measured
+        warmup: Seconds run before the measurement starts
+        workers: Number of app worker processes, for the throughput per worker
+        mocks: The mock providers by name (empty when not started here)
+
+    Returns:
+        The report of the scenario
+    """
+    run_id = f"{int(time.time()) % 100000}{random.randrange(1000):03d}"
+    users = [
+        VirtualUser(base_url, f"bench_{scenario.name}_{run_id}_{index}", f"172.16.{random.randrange(256)}.{index}")
+        for index in range(concurrency)
+    ]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(scenario.prepare, users))
+
+    samples: List[Sample] = []
+    samples_lock = threading.Lock()
+    measure_from = time.perf_counter() + warmup
+    stop_at = measure_from + duration
+
+    def load(user: VirtualUser) -> None:
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                return
+            try:
+                sample = scenario.step(user)
+            except httpx.HTTPError:
+                sample = (time.perf_counter() - now, None, 0)
+            if now >= measure_from:
+                with samples_lock:
+                    samples.append(sample)
+
+    scenario.start(mocks)
+    try:
+        threads = [threading.Thread(target=load, args=(user,), daemon=True) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        scenario.stop(mocks)
+        for user in users:
+            user.close()
+
+    statuses: Dict[str, int] = {}
+    for _, _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    rps = len(samples) / duration
+    report = {
+        'requests': len(samples),
+        'rps': round(rps, 2),
+        'rps_per_worker': round(rps / workers, 2),
+        'errors': sum(1 for _, _, status in samples if status not in scenario.expected_statuses),
+        'statuses': statuses,
+        'latency_ms': summarize([latency for latency, _, _ in samples]),
+    }
+    first_bytes = [first_byte for _, first_byte, _ in samples if first_byte is not None]
+    if first_bytes:
+        report['ttfb_ms'] = summarize(first_bytes)
+    return report
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_app(workdir: str, mocks: Dict[str, MockProvider], workers: int, threads: int) -> Tuple[subprocess.Popen, str]:
+    """
+    Start the app under gunicorn, pointed at the mock providers.
+
+    Returns:
+        The gunicorn process and the URL of the app
+    """
+    port = free_port()
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'benchmark.db')}",
+        SESSION_SECRET='benchmark',
+        DEEPSEEK_API_KEY='benchmark',
+        OPENAI_API_KEY='benchmark',
+        DEEPSEEK_BASE_URL=mocks['deepseek'].url,
+        OPENAI_BASE_URL=mocks['openai'].url,
+        AI_PROVIDER_ORDER='deepseek,openai,local',
+        AI_HEALTH_STORE_PATH=os.path.join(workdir, 'provider_health.json'),
+        RESPONSE_CACHE_ENABLED='0',
+        RATE_LIMIT_TIERS=json.dumps({
+            'anonymous': {'limit': ANONYMOUS_LIMIT, 'window_seconds': 3600},
+            'free': {'limit': 10 ** 9, 'window_seconds': 3600},
+        }),
+        MESSAGE_JOURNAL_DIR=os.path.join(workdir, 'journal'),
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, 'metrics'),
+    )
+    os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'])
+
+    # Create the tables, as a deploy would, before starting the app
+    subprocess.run([sys.executable, '-m', 'alembic', 'upgrade', 'head'], cwd=REPO_ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', str(threads),
+         '--bind', f"127.0.0.1:{port}", '--log-level', 'warning', '--preload', 'wsgi:app'],
+        cwd=REPO_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited on startup, see {log.name}")
+        try:
+            if httpx.get(f"{url}/auth/login", timeout=1).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"The app did not start in time, see {log.name}")
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> Dict[str, List[str]]:
+    """
+    Compare scenario reports with the baseline.
+
+    Returns:
+        The regressions found, by scenario
+    """
+    regressions: Dict[str, List[str]] = {}
+    for name, report in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            continue
+        found = []
+        p95, base_p95 = report['latency_ms']['p95'], base['latency_ms']['p95']
+        if base_p95 and p95 > base_p95 * (1 + tolerance):
+            found.append(f"p95 {base_p95:.0f} -> {p95:.0f} ms")
+        if base['rps'] and report['rps'] < base['rps'] * (1 - tolerance):
+            found.append(f"throughput {base['rps']:.1f} -> {report['rps']:.1f} rps")
+        if found:
+            regressions[name] = found
+    return regressions
+
+def print_report(results: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    print(f"\n{'scenario':<14}{'requests':>9}{'rps':>9}{'rps/wkr':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'errors':>8}"
+          f"{'p95 base':>10}{'rps base':>10}")
+    for name, report in results['scenarios'].items():
+        latency = report['latency_ms']
+        base = (baseline or {}).get('scenarios', {}).get(name)
+        print(
+            f"{name:<14}{report['requests']:>9}{report['rps']:>9.1f}{report['rps_per_worker']:>9.1f}"
+            f"{latency['p50']:>9.0f}{latency['p95']:>9.0f}{latency['p99']:>9.0f}{report['errors']:>8}"
+            + (f"{base['latency_ms']['p95']:>10.0f}{base['rps']:>10.1f}" if base else f"{'-':>10}{'-':>10}")
+        )
+        if 'ttfb_ms' in report:
+            print(f"{'':<14}time to first byte: p50 {report['ttfb_ms']['p50']:.0f} ms, p95 {report['ttfb_ms']['p95']:.0f} ms")
+    print("(latencies in ms)")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="Load an app that is already running instead of starting one")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument('--threads', type=int, default=4, help="Threads per gunicorn worker")
+    parser.add_argument('--concurrency', type=int, default=8, help="Virtual users per scenario")
+    parser.add_argument('--duration', type=float, default=15, help="Seconds measured per scenario")
+    parser.add_argument('--warmup', type=float, default=2, help="Seconds run before measuring")
+    parser.add_argument('--scenarios', help="Comma-separated scenarios to run (default: all)")
+    parser.add_argument('--history', type=int, default=40, help="Messages sent before long_history is measured")
+    parser.add_argument('--mock-ttft', type=float, default=0.2, help="Latency of the mock providers")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="Baseline to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="Store the results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative regression")
+    parser.add_argument('--output', help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    scenarios = make_scenarios(args.history)
+    names = args.scenarios.split(',') if args.scenarios else list(scenarios)
+    unknown = [name for name in names if name not in scenarios]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+
+    mocks: Dict[str, MockProvider] = {}
+    process = None
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+            if 'failover' in names:
+                print("Skipping failover: it needs the mock providers started by the load test")
+                names.remove('failover')
+        else:
+            mocks = {
+                'deepseek': start_mock_provider(ttft=args.mock_ttft),
+                'openai': start_mock_provider(ttft=args.mock_ttft),
+            }
+            process, base_url = start_app(workdir, mocks, args.workers, args.threads)
+
+        results: Dict[str, Any] = {
+            'config': {
+                'workers': args.workers,
+                'threads': args.threads,
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'mock_ttft': args.mock_ttft if not args.url else None,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+            },
+            'scenarios': {},
+        }
+        for name in names:
+            print(f"Running {name}...", flush=True)
+            results['scenarios'][name] = run_scenario(
+                scenarios[name], base_url, args.concurrency, args.duration, args.warmup, args.workers, mocks
+            )
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for mock in mocks.values():
+            mock.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+    print_report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+        print(f"Saved the baseline to {args.baseline}")
+        return 0
+
+    if baseline is None:
+        return 0
+    if baseline.get('config', {}).get('workers') != args.workers or \
+            baseline.get('config', {}).get('concurrency') != args.concurrency:
+        print("Warning: the baseline was recorded with other workers or concurrency")
+    regressions = compare(results, baseline, args.tolerance)
+    for name, found in regressions.items():
+        print(f"REGRESSION in {name}: {'; '.join(found)}")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+"""
+Mock AI provider for benchmarks.
+
+Serves POST /v1/chat/completions in the OpenAI wire format, which DeepSeek
+also uses, so the app can be pointed at it with OPENAI_BASE_URL or
+DEEPSEEK_BASE_URL. Both plain and streamed (server-sent events) completions
+are supported, with configurable latency and injected errors.
+
+The behaviour can be changed while running:
+
+    POST /_control   JSON body with any of the settings below
+    GET  /_stats     Requests served, by outcome
+
+Usage:
+    python -m benchmarks.mock_provider --port 8901 --ttft 0.2 --chunk-delay 0.02
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+# Default settings of a mock provider
+DEFAULT_SETTINGS: Dict[str, Any] = {
+    # Seconds before the first token (or the whole non-streamed response)
+    'ttft': 0.2,
+    # Random extra delay, up to this many seconds
+    'jitter': 0.05,
+    # Chunks of a streamed response and the seconds between them
+    'chunks': 20,
+    'chunk_delay': 0.02,
+    # Fraction of requests failing, and their HTTP status
+    'error_rate': 0.0,
+    'error_status': 500,
+}
+
+# Words the responses are made of
+RESPONSE_WORDS = (
+    "Sure, here is a short answer to your question. The details depend on your setup, "
+    "but the usual approach is to measure first and change one thing at a time."
+).split()
+
+class MockProvider(ThreadingHTTPServer):
+    """HTTP server holding the mock's settings and counters."""
+
+    daemon_threads = True
+
+    def __init__(self, address, settings: Dict[str, Any]):
+        super().__init__(address, MockProviderHandler)
+        self.settings = dict(settings)
+        self.stats: Dict[str, int] = {'success': 0, 'error': 0}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        """Base URL of the API, as expected by OPENAI_BASE_URL and DEEPSEEK_BASE_URL."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def configure(self, **settings: Any) -> Dict[str, Any]:
+        """Change settings while running, returning them all."""
+        with self.lock:
+            self.settings.update(settings)
+            return dict(self.settings)
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response (e.g. a cancelled hedged request) are expected
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def count(self, outcome: str) -> None:
+        with self.lock:
+            self.stats[outcome] += 1
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    """Request handler of the mock provider."""
+
+    protocol_version = 'HTTP/1.1'
+    server: MockProvider
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/_stats':
+            with self.server.lock:
+                payload = dict(self.server.stats, settings=dict(self.server.settings))
+            self._send_json(200, payload)
+        else:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        data = json.loads(body) if body else {}
+
+        if self.path == '/_control':
+            self._send_json(200, self.server.configure(**data))
+            return
+
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'Not found'}})
+            return
+
+        with self.server.lock:
+            settings = dict(self.server.settings)
+        time.sleep(settings['ttft'] + random.uniform(0, settings['jitter']))
+
+        if random.random() < settings['error_rate']:
+            self.server.count('error')
+            self._send_json(settings['error_status'], {
+                'error': {'message': 'Injected error', 'type': 'server_error'}
+            })
+            return
+
+        words = [random.choice(RESPONSE_WORDS) for _ in range(max(settings['chunks'], 1))]
+        model = data.get('model', 'mock')
+
+        if data.get('stream'):
+            self._stream(model, words, settings['chunk_delay'])
+        else:
+            prompt_tokens = sum(len(message.get('content', '')) for message in data.get('messages', [])) // 4
+            self._send_json(200, {
+                'id': f"chatcmpl-{random.getrandbits(64):x}",
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': ' '.join(words)},
+                    'finish_reason': 'stop',
+                }],
+                'usage': {
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': len(words),
+                    'total_tokens': prompt_tokens + len(words),
+                },
+            })
+        self.server.count('success')
+
+    def _stream(self, model: str, words: List[str], chunk_delay: float) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        completion_id = f"chatcmpl-{random.getrandbits(64):x}"
+        for index, word in enumerate(words):
+            if index:
+                time.sleep(chunk_delay)
+            self._write_chunk(("data: " + json.dumps({
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}],
+            }) + "\n\n").encode())
+        self._write_chunk(b"data: [DONE]\n\n")
+        # Terminating chunk of the chunked encoding
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_mock_provider(host: str = '127.0.0.1', port: int = 0, **settings: Any) -> MockProvider:
+    """
+    Start a mock provider on a background thread.
+
+    Args:
+        host: Interface to listen on
+        port: Port to listen on (0 for any free port)
+        **settings: Overrides of DEFAULT_SETTINGS
+
+    Returns:
+        The running server
+    """
+    server = MockProvider((host, port), dict(DEFAULT_SETTINGS, **settings))
+    threading.Thread(target=server.serve_forever, name="mock-provider", daemon=True).start()
+    return server
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8901)
+    for name, default in DEFAULT_SETTINGS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, type=type(default), default=default)
+    args = parser.parse_args()
+
+    server = MockProvider((args.host, args.port), {name: getattr(args, name) for name in DEFAULT_SETTINGS})
+    print(f"Mock provider listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,8 @@ Forms for the application.
 """
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
-from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
+from wtforms.validators import DataRequired, Email, EqualTo, Length
+from sqlalchemy import or_
 from models import User
 
 class LoginForm(FlaskForm):
@@ -34,14 +35,17 @@ class RegistrationForm(FlaskForm):
     ])
     submit = SubmitField('Register')
     
-    def validate_username(self, username):
-        """Check if username is already taken."""
-        user = User.query.filter_by(username=username.data).first()
-        if user is not None:
-            raise ValidationError('Username is already taken. Please choose a different one.')
-    
-    def validate_email(self, email):
-        """Check if email is already registered."""
-        user = User.query.filter_by(email=email.data).first()
-        if user is not None:
-            raise ValidationError('Email is already registered. Please use a different one.')
\ No newline at end of file
+    def validate(self, extra_validators=None):
+        """Validate the fields, then check the username and email are free in one query."""
+        if not super().validate(extra_validators):
+            return False
+        
+        taken = User.query.with_entities(User.username, User.email).filter(
+            or_(User.username == self.username.data, User.email == self.email.data)
+        ).limit(2).all()
+        for username, email in taken:
+            if username == self.username.data:
+                self.username.errors.append('Username is already taken. Please choose a different one.')
+            if email == self.email.data:
+                self.email.errors.append('Email is already registered. Please use a different one.')
+        return not taken
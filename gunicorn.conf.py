@@ -0,0 +1,48 @@
+"""
+Gunicorn configuration, loaded automatically from the working directory.
+
+Sets up Prometheus multiprocess metrics: every worker writes its samples to
+PROMETHEUS_MULTIPROC_DIR, which is emptied on startup, and the files of a
+worker that exits are folded into the totals.
+
+With --preload (as deployed) the app is imported once in the master and the
+workers share its memory copy-on-write: objects are moved out of the garbage
+collector's reach before forking so collections do not touch (and copy) the
+shared pages, and each worker drops the database connections inherited from
+the master.
+"""
+import gc
+import os
+import shutil
+import tempfile
+
+# Must be set before prometheus_client is imported by the app
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "prometheus_multiproc")
+)
+
+def on_starting(server):
+    """Clear the samples of a previous run, which would otherwise be counted again."""
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+def child_exit(server, worker):
+    """Stop reporting the live gauges of a worker that exited."""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+def pre_fork(server, worker):
+    """Freeze the objects of the preloaded app so workers keep sharing their pages."""
+    if server.cfg.preload_app:
+        gc.freeze()
+
+def post_fork(server, worker):
+    """Drop the database connections a preloaded app opened in the master."""
+    if not server.cfg.preload_app:
+        return
+    from wsgi import app
+    from models import db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
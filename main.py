@@ -1,4 +1,6 @@
-from app import app  # noqa: F401
-
+"""
+Development server: ``python main.py``. Servers load the app from wsgi.py.
+"""
 if __name__ == "__main__":
+    from wsgi import app
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,69 @@
+"""
+Alembic environment: migrates the database at DATABASE_URL.
+
+Only the models are imported, not the app, so migrations run without the
+app's services and configuration.
+"""
+import os
+from logging.config import fileConfig
+
+from alembic import context
+from dotenv import load_dotenv
+from sqlalchemy import engine_from_config, pool
+
+load_dotenv()
+
+from models import db
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+config.set_main_option("sqlalchemy.url", os.environ["DATABASE_URL"].replace("%", "%%"))
+target_metadata = db.metadata
+
+# Schema objects not described by the models: the full-text index of migration
+# 0003, and the table of Flask-Session's SQLAlchemy backend
+UNMODELED_OBJECTS = {"search_vector", "ix_messages_search_vector", "sessions"}
+
+def include_object(object, name, type_, reflected, compare_to) -> bool:
+    """Leave the objects the models do not describe out of autogenerate."""
+    if name is None:
+        return True
+    return not (name.startswith("messages_fts") or name in UNMODELED_OBJECTS)
+
+def run_migrations_offline() -> None:
+    """Emit the migrations as SQL instead of running them."""
+    url = config.get_main_option("sqlalchemy.url")
+    context.configure(
+        url=url,
+        target_metadata=target_metadata,
+        include_object=include_object,
+        literal_binds=True,
+        render_as_batch=url.startswith("sqlite"),
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+def run_migrations_online() -> None:
+    """Run the migrations against the database."""
+    connectable = engine_from_config(
+        config.get_section(config.config_ini_section, {}),
+        prefix="sqlalchemy.",
+        poolclass=pool.NullPool,
+    )
+    with connectable.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_object=include_object,
+            # SQLite cannot alter constraints in place; tables are copied instead
+            render_as_batch=connection.dialect.name == "sqlite",
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,54 @@
+"""
+Baseline schema: users, messages and rate limits.
+
+Databases created by db.create_all() before migrations were introduced
+already have these tables, so existing ones are left alone.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    tables = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if 'users' not in tables:
+        op.create_table(
+            'users',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('username', sa.String(64), nullable=False, unique=True),
+            sa.Column('email', sa.String(120), nullable=False, unique=True),
+            sa.Column('password_hash', sa.String(256), nullable=False),
+            sa.Column('created_at', sa.DateTime()),
+        )
+
+    if 'messages' not in tables:
+        op.create_table(
+            'messages',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+            sa.Column('role', sa.String(20), nullable=False),
+            sa.Column('content', sa.Text(), nullable=False),
+            sa.Column('created_at', sa.DateTime()),
+        )
+
+    if 'rate_limits' not in tables:
+        op.create_table(
+            'rate_limits',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+            sa.Column('count', sa.Integer()),
+            sa.Column('reset_time', sa.DateTime(), nullable=False),
+        )
+
+def downgrade() -> None:
+    op.drop_table('rate_limits')
+    op.drop_table('messages')
+    op.drop_table('users')
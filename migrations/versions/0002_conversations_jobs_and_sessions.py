@@ -0,0 +1,191 @@
+"""
+Conversations, chat summaries, chat jobs, sessions, rate limit tiers and counters.
+
+Brings databases created by db.create_all() up to the current models:
+create_all created the new tables but never altered existing ones, so each
+step checks what is already there. Messages without a conversation are moved
+into one conversation per user, and duplicate rate limit rows are removed
+before user_id is made unique (the target of the quota UPSERT).
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+# Title of a conversation until its first message names it (models.DEFAULT_CONVERSATION_TITLE)
+DEFAULT_CONVERSATION_TITLE = 'New conversation'
+
+def _columns(inspector, table: str) -> set:
+    return {column['name'] for column in inspector.get_columns(table)}
+
+def _indexes(inspector, table: str) -> set:
+    return {index['name'] for index in inspector.get_indexes(table)}
+
+def _has_unique(inspector, table: str, columns: list) -> bool:
+    return any(
+        constraint['column_names'] == columns for constraint in inspector.get_unique_constraints(table)
+    ) or any(
+        index['unique'] and index['column_names'] == columns for index in inspector.get_indexes(table)
+    )
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    tables = set(inspector.get_table_names())
+
+    if 'tier' not in _columns(inspector, 'users'):
+        op.add_column('users', sa.Column('tier', sa.String(20), nullable=False, server_default='free'))
+
+    if 'conversations' not in tables:
+        op.create_table(
+            'conversations',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+            sa.Column('title', sa.String(120), nullable=False),
+            sa.Column('created_at', sa.DateTime()),
+            sa.Column('updated_at', sa.DateTime()),
+        )
+    if 'ix_conversations_user_id_id' not in _indexes(inspector, 'conversations'):
+        op.create_index('ix_conversations_user_id_id', 'conversations', ['user_id', 'id'])
+
+    if 'conversation_id' not in _columns(inspector, 'messages'):
+        with op.batch_alter_table('messages') as batch_op:
+            batch_op.add_column(sa.Column(
+                'conversation_id', sa.Integer(),
+                sa.ForeignKey('conversations.id', name='fk_messages_conversation_id'), nullable=True
+            ))
+    message_indexes = _indexes(inspector, 'messages')
+    if 'ix_messages_user_id_created_at' not in message_indexes:
+        op.create_index('ix_messages_user_id_created_at', 'messages', ['user_id', 'created_at'])
+    if 'ix_messages_conversation_id_id' not in message_indexes:
+        op.create_index('ix_messages_conversation_id_id', 'messages', ['conversation_id', 'id'])
+
+    _backfill_conversations(bind)
+
+    if 'chat_summaries' not in tables:
+        op.create_table(
+            'chat_summaries',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+            sa.Column('conversation_id', sa.Integer(), sa.ForeignKey('conversations.id'), nullable=False, unique=True),
+            sa.Column('content', sa.Text(), nullable=False),
+            sa.Column('last_message_id', sa.Integer(), nullable=False),
+            sa.Column('updated_at', sa.DateTime()),
+        )
+
+    if not _has_unique(inspector, 'rate_limits', ['user_id']):
+        # Keep the newest row of each user
+        op.execute(
+            "DELETE FROM rate_limits WHERE id NOT IN "
+            "(SELECT keep_id FROM (SELECT MAX(id) AS keep_id FROM rate_limits GROUP BY user_id) AS newest)"
+        )
+        with op.batch_alter_table('rate_limits') as batch_op:
+            batch_op.create_unique_constraint('uq_rate_limits_user_id', ['user_id'])
+
+    # Counters of the rate limit keys that are not users (anonymous clients, sign-in attempts)
+    if 'rate_limit_counters' not in tables:
+        op.create_table(
+            'rate_limit_counters',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('key', sa.String(255), nullable=False, unique=True),
+            sa.Column('count', sa.Integer()),
+            sa.Column('reset_time', sa.DateTime(), nullable=False),
+        )
+        op.create_index('ix_rate_limit_counters_reset_time', 'rate_limit_counters', ['reset_time'])
+
+    if 'chat_jobs' not in tables:
+        op.create_table(
+            'chat_jobs',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=True),
+            sa.Column('conversation_id', sa.Integer(), sa.ForeignKey('conversations.id'), nullable=True),
+            sa.Column('status', sa.String(20), nullable=False),
+            sa.Column('priority', sa.Integer(), nullable=False),
+            sa.Column('payload', sa.Text(), nullable=False),
+            sa.Column('result', sa.Text(), nullable=True),
+            sa.Column('provider', sa.String(20), nullable=True),
+            sa.Column('error', sa.String(50), nullable=True),
+            sa.Column('attempts', sa.Integer(), nullable=False),
+            sa.Column('max_attempts', sa.Integer(), nullable=False),
+            sa.Column('available_at', sa.DateTime(), nullable=False),
+            sa.Column('locked_until', sa.DateTime(), nullable=True),
+            sa.Column('created_at', sa.DateTime()),
+            sa.Column('finished_at', sa.DateTime(), nullable=True),
+        )
+        op.create_index('ix_chat_jobs_status_priority_id', 'chat_jobs', ['status', 'priority', 'id'])
+
+    # Server-side sessions (the table of Flask-Session's SQLAlchemy backend)
+    if 'sessions' not in tables:
+        op.create_table(
+            'sessions',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('session_id', sa.String(255), unique=True),
+            sa.Column('data', sa.LargeBinary()),
+            sa.Column('expiry', sa.DateTime()),
+        )
+
+def _backfill_conversations(bind) -> None:
+    """Move the messages without a conversation into one new conversation per user."""
+    conversations = sa.Table(
+        'conversations', sa.MetaData(),
+        sa.Column('id', sa.Integer, primary_key=True), sa.Column('user_id', sa.Integer),
+        sa.Column('title', sa.String), sa.Column('created_at', sa.DateTime), sa.Column('updated_at', sa.DateTime),
+    )
+    messages = sa.table(
+        'messages',
+        sa.column('id', sa.Integer), sa.column('user_id', sa.Integer), sa.column('conversation_id', sa.Integer),
+        sa.column('role', sa.String), sa.column('content', sa.Text), sa.column('created_at', sa.DateTime),
+    )
+
+    orphans = bind.execute(
+        sa.select(
+            messages.c.user_id,
+            sa.func.min(messages.c.created_at),
+            sa.func.max(messages.c.created_at),
+        ).where(messages.c.conversation_id.is_(None)).group_by(messages.c.user_id)
+    ).all()
+
+    for user_id, first_at, last_at in orphans:
+        first_message = bind.execute(
+            sa.select(messages.c.content).where(
+                messages.c.user_id == user_id,
+                messages.c.conversation_id.is_(None),
+                messages.c.role == 'user',
+            ).order_by(messages.c.id).limit(1)
+        ).scalar()
+        conversation_id = bind.execute(conversations.insert().values(
+            user_id=user_id,
+            title=first_message[:60] if first_message else DEFAULT_CONVERSATION_TITLE,
+            created_at=first_at,
+            updated_at=last_at,
+        )).inserted_primary_key[0]
+        bind.execute(
+            messages.update()
+            .where(messages.c.user_id == user_id, messages.c.conversation_id.is_(None))
+            .values(conversation_id=conversation_id)
+        )
+
+def downgrade() -> None:
+    op.drop_table('sessions')
+    op.drop_index('ix_chat_jobs_status_priority_id', table_name='chat_jobs')
+    op.drop_table('chat_jobs')
+    op.drop_index('ix_rate_limit_counters_reset_time', table_name='rate_limit_counters')
+    op.drop_table('rate_limit_counters')
+    with op.batch_alter_table('rate_limits') as batch_op:
+        batch_op.drop_constraint('uq_rate_limits_user_id', type_='unique')
+    op.drop_table('chat_summaries')
+    op.drop_index('ix_messages_conversation_id_id', table_name='messages')
+    op.drop_index('ix_messages_user_id_created_at', table_name='messages')
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_constraint('fk_messages_conversation_id', type_='foreignkey')
+        batch_op.drop_column('conversation_id')
+    op.drop_index('ix_conversations_user_id_id', table_name='conversations')
+    op.drop_table('conversations')
+    op.drop_column('users', 'tier')
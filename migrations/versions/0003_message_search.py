@@ -0,0 +1,83 @@
+"""
+Full-text index of message contents.
+
+PostgreSQL: a generated tsvector column, computed by the database on every
+insert and update, with a GIN index. SQLite (local development): an FTS5
+table over the messages table, kept in sync by triggers. Either way the index
+follows every write, including the bulk inserts of the message writer, and
+rows already in the table are indexed here.
+
+On SQLite, a batch alter of the messages table copies it to a new table,
+which drops the triggers: a migration doing one has to recreate them.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+# Text search configuration of the tsvector (utils.message_search.TEXT_SEARCH_CONFIG)
+TEXT_SEARCH_CONFIG = 'english'
+
+SQLITE_TRIGGERS = {
+    'messages_fts_insert': """
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+    """,
+    'messages_fts_delete': """
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    """,
+    'messages_fts_update': """
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+    """,
+}
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    if bind.dialect.name == 'postgresql':
+        if 'search_vector' not in {column['name'] for column in inspector.get_columns('messages')}:
+            op.execute(
+                "ALTER TABLE messages ADD COLUMN search_vector tsvector "
+                f"GENERATED ALWAYS AS (to_tsvector('{TEXT_SEARCH_CONFIG}', content)) STORED"
+            )
+        if 'ix_messages_search_vector' not in {index['name'] for index in inspector.get_indexes('messages')}:
+            op.create_index('ix_messages_search_vector', 'messages', ['search_vector'], postgresql_using='gin')
+
+    elif bind.dialect.name == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+            "content, content='messages', content_rowid='id', tokenize='porter unicode61')"
+        )
+        triggers = {
+            row[0] for row in bind.execute(sa.text("SELECT name FROM sqlite_master WHERE type = 'trigger'"))
+        }
+        for name, statement in SQLITE_TRIGGERS.items():
+            if name not in triggers:
+                op.execute(statement)
+        op.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+def downgrade() -> None:
+    bind = op.get_bind()
+
+    if bind.dialect.name == 'postgresql':
+        op.drop_index('ix_messages_search_vector', table_name='messages')
+        op.execute("ALTER TABLE messages DROP COLUMN search_vector")
+
+    elif bind.dialect.name == 'sqlite':
+        for name in SQLITE_TRIGGERS:
+            op.execute(f"DROP TRIGGER IF EXISTS {name}")
+        op.execute("DROP TABLE IF EXISTS messages_fts")
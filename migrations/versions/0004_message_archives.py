@@ -0,0 +1,52 @@
+"""
+Compressed archive of old messages.
+
+Adds the message_archives table, which holds the segments of old messages the
+retention compactor moves out of messages, and an index on
+messages.created_at so that the compactor finds old messages without scanning
+the table.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+
+    if 'message_archives' not in inspector.get_table_names():
+        op.create_table(
+            'message_archives',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+            sa.Column('conversation_id', sa.Integer(), sa.ForeignKey('conversations.id'), nullable=False),
+            sa.Column('first_message_id', sa.Integer(), nullable=False),
+            sa.Column('last_message_id', sa.Integer(), nullable=False),
+            sa.Column('message_count', sa.Integer(), nullable=False),
+            sa.Column('codec', sa.String(10), nullable=False),
+            sa.Column('data', sa.LargeBinary(), nullable=False),
+            sa.Column('first_created_at', sa.DateTime(), nullable=False),
+            sa.Column('last_created_at', sa.DateTime(), nullable=False),
+            sa.Column('archived_at', sa.DateTime()),
+        )
+        op.create_index(
+            'ix_message_archives_conversation_id_last_message_id', 'message_archives',
+            ['conversation_id', 'last_message_id']
+        )
+        op.create_index('ix_message_archives_last_created_at', 'message_archives', ['last_created_at'])
+
+    if 'ix_messages_created_at' not in {index['name'] for index in inspector.get_indexes('messages')}:
+        op.create_index('ix_messages_created_at', 'messages', ['created_at'])
+
+def downgrade() -> None:
+    op.drop_index('ix_messages_created_at', table_name='messages')
+    op.drop_index('ix_message_archives_last_created_at', table_name='message_archives')
+    op.drop_index('ix_message_archives_conversation_id_last_message_id', table_name='message_archives')
+    op.drop_table('message_archives')
@@ -4,10 +4,13 @@ Database models for the application.
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from utils.password_hasher import hash_password, needs_rehash, verify_password
 
 db = SQLAlchemy()
 
+# Title of a conversation until its first message names it
+DEFAULT_CONVERSATION_TITLE = 'New conversation'
+
 class User(UserMixin, db.Model):
     """User model for authentication."""
     __tablename__ = 'users'
@@ -16,26 +19,66 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(64), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
+    tier = db.Column(db.String(20), nullable=False, default='free', server_default='free')  # Rate limit tier
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     messages = db.relationship('Message', backref='user', lazy=True)
+    conversations = db.relationship('Conversation', backref='user', lazy='dynamic')
     
     def set_password(self, password):
-        """Set password hash."""
-        self.password_hash = generate_password_hash(password)
+        """Set password hash (computed in the hashing pool, see utils.password_hasher)."""
+        self.password_hash = hash_password(password)
     
     def check_password(self, password):
         """Check if password is correct."""
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+    
+    def password_needs_rehash(self):
+        """Check if the password hash was made with outdated parameters."""
+        return needs_rehash(self.password_hash)
     
     def __repr__(self):
         return f'<User {self.username}>'
 
+class Conversation(db.Model):
+    """Conversation model grouping the messages of one chat thread."""
+    __tablename__ = 'conversations'
+    __table_args__ = (
+        db.Index('ix_conversations_user_id_id', 'user_id', 'id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    title = db.Column(db.String(120), nullable=False, default=DEFAULT_CONVERSATION_TITLE)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    messages = db.relationship('Message', backref='conversation', lazy='dynamic')
+    
+    def __repr__(self):
+        return f'<Conversation {self.id} - {self.title}>'
+    
+    def to_dict(self):
+        """Convert conversation to dictionary format for API responses."""
+        return {
+            'id': self.id,
+            'title': self.title,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat()
+        }
+
 class Message(db.Model):
     """Message model for chat history."""
     __tablename__ = 'messages'
+    __table_args__ = (
+        # History is always read newest-first within a user or conversation
+        db.Index('ix_messages_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_messages_conversation_id_id', 'conversation_id', 'id'),
+        # The retention compactor looks for messages older than a cutoff
+        db.Index('ix_messages_created_at', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=True)
     role = db.Column(db.String(20), nullable=False)  # 'user' or 'assistant'
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -47,19 +90,104 @@ class Message(db.Model):
         """Convert message to dictionary format for API responses."""
         return {
             'id': self.id,
+            'conversation_id': self.conversation_id,
             'role': self.role,
             'content': self.content,
             'created_at': self.created_at.isoformat()
         }
 
+class MessageArchive(db.Model):
+    """
+    Compressed segment of old messages of a conversation, moved out of the
+    messages table by the retention compactor (see utils.message_archive).
+    """
+    __tablename__ = 'message_archives'
+    __table_args__ = (
+        # History pages back through a conversation's segments, newest first
+        db.Index('ix_message_archives_conversation_id_last_message_id', 'conversation_id', 'last_message_id'),
+        db.Index('ix_message_archives_last_created_at', 'last_created_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False)
+    first_message_id = db.Column(db.Integer, nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    codec = db.Column(db.String(10), nullable=False)  # 'zstd' or 'zlib'
+    data = db.Column(db.LargeBinary, nullable=False)  # Compressed JSON list of the messages
+    first_created_at = db.Column(db.DateTime, nullable=False)
+    last_created_at = db.Column(db.DateTime, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<MessageArchive {self.conversation_id} - Messages {self.first_message_id} to {self.last_message_id}>'
+
+class ChatSummary(db.Model):
+    """Rolling summary of the messages that no longer fit in the AI context window."""
+    __tablename__ = 'chat_summaries'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), unique=True, nullable=False)
+    content = db.Column(db.Text, nullable=False, default='')
+    last_message_id = db.Column(db.Integer, nullable=False, default=0)  # Last message folded into the summary
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ChatSummary {self.conversation_id} - Up to message {self.last_message_id}>'
+
 class RateLimit(db.Model):
     """Rate limit model for tracking usage."""
     __tablename__ = 'rate_limits'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True, nullable=False)  # Target of the UPSERT in consume_message
+    count = db.Column(db.Integer, default=0)
+    reset_time = db.Column(db.DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f'<RateLimit {self.user_id} - Count: {self.count}>'
+
+class RateLimitCounter(db.Model):
+    """Usage counter of a rate limit key that is not a user (client IPs, sign-in throttles)."""
+    __tablename__ = 'rate_limit_counters'
+    __table_args__ = (
+        # Expired counters are purged by reset time
+        db.Index('ix_rate_limit_counters_reset_time', 'reset_time'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(255), unique=True, nullable=False)  # Target of the UPSERT in consume_counter
     count = db.Column(db.Integer, default=0)
     reset_time = db.Column(db.DateTime, nullable=False)
     
     def __repr__(self):
-        return f'<RateLimit {self.user_id} - Count: {self.count}>'
\ No newline at end of file
+        return f'<RateLimitCounter {self.key} - Count: {self.count}>'
+
+class ChatJob(db.Model):
+    """Chat turn queued for the background workers (job mode)."""
+    __tablename__ = 'chat_jobs'
+    __table_args__ = (
+        # Workers claim the highest-priority, oldest runnable job
+        db.Index('ix_chat_jobs_status_priority_id', 'status', 'priority', 'id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)  # None for anonymous users
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # 'queued', 'running', 'succeeded' or 'failed'
+    priority = db.Column(db.Integer, nullable=False, default=0)  # Higher runs first
+    payload = db.Column(db.Text, nullable=False)  # JSON: the prepared chat turn
+    result = db.Column(db.Text, nullable=True)  # The AI response
+    provider = db.Column(db.String(20), nullable=True)  # The provider that produced the response
+    error = db.Column(db.String(50), nullable=True)  # Error code of the last failed attempt
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # Not run before (retry backoff)
+    locked_until = db.Column(db.DateTime, nullable=True)  # Lease of the worker running the job
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<ChatJob {self.id} - {self.status}>'
@@ -1,15 +1,26 @@
 """
 Routes for authentication.
+
+Password hashes are computed in a process pool (see utils.password_hasher) and
+sign-in attempts are throttled per client IP and username before hashing
+(see utils.rate_limiter), so a burst of logins cannot take the workers away
+from the chat routes.
 """
 import logging
+import math
 from flask import (
     Blueprint, render_template, redirect, url_for, 
     flash, request
 )
 from flask_login import login_user, logout_user, login_required, current_user
+from sqlalchemy.exc import IntegrityError
 from urllib.parse import urlparse
 from models import db, User
 from forms import LoginForm, RegistrationForm
+from utils.rate_limiter import consume_login_attempt, refund_login_attempt, reset_login_attempts
+
+# Shown when the password hashing pool is saturated
+HASHING_BUSY_MESSAGE = 'The server is busy. Please try again in a moment.'
 
 logger = logging.getLogger(__name__)
 
@@ -25,17 +36,48 @@ def login():
         
     form = LoginForm()
     if form.validate_on_submit():
+        # Count the attempt before any password hash is computed
+        throttled = consume_login_attempt(form.username.data)
+        if throttled is not None:
+            limit_info = throttled.limit_info()
+            minutes = max(1, math.ceil(limit_info['remaining_time'] / 60))
+            flash(f'Too many sign-in attempts. Please try again in {minutes} minute(s).', 'danger')
+            return render_template('auth/login.html', title='Sign In', form=form), 429, {
+                'Retry-After': str(limit_info['remaining_time'])
+            }
+        
         # Try to find the user by username
         user = User.query.filter_by(username=form.username.data).first()
         
         # Check if user exists and password is correct
-        if user is None or not user.check_password(form.password.data):
+        try:
+            valid = user is not None and user.check_password(form.password.data)
+        except Exception as e:
+            refund_login_attempt(form.username.data)
+            logger.error("Error checking password: %s", e)
+            flash(HASHING_BUSY_MESSAGE, 'warning')
+            return render_template('auth/login.html', title='Sign In', form=form), 503
+        
+        if not valid:
             flash('Invalid username or password', 'danger')
             return redirect(url_for('auth.login'))
             
+        reset_login_attempts(form.username.data)
+        
+        # Store a new hash if the password was hashed with outdated parameters
+        if user.password_needs_rehash():
+            try:
+                user.set_password(form.password.data)
+                db.session.commit()
+                logger.info("Upgraded password hash of user %s", user.username)
+            except Exception as e:
+                # Signing in does not depend on it: the upgrade is retried next time
+                db.session.rollback()
+                logger.warning("Could not upgrade password hash of user %s: %s", user.username, e)
+        
         # Log the user in
         login_user(user, remember=form.remember_me.data)
-        logger.info(f"User {user.username} logged in")
+        logger.info("User %s logged in", user.username)
         
         # Redirect to the page the user was trying to access
         next_page = request.args.get('next')
@@ -67,13 +109,24 @@ def register():
         user = User()
         user.username = form.username.data
         user.email = form.email.data
-        user.set_password(form.password.data)
+        try:
+            user.set_password(form.password.data)
+        except Exception as e:
+            logger.error("Error hashing password: %s", e)
+            flash(HASHING_BUSY_MESSAGE, 'warning')
+            return render_template('auth/register.html', title='Register', form=form), 503
         
         # Add to database
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Registered concurrently since the form checked the username and email
+            db.session.rollback()
+            flash('Username or email is already registered.', 'danger')
+            return render_template('auth/register.html', title='Register', form=form)
         
-        logger.info(f"New user registered: {user.username}")
+        logger.info("New user registered: %s", user.username)
         flash('Your account has been created! You can now log in.', 'success')
         return redirect(url_for('auth.login'))
         
@@ -1,212 +1,604 @@
 """
 Routes for the chat functionality of the application.
 """
+import json
 import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from flask import (
-    Blueprint, render_template, request, jsonify
+    Blueprint, Response, render_template, request, jsonify, stream_with_context, url_for
 )
+from flask_login import current_user
 
-from services.ai_service import AIService
-from services.local_ai_service import LocalAIService
-from services.deepseek_ai_service import DeepSeekAIService
-from utils.session_utils import get_chat_history, add_message_to_history, clear_chat_history
-from utils.db_rate_limit import check_rate_limit, increment_message_count, get_remaining_messages
+from models import ChatJob
+from services.admission import ProviderOverloaded, create_admission_controller
+from services.chat_provider import format_messages_for_api
+from services.provider_router import ProviderRouter
+from services.response_cache import create_response_cache
+from services.context_builder import (
+    CONTEXT_EVICTION_LOOKBACK, CONTEXT_MAX_MESSAGES, CONTEXT_SUMMARY_ENABLED,
+    ContextBuilder, ExtractiveSummarizer, get_token_estimator
+)
+from utils.session_utils import (
+    get_chat_history_page, get_recent_chat_history, record_chat_turn, clear_chat_history,
+    get_chat_summary, establish_session, persist_session, get_active_conversation_id,
+    get_conversation, get_conversations, start_new_conversation, HISTORY_PAGE_SIZE,
+    remember_anonymous_job, get_anonymous_job_state, mark_anonymous_job_delivered
+)
+from utils.rate_limiter import (
+    consume_message, refund_message, get_rate_limit_identity, get_rate_limit_status,
+    get_remaining_messages
+)
+from utils.message_search import (
+    MAX_SEARCH_QUERY_LENGTH, SEARCH_PAGE_SIZE, decode_cursor, encode_cursor, search_messages
+)
+from utils.chat_jobs import (
+    CHAT_JOB_MODE, FINISHED_STATUSES, JOB_SUCCEEDED,
+    enqueue_chat_job, get_chat_job, is_queue_full, wait_for_chat_job
+)
 
 logger = logging.getLogger(__name__)
 
 # Create a blueprint
 chat_bp = Blueprint('chat', __name__)
 
-# Initialize AI services
-ai_service = AIService()         # OpenAI service
-deepseek_ai_service = DeepSeekAIService()  # DeepSeek AI service
-local_ai_service = LocalAIService()        # Local fallback service
-
-# AI service mode flags
-AI_MODE_OPENAI = 'openai'
-AI_MODE_DEEPSEEK = 'deepseek'
-AI_MODE_LOCAL = 'local'
-
-# Current AI service mode - start with DeepSeek as primary
-current_ai_mode = AI_MODE_DEEPSEEK
-
-def get_ai_model_name():
-    """Get the name of the current AI model being used."""
-    if current_ai_mode == AI_MODE_OPENAI:
-        return "OpenAI GPT-4o"
-    elif current_ai_mode == AI_MODE_DEEPSEEK:
-        return "DeepSeek AI"
+class ChatServices:
+    """The AI providers, their router and the context builder of the chat routes."""
+    
+    def __init__(self):
+        # Imported here: the providers pull in their SDKs and the FAQ index (NumPy)
+        from services.provider_registry import create_provider_registry
+        
+        # AI providers, from AI_PROVIDERS_CONFIG (by default DeepSeek, then OpenAI, then local)
+        self.provider_registry = create_provider_registry()
+        
+        # Assemble a token-budgeted context instead of replaying the whole history
+        token_estimator = get_token_estimator()
+        self.context_builder = ContextBuilder(
+            format_messages_for_api,
+            estimator=token_estimator,
+            summarizer=ExtractiveSummarizer(token_estimator) if CONTEXT_SUMMARY_ENABLED else None
+        )
+        
+        # Route requests to the first healthy provider in the configured order, or to a
+        # weighted pick; breaker state is shared by all workers, and calls to the remote
+        # providers are admitted within their concurrency and token limits
+        self.provider_router = ProviderRouter(
+            self.provider_registry.providers,
+            order=self.provider_registry.order,
+            cache=create_response_cache(),
+            admission=create_admission_controller(
+                token_estimator.count, self.provider_registry.limits, self.provider_registry.max_tokens
+            ),
+            count_tokens=token_estimator.count,
+            weights=self.provider_registry.weights,
+        )
+
+_services: Optional[ChatServices] = None
+_services_lock = threading.Lock()
+
+def get_chat_services() -> ChatServices:
+    """
+    Get the chat services, built on first use rather than at import time so
+    that starting a process (and a scale-up) does not wait for the token
+    encoding and the providers to load.
+    """
+    global _services
+    if _services is None:
+        with _services_lock:
+            if _services is None:
+                _services = ChatServices()
+    return _services
+
+def run_chat_job(messages: List[Dict[str, str]], use_cache: bool = True) -> Tuple[str, str]:
+    """Get the AI response of a queued chat turn (the runner of utils.chat_jobs)."""
+    return get_chat_services().provider_router.get_chat_response(messages, use_cache)
+
+# Reply recorded when a stream ends without any content
+EMPTY_RESPONSE_FALLBACK = "I'm sorry, I couldn't generate a response."
+
+# Headers of Server-Sent Events responses
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+# Longest long-poll on a job, and the interval of keep-alive comments on its event stream
+JOB_MAX_WAIT_SECONDS = 30
+JOB_HEARTBEAT_SECONDS = 15
+
+def get_ai_info(mode: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Get the information about an AI model shown in the UI.
+    
+    Args:
+        mode: The provider that served the response (defaults to the one the
+              router will most likely use next)
+    """
+    services = get_chat_services()
+    provider = services.provider_registry.get(mode) if mode else None
+    if provider is None or provider.is_local:
+        # Simple queries are answered locally even when the remote providers
+        # are up; only report local mode when they are not
+        mode = services.provider_router.preferred_provider()
+        provider = services.provider_registry.get(mode)
+    return {
+        'mode': mode,
+        'name': provider.display_name if provider else mode,
+        'is_local': provider.is_local if provider else False
+    }
+
+def build_context_messages(user_message: str) -> Tuple[List[Dict[str, str]], Optional[Dict[str, Any]]]:
+    """
+    Build the messages for the AI request from the tail of the chat history
+    and the new user message, which is not stored until the turn completes.
+    
+    Messages that fall out of the context window are folded into the rolling
+    summary, which is sent in their place.
+    
+    Args:
+        user_message: The new user message
+        
+    Returns:
+        A tuple with the formatted messages for the AI APIs (all services use
+        the same format) and the summary update to store with the turn, if any
+    """
+    history = get_recent_chat_history(CONTEXT_MAX_MESSAGES + CONTEXT_EVICTION_LOOKBACK - 1)
+    # The newest message is never evicted, so its placeholder id is never recorded
+    history.append({'id': history[-1]['id'] + 1 if history else 1, 'role': 'user', 'content': user_message})
+    
+    summary = get_chat_summary()
+    context_builder = get_chat_services().context_builder
+    window = context_builder.build(history, summary['content'])
+    
+    summary_update = None
+    unsummarized = [msg for msg in window.evicted if msg['id'] > summary['last_message_id']]
+    if unsummarized and context_builder.summarizer:
+        content = context_builder.update_summary(summary['content'], unsummarized)
+        summary_update = {'content': content, 'last_message_id': unsummarized[-1]['id']}
+        window = context_builder.build(history, content)
+    
+    return window.messages, summary_update
+
+def get_error_response(error_message: str) -> Tuple[Dict[str, str], int]:
+    """
+    Map an error code raised by the AI services to a response payload.
+    
+    Args:
+        error_message: The error message raised while getting the AI response
+        
+    Returns:
+        A tuple containing the JSON payload and the HTTP status code
+    """
+    if error_message == "API_QUOTA_EXCEEDED":
+        # API quota exceeded error
+        return {
+            'error': 'openai_quota_exceeded',
+            'message': 'The API quota has been exceeded. Switching to an alternative AI model.'
+        }, 503
+    elif error_message == "API_RATE_LIMITED":
+        # API rate limited error
+        return {
+            'error': 'openai_rate_limited',
+            'message': 'The API is currently rate limited. Please try again in a few minutes.'
+        }, 429
+    elif error_message == "API_KEY_INVALID":
+        # API key invalid error
+        return {
+            'error': 'openai_key_invalid',
+            'message': 'The API key is invalid or has expired. Switching to an alternative AI model.'
+        }, 401
+    elif error_message == "PROVIDER_OVERLOADED":
+        # Too many requests queued for the AI service
+        return {
+            'error': 'provider_overloaded',
+            'message': 'The AI service is busy. Please try again in a few seconds.'
+        }, 503
+    elif error_message == "DEEPSEEK_API_KEY_MISSING":
+        # DeepSeek API key missing
+        return {
+            'error': 'deepseek_key_missing',
+            'message': 'The DeepSeek API key is missing. Switching to OpenAI.'
+        }, 401
     else:
-        return "Local AI (Fallback)"
+        # Generic error
+        return {
+            'error': 'server_error',
+            'message': 'An error occurred processing your request. Please try again later.'
+        }, 500
+
+def get_error_headers(error: Exception) -> Dict[str, str]:
+    """Get the headers of an error response, e.g. Retry-After when a provider is overloaded."""
+    if isinstance(error, ProviderOverloaded):
+        return {'Retry-After': str(error.retry_after)}
+    return {}
+
+def use_response_cache(data: Dict[str, Any]) -> bool:
+    """
+    Check whether a cached AI response may be served for this request.
+    
+    Clients opt out with {"cache": false} in the body or a
+    "Cache-Control: no-cache" header.
+    """
+    if data.get('cache') is False:
+        return False
+    return 'no-cache' not in request.headers.get('Cache-Control', '')
+
+def use_job_mode(data: Optional[Dict[str, Any]]) -> bool:
+    """
+    Check whether a chat request is processed as a background job.
+    
+    Clients opt in with {"mode": "job"} in the body, unless CHAT_JOB_MODE
+    makes it the default.
+    """
+    return CHAT_JOB_MODE or bool(data and data.get('mode') == 'job')
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Format a server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 @chat_bp.route('/')
 def index():
     """Render the main chat page."""
-    # Get chat history from session
-    chat_history = get_chat_history()
+    # Get the most recent page of chat history; older pages are fetched lazily
+    chat_history, has_more = get_chat_history_page()
+    conversation_id = get_active_conversation_id() if current_user.is_authenticated else None
     
     # Get remaining messages for the user
     remaining_messages = get_remaining_messages()
     
     # Get the current AI model information
-    ai_info = {
-        'mode': current_ai_mode,
-        'name': get_ai_model_name(),
-        'is_local': current_ai_mode == AI_MODE_LOCAL
-    }
+    ai_info = get_ai_info()
     
     return render_template('index.html', 
                           chat_history=chat_history, 
+                          has_more=has_more,
+                          conversation_id=conversation_id,
                           remaining_messages=remaining_messages,
                           ai_info=ai_info)
 
+def prepare_chat_turn(data: Optional[Dict[str, Any]]) -> Tuple[Optional[Dict[str, Any]], Optional[Tuple[Dict[str, Any], int]]]:
+    """
+    Run the steps of a chat turn that come before the AI call: validate the
+    request, consume a message from the quota and build the context. Nothing
+    is stored until finish_chat_turn, so a failed turn leaves no trace.
+    
+    Shared by the WSGI routes below and the async handlers in asgi.py; must
+    run inside a request context.
+    
+    Args:
+        data: The JSON body of the request
+        
+    Returns:
+        A tuple of the turn and None, or None and an error (payload, status
+        code) to return instead
+    """
+    if not data or 'message' not in data:
+        return None, ({'error': 'Invalid request. Message is required.'}, 400)
+        
+    user_message = data['message'].strip()
+    
+    if not user_message:
+        return None, ({'error': 'Message cannot be empty.'}, 400)
+    
+    # Check the rate limit and consume a message in one atomic step
+    is_limited, usage = consume_message()
+    if is_limited:
+        return None, ({
+            'error': 'rate_limit_exceeded',
+            'limit_info': usage['limit_info']
+        }, 429)
+    
+    try:
+        # Format the recent conversation and the new message for the API
+        received_at = datetime.utcnow()
+        formatted_messages, summary = build_context_messages(user_message)
+    except Exception:
+        refund_message()
+        raise
+    
+    return {
+        'user_message': user_message,
+        'received_at': received_at,
+        'messages': formatted_messages,
+        'summary': summary,
+        'remaining': usage['remaining'],
+        'use_cache': use_response_cache(data)
+    }, None
+
+def finish_chat_turn(turn: Dict[str, Any], ai_response: str, provider: str) -> Dict[str, Any]:
+    """
+    Store both messages of a chat turn at once. Must run inside a request context.
+    
+    Args:
+        turn: The turn returned by prepare_chat_turn
+        ai_response: The AI response text
+        provider: The provider that produced the response
+        
+    Returns:
+        The usage and model information returned to the client
+    """
+    record_chat_turn(turn['user_message'], ai_response, turn['summary'], turn['received_at'])
+    return {
+        'remaining_messages': turn['remaining'],
+        'ai_info': get_ai_info(provider)
+    }
+
+def enqueue_chat_turn(data: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], int, Dict[str, str]]:
+    """
+    Prepare a chat turn and queue it as a background job. Must run inside a
+    request context.
+    
+    Args:
+        data: The JSON body of the request
+        
+    Returns:
+        A tuple with the JSON payload, the HTTP status code and the headers
+    """
+    # Refuse work before charging the quota when the workers are behind
+    if is_queue_full():
+        return {
+            'error': 'queue_full',
+            'message': 'The server is busy. Please try again shortly.'
+        }, 503, {'Retry-After': str(JOB_MAX_WAIT_SECONDS)}
+    
+    turn, error = prepare_chat_turn(data)
+    if error:
+        payload, status_code = error
+        return payload, status_code, {}
+    
+    try:
+        conversation_id = get_active_conversation_id(create=True) if current_user.is_authenticated else None
+        key, tier = get_rate_limit_identity()
+        job_id = enqueue_chat_job(turn, conversation_id, key, tier)
+    except Exception:
+        refund_message()
+        raise
+    
+    if not current_user.is_authenticated:
+        remember_anonymous_job(job_id)
+    
+    status_url = url_for('chat.get_job', job_id=job_id)
+    return {
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': status_url,
+        'events_url': url_for('chat.job_events', job_id=job_id),
+        'remaining_messages': turn['remaining']
+    }, 202, {'Location': status_url}
+
 @chat_bp.route('/api/chat', methods=['POST'])
 def chat():
     """
     Process chat messages and return AI responses.
     
     Expects JSON with format: {'message': 'user message here'}
+    (add 'cache': false to bypass the response cache)
     Returns JSON with format: {'response': 'AI response here'}
     
+    With 'mode': 'job' (or CHAT_JOB_MODE) the message is queued instead and
+    202 is returned with the job id and the URLs to fetch the result from.
+    
     Rate limited for free tier usage.
     """
-    global current_ai_mode
-    
+    turn = None
     try:
-        # Check rate limit before processing
-        is_limited, limit_info = check_rate_limit()
-        if is_limited:
-            return jsonify({
-                'error': 'rate_limit_exceeded',
-                'limit_info': limit_info
-            }), 429
-        
-        # Get user message from request
         data = request.get_json()
+        if use_job_mode(data):
+            payload, status_code, headers = enqueue_chat_turn(data)
+            return jsonify(payload), status_code, headers
         
-        if not data or 'message' not in data:
-            return jsonify({'error': 'Invalid request. Message is required.'}), 400
-            
-        user_message = data['message'].strip()
+        turn, error = prepare_chat_turn(data)
+        if error:
+            payload, status_code = error
+            return jsonify(payload), status_code
         
-        if not user_message:
-            return jsonify({'error': 'Message cannot be empty.'}), 400
-            
-        # Get chat history from session
-        chat_history = get_chat_history()
+        # Get the response from the first healthy AI service
+        ai_response, provider = get_chat_services().provider_router.get_chat_response(
+            turn['messages'], use_cache=turn['use_cache']
+        )
+        
+        return jsonify({
+            'response': ai_response,
+            **finish_chat_turn(turn, ai_response, provider)
+        })
         
-        # Add user message to chat history
-        add_message_to_history('user', user_message)
+    except Exception as e:
+        error_message = str(e)
+        logger.error("Error in chat endpoint: %s", error_message)
         
-        # Update chat history after adding user message
-        chat_history = get_chat_history()
+        # Failed requests don't count against the quota
+        if turn is not None:
+            refund_message()
         
-        # Format messages for API (all services use the same format)
-        formatted_messages = ai_service.format_messages_for_api(chat_history)
+        payload, status_code = get_error_response(error_message)
+        return jsonify(payload), status_code, get_error_headers(e)
+
+@chat_bp.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Process chat messages and stream the AI response as Server-Sent Events.
+    
+    Expects JSON with format: {'message': 'user message here'}
+    (add 'cache': false to bypass the response cache)
+    Streams events of the form:
+        event: delta  data: {'content': 'partial text'}
+        event: done   data: {'remaining_messages': 4, 'ai_info': {...}}
+        event: error  data: {'error': 'error_code', 'message': '...'}
+    
+    Errors raised before the first token (validation, rate limits, an
+    overloaded or failing AI service) are returned as regular JSON responses
+    instead of a stream. Rate limited for free tier usage.
+    """
+    try:
+        turn, error = prepare_chat_turn(request.get_json())
+    except Exception as e:
+        error_message = str(e)
+        logger.error("Error in chat stream: %s", error_message)
+        payload, status_code = get_error_response(error_message)
+        return jsonify(payload), status_code, get_error_headers(e)
+    
+    if error:
+        payload, status_code = error
+        return jsonify(payload), status_code
+    
+    # The turn is saved to the session after the headers are sent
+    establish_session()
+    
+    try:
+        provider, stream = get_chat_services().provider_router.open_stream(turn['messages'], use_cache=turn['use_cache'])
+    except Exception as e:
+        error_message = str(e)
+        logger.error("Error in chat stream: %s", error_message)
         
-        # Get response from the appropriate AI service based on current mode
-        global current_ai_mode
+        # Failed requests don't count against the quota
+        refund_message()
+        
+        payload, status_code = get_error_response(error_message)
+        return jsonify(payload), status_code, get_error_headers(e)
+    
+    def generate() -> Iterator[str]:
+        chunks = []
         try:
-            if current_ai_mode == AI_MODE_DEEPSEEK:
-                # Try DeepSeek AI first
-                logger.info("Using DeepSeek AI service")
-                ai_response = deepseek_ai_service.get_chat_response(formatted_messages)
-            elif current_ai_mode == AI_MODE_OPENAI:
-                # Use OpenAI as backup
-                logger.info("Using OpenAI service")
-                ai_response = ai_service.get_chat_response(formatted_messages)
-            else:
-                # Use local AI service as last resort
-                logger.info("Using local AI service")
-                ai_response = local_ai_service.get_chat_response(formatted_messages)
+            for chunk in stream:
+                chunks.append(chunk)
+                yield format_sse('delta', {'content': chunk})
         except Exception as e:
             error_message = str(e)
+            logger.error("Error in chat stream: %s", error_message)
+            payload, _ = get_error_response(error_message)
             
-            if error_message in ["API_QUOTA_EXCEEDED", "API_KEY_INVALID", "DEEPSEEK_API_KEY_MISSING"]:
-                logger.warning(f"Error with AI service: {error_message}")
-                
-                # If DeepSeek fails, try OpenAI
-                if current_ai_mode == AI_MODE_DEEPSEEK:
-                    try:
-                        logger.info("DeepSeek error, falling back to OpenAI")
-                        current_ai_mode = AI_MODE_OPENAI
-                        ai_response = ai_service.get_chat_response(formatted_messages)
-                    except Exception as openai_error:
-                        # If OpenAI also fails, use local fallback
-                        logger.warning(f"OpenAI also failed: {str(openai_error)}, using local fallback")
-                        current_ai_mode = AI_MODE_LOCAL
-                        ai_response = local_ai_service.get_chat_response(formatted_messages)
-                # If OpenAI fails, use local fallback
-                elif current_ai_mode == AI_MODE_OPENAI:
-                    logger.info("OpenAI error, falling back to local service")
-                    current_ai_mode = AI_MODE_LOCAL
-                    ai_response = local_ai_service.get_chat_response(formatted_messages)
-                else:
-                    # Re-raise if we're already in local mode and still getting errors
-                    raise
-            else:
-                # Re-raise other exceptions to be handled by the outer try-except
-                raise
-        
-        # Add AI response to chat history
-        add_message_to_history('assistant', ai_response)
-        
-        # Increment message count for rate limiting
-        increment_message_count()
+            # Failed requests don't count against the quota
+            refund_message()
+            persist_session()
+            
+            yield format_sse('error', payload)
+            return
         
-        # Get remaining messages for the response
-        remaining_messages = get_remaining_messages()
+        ai_response = ''.join(chunks)
+        if not ai_response:
+            ai_response = EMPTY_RESPONSE_FALLBACK
+            yield format_sse('delta', {'content': ai_response})
         
-        # Get AI model info for the response
-        ai_info = {
-            'mode': current_ai_mode,
-            'name': get_ai_model_name(),
-            'is_local': current_ai_mode == AI_MODE_LOCAL
-        }
+        # Persist the assembled reply once the stream has closed
+        result = finish_chat_turn(turn, ai_response, provider)
+        persist_session()
         
-        return jsonify({
-            'response': ai_response,
-            'remaining_messages': remaining_messages,
-            'ai_info': ai_info
-        })
+        yield format_sse('done', result)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers=SSE_HEADERS
+    )
+
+def find_chat_job(job_id: int) -> Optional[ChatJob]:
+    """Get a job if it belongs to the current user or, for anonymous users, to the session."""
+    if current_user.is_authenticated:
+        job = get_chat_job(job_id)
+        return job if job is not None and job.user_id == current_user.id else None
+    
+    if get_anonymous_job_state(job_id) is None:
+        return None
+    job = get_chat_job(job_id)
+    return job if job is not None and job.user_id is None else None
+
+def deliver_chat_job(job: ChatJob) -> Dict[str, Any]:
+    """
+    Build the payload describing a job. When an anonymous user's job has
+    succeeded its turn is recorded in the session on first delivery
+    (authenticated users' turns are recorded by the worker).
+    """
+    payload: Dict[str, Any] = {'job_id': job.id, 'status': job.status, 'attempts': job.attempts}
+    if job.status not in FINISHED_STATUSES:
+        return payload
+    
+    if job.status != JOB_SUCCEEDED:
+        error_payload, _ = get_error_response(job.error or '')
+        return {**payload, **error_payload}
+    
+    turn = json.loads(job.payload)
+    if job.user_id is None and get_anonymous_job_state(job.id) is False:
+        record_chat_turn(
+            turn['user_message'], job.result, turn['summary'],
+            datetime.fromisoformat(turn['received_at'])
+        )
+        mark_anonymous_job_delivered(job.id)
+    
+    return {
+        **payload,
+        'response': job.result,
+        'remaining_messages': turn['remaining'],
+        'ai_info': get_ai_info(job.provider)
+    }
+
+@chat_bp.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Get the status of a chat job, and its result once it has finished.
+    
+    Query parameters:
+        wait: Seconds to wait for the job to finish (long-poll, at most 30)
         
-    except Exception as e:
-        error_message = str(e)
-        logger.error(f"Error in chat endpoint: {error_message}")
-        
-        # Handle specific error types
-        if error_message == "API_QUOTA_EXCEEDED":
-            # API quota exceeded error
-            return jsonify({
-                'error': 'openai_quota_exceeded',
-                'message': 'The API quota has been exceeded. Switching to an alternative AI model.'
-            }), 503
-        elif error_message == "API_RATE_LIMITED":
-            # API rate limited error
-            return jsonify({
-                'error': 'openai_rate_limited',
-                'message': 'The API is currently rate limited. Please try again in a few minutes.'
-            }), 429
-        elif error_message == "API_KEY_INVALID":
-            # API key invalid error
-            return jsonify({
-                'error': 'openai_key_invalid',
-                'message': 'The API key is invalid or has expired. Switching to an alternative AI model.'
-            }), 401
-        elif error_message == "DEEPSEEK_API_KEY_MISSING":
-            # DeepSeek API key missing
-            logger.error("DeepSeek API key is missing - update current_ai_mode")
-            current_ai_mode = AI_MODE_OPENAI
-            return jsonify({
-                'error': 'deepseek_key_missing',
-                'message': 'The DeepSeek API key is missing. Switching to OpenAI.'
-            }), 401
-        else:
-            # Generic error
-            return jsonify({
-                'error': 'server_error',
-                'message': 'An error occurred processing your request. Please try again later.'
-            }), 500
+    Returns 202 while the job is queued or running and 200 once it has
+    finished, with the same fields as /api/chat (or an error) on completion.
+    """
+    job = find_chat_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found.'}), 404
+    
+    wait = max(0.0, min(request.args.get('wait', 0, type=float), JOB_MAX_WAIT_SECONDS))
+    if wait and job.status not in FINISHED_STATUSES:
+        job = wait_for_chat_job(job_id, wait)
+        if job is None:
+            return jsonify({'error': 'Job not found.'}), 404
+    
+    payload = deliver_chat_job(job)
+    return jsonify(payload), 200 if job.status in FINISHED_STATUSES else 202
+
+@chat_bp.route('/api/jobs/<int:job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """
+    Stream the progress of a chat job as Server-Sent Events.
+    
+    Streams events of the form:
+        event: status  data: {'job_id': 1, 'status': 'running', 'attempts': 1}
+        event: done    data: {'response': '...', 'remaining_messages': 4, 'ai_info': {...}}
+        event: error   data: {'error': 'error_code', 'message': '...'}
+    """
+    job = find_chat_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found.'}), 404
+    
+    def generate() -> Iterator[str]:
+        current = job
+        last_status = None
+        while True:
+            if current is None:
+                yield format_sse('error', {'error': 'job_not_found', 'message': 'The job no longer exists.'})
+                return
+            
+            if current.status in FINISHED_STATUSES:
+                payload = deliver_chat_job(current)
+                persist_session()
+                yield format_sse('done' if current.status == JOB_SUCCEEDED else 'error', payload)
+                return
+            
+            if current.status != last_status:
+                last_status = current.status
+                yield format_sse('status', {'job_id': current.id, 'status': current.status, 'attempts': current.attempts})
+            else:
+                # Keep proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+            
+            current = wait_for_chat_job(job_id, JOB_HEARTBEAT_SECONDS)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers=SSE_HEADERS
+    )
 
 @chat_bp.route('/api/chat/clear', methods=['POST'])
 def clear_chat():
@@ -215,15 +607,108 @@ def clear_chat():
         clear_chat_history()
         return jsonify({'success': True})
     except Exception as e:
-        logger.error(f"Error clearing chat history: {str(e)}")
+        logger.error("Error clearing chat history: %s", e)
         return jsonify({'error': 'Failed to clear chat history.'}), 500
 
+@chat_bp.route('/api/conversations', methods=['GET'])
+def list_conversations():
+    """
+    List the user's conversations, newest first.
+    
+    Query parameters:
+        before: Conversation id to page back from (keyset pagination)
+        limit: Page size
+    """
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Authentication required.'}), 401
+    
+    before = request.args.get('before', type=int)
+    limit = max(1, min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 100))
+    conversations, has_more = get_conversations(before=before, limit=limit)
+    
+    return jsonify({
+        'conversations': conversations,
+        'has_more': has_more,
+        'next_before': conversations[-1]['id'] if has_more else None
+    })
+
+@chat_bp.route('/api/conversations', methods=['POST'])
+def create_conversation():
+    """Start a new conversation and make it the active one."""
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Authentication required.'}), 401
+    
+    conversation = start_new_conversation()
+    return jsonify({'conversation': conversation.to_dict()}), 201
+
+@chat_bp.route('/api/conversations/<int:conversation_id>/messages', methods=['GET'])
+def get_conversation_messages(conversation_id):
+    """
+    Get a page of messages from a conversation, oldest first within the page.
+    
+    Query parameters:
+        before: Message id to page back from (keyset pagination)
+        limit: Page size
+    """
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Authentication required.'}), 401
+    
+    if get_conversation(conversation_id) is None:
+        return jsonify({'error': 'Conversation not found.'}), 404
+    
+    before = request.args.get('before', type=int)
+    limit = max(1, min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 100))
+    messages, has_more = get_chat_history_page(conversation_id, before=before, limit=limit)
+    
+    return jsonify({
+        'messages': messages,
+        'has_more': has_more,
+        'next_before': messages[0]['id'] if has_more else None
+    })
+
+@chat_bp.route('/api/messages/search', methods=['GET'])
+def search_chat_messages():
+    """
+    Search the user's messages, best matches first.
+    
+    Query parameters:
+        q: The search query
+        conversation_id: Only search this conversation
+        cursor: The next_cursor of the previous page (keyset pagination)
+        limit: Page size
+    """
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Authentication required.'}), 401
+    
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Search query is required.'}), 400
+    if len(query) > MAX_SEARCH_QUERY_LENGTH:
+        return jsonify({'error': f'Search query must be at most {MAX_SEARCH_QUERY_LENGTH} characters.'}), 400
+    
+    cursor = request.args.get('cursor')
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor.'}), 400
+    
+    conversation_id = request.args.get('conversation_id', type=int)
+    limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 100))
+    results, next_after = search_messages(
+        current_user.id, query, conversation_id=conversation_id, after=after, limit=limit
+    )
+    
+    return jsonify({
+        'results': results,
+        'has_more': next_after is not None,
+        'next_cursor': encode_cursor(*next_after) if next_after else None
+    })
+
 @chat_bp.route('/api/usage', methods=['GET'])
 def get_usage():
     """Get the current usage info and limits."""
     try:
-        is_limited, limit_info = check_rate_limit()
-        remaining = get_remaining_messages()
+        is_limited, limit_info, remaining = get_rate_limit_status()
         
         return jsonify({
             'is_limited': is_limited,
@@ -231,5 +716,5 @@ def get_usage():
             'limit_info': limit_info if is_limited else None
         })
     except Exception as e:
-        logger.error(f"Error getting usage info: {str(e)}")
+        logger.error("Error getting usage info: %s", e)
         return jsonify({'error': 'Failed to get usage information.'}), 500
@@ -0,0 +1,25 @@
+"""
+Route exposing the Prometheus metrics.
+"""
+import hmac
+import os
+from flask import Blueprint, Response, request
+
+from utils.metrics import generate_metrics
+
+# Bearer token required to scrape /metrics (empty to allow any client)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# Create a blueprint
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Serve the metrics of all worker processes in the Prometheus text format."""
+    if METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(supplied, METRICS_TOKEN):
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    
+    body, content_type = generate_metrics()
+    return Response(body, content_type=content_type)
@@ -0,0 +1,377 @@
+"""
+Admission control for the remote AI providers.
+
+Each provider gets a limit on concurrent calls and, optionally, a
+tokens-per-minute budget. A call that cannot start at once waits in a bounded
+FIFO queue until a slot and enough budget are free. When the queue is full, or
+the expected wait exceeds the caller's deadline, ProviderOverloaded is raised
+right away so the client can be told to retry later instead of piling more load
+on a provider that is about to answer with 429s.
+
+Limits are enforced per process: divide a provider's account limits by the
+number of worker processes when configuring them.
+"""
+import asyncio
+import collections
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from services.chat_provider import DEFAULT_MAX_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# Admission control ("1" to enable)
+ADMISSION_ENABLED = os.environ.get("AI_ADMISSION_ENABLED", "1") == "1"
+
+# Default limits of every remote provider: concurrent calls, tokens per minute
+# (0 for no budget), queued calls, and seconds a call may wait to be admitted
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("AI_ADMISSION_MAX_IN_FLIGHT", "16"))
+ADMISSION_TOKENS_PER_MINUTE = int(os.environ.get("AI_ADMISSION_TOKENS_PER_MINUTE", "0"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("AI_ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_TIMEOUT = float(os.environ.get("AI_ADMISSION_TIMEOUT", "10"))
+
+# Per-provider overrides, e.g.
+# AI_PROVIDER_LIMITS='{"openai": {"max_in_flight": 8, "tokens_per_minute": 30000}}'
+PROVIDER_LIMITS: Dict[str, Dict[str, Any]] = json.loads(os.environ.get("AI_PROVIDER_LIMITS", "{}"))
+
+# Weight of the latest call in the moving average of call durations
+HOLD_TIME_EWMA_ALPHA = 0.2
+
+class ProviderOverloaded(Exception):
+    """Raised when a call to a provider cannot be admitted in time."""
+
+    def __init__(self, provider: str, retry_after: int):
+        super().__init__("PROVIDER_OVERLOADED")
+        self.provider = provider
+        self.retry_after = retry_after
+
+class Lease:
+    """A call admitted by a ProviderLimiter; release it when the call has finished."""
+
+    def __init__(self, limiter: Optional['ProviderLimiter'] = None, tokens: int = 0):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        """Give the slot back (idempotent)."""
+        if self.released:
+            return
+        self.released = True
+        if self.limiter is not None:
+            self.limiter._release(self)
+
+    def __enter__(self) -> 'Lease':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+# Lease of calls that are not limited
+UNLIMITED = Lease()
+UNLIMITED.released = True
+
+class _Waiter:
+    """A queued call, woken by a thread event or, on an event loop, a future."""
+
+    def __init__(self, tokens: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.tokens = tokens
+        self.admitted = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def wake(self) -> None:
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self) -> None:
+        if not self.future.done():
+            self.future.set_result(None)
+
+class ProviderLimiter:
+    """Concurrency limit and token budget of one provider, with a FIFO wait queue."""
+
+    def __init__(
+        self,
+        name: str,
+        max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+        tokens_per_minute: int = ADMISSION_TOKENS_PER_MINUTE,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        timeout: float = ADMISSION_TIMEOUT,
+    ):
+        """
+        Args:
+            name: The provider name
+            max_in_flight: Maximum number of concurrent calls
+            tokens_per_minute: Token budget, refilled continuously (0 for none)
+            max_queue: Maximum number of calls waiting to be admitted
+            timeout: Default number of seconds a call may wait
+        """
+        self.name = name
+        self.max_in_flight = max(1, max_in_flight)
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiters: Deque[_Waiter] = collections.deque()
+        self.tokens = float(tokens_per_minute)
+        self.refilled_at = time.monotonic()
+        # Moving average of call durations, to estimate queueing delays
+        self.hold_time: Optional[float] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.tokens_per_minute:
+            self.tokens = min(
+                float(self.tokens_per_minute),
+                self.tokens + (now - self.refilled_at) * self.tokens_per_minute / 60.0
+            )
+        self.refilled_at = now
+
+    def _can_admit(self, tokens: int) -> bool:
+        if self.in_flight >= self.max_in_flight:
+            return False
+        # A call larger than the whole budget waits for a full bucket
+        return not self.tokens_per_minute or self.tokens >= min(tokens, self.tokens_per_minute)
+
+    def _reserve(self, tokens: int) -> None:
+        self.in_flight += 1
+        if self.tokens_per_minute:
+            self.tokens -= tokens
+
+    def _dispatch(self) -> None:
+        """Admit queued calls in order while there is room. Call with the lock held."""
+        self._refill()
+        while self.waiters and self._can_admit(self.waiters[0].tokens):
+            waiter = self.waiters.popleft()
+            self._reserve(waiter.tokens)
+            waiter.admitted = True
+            waiter.wake()
+
+    def _token_wait(self, tokens: int) -> float:
+        """Seconds until the budget covers a call. Call with the lock held."""
+        if not self.tokens_per_minute:
+            return 0.0
+        missing = min(tokens, self.tokens_per_minute) - self.tokens
+        return max(0.0, missing * 60.0 / self.tokens_per_minute)
+
+    def _expected_wait(self, tokens: int) -> float:
+        """Estimate how long a call queued now would wait. Call with the lock held."""
+        queued_tokens = sum(waiter.tokens for waiter in self.waiters) + tokens
+        wait = self._token_wait(queued_tokens)
+        if self.hold_time is not None:
+            rounds = (self.in_flight + len(self.waiters) + 1) // self.max_in_flight
+            wait = max(wait, rounds * self.hold_time)
+        return wait
+
+    def _overloaded(self, wait: float) -> ProviderOverloaded:
+        logger.warning("%s AI service is overloaded, rejecting call", self.name)
+        return ProviderOverloaded(self.name, max(1, math.ceil(wait)))
+
+    def _enqueue(self, tokens: int, timeout: float, loop=None) -> _Waiter:
+        """Queue a call, or raise ProviderOverloaded if it cannot be admitted in time. Call with the lock held."""
+        expected = self._expected_wait(tokens)
+        if len(self.waiters) >= self.max_queue or expected > timeout:
+            raise self._overloaded(expected)
+        waiter = _Waiter(tokens, loop)
+        self.waiters.append(waiter)
+        return waiter
+
+    def _poll_interval(self, waiter: _Waiter, remaining: float) -> float:
+        """
+        Time to sleep before re-checking: the token budget refills without
+        anyone releasing a slot, so a waiter blocked on it polls.
+        """
+        token_wait = self._token_wait(waiter.tokens)
+        return min(remaining, token_wait) if token_wait > 0 else remaining
+
+    def _remove(self, waiter: _Waiter) -> None:
+        """Drop a waiter from the queue. Call with the lock held."""
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def _timed_out(self, waiter: _Waiter) -> ProviderOverloaded:
+        """Drop a waiter whose deadline passed. Call with the lock held."""
+        self._remove(waiter)
+        return self._overloaded(self._expected_wait(0))
+
+    def try_acquire(self, tokens: int = 0) -> Optional[Lease]:
+        """
+        Admit a call only if it can start immediately and nobody is queued.
+
+        Returns:
+            The lease, or None if the call would have to wait
+        """
+        with self.lock:
+            self._refill()
+            if not self.waiters and self._can_admit(tokens):
+                self._reserve(tokens)
+                return Lease(self, tokens)
+        return None
+
+    def acquire(self, tokens: int = 0, timeout: Optional[float] = None) -> Lease:
+        """
+        Admit a call, waiting in the queue if needed.
+
+        Args:
+            tokens: Estimated tokens of the call
+            timeout: Seconds the call may wait (defaults to the limiter's)
+
+        Returns:
+            The lease of the admitted call
+
+        Raises:
+            ProviderOverloaded: If the queue is full or the call was not admitted in time
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        with self.lock:
+            self._refill()
+            if not self.waiters and self._can_admit(tokens):
+                self._reserve(tokens)
+                return Lease(self, tokens)
+            waiter = self._enqueue(tokens, timeout)
+
+        while True:
+            remaining = deadline - time.monotonic()
+            with self.lock:
+                self._dispatch()
+                if waiter.admitted:
+                    return Lease(self, tokens)
+                if remaining <= 0:
+                    raise self._timed_out(waiter)
+                interval = self._poll_interval(waiter, remaining)
+            waiter.event.wait(interval)
+
+    async def aacquire(self, tokens: int = 0, timeout: Optional[float] = None) -> Lease:
+        """Async version of acquire: waiting does not block the event loop."""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        with self.lock:
+            self._refill()
+            if not self.waiters and self._can_admit(tokens):
+                self._reserve(tokens)
+                return Lease(self, tokens)
+            waiter = self._enqueue(tokens, timeout, asyncio.get_running_loop())
+
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                with self.lock:
+                    self._dispatch()
+                    if waiter.admitted:
+                        return Lease(self, tokens)
+                    if remaining <= 0:
+                        raise self._timed_out(waiter)
+                    interval = self._poll_interval(waiter, remaining)
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), interval)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            # Give back a slot granted while the caller was being cancelled
+            with self.lock:
+                admitted = waiter.admitted
+                if not admitted:
+                    self._remove(waiter)
+            if admitted:
+                Lease(self, tokens).release()
+            raise
+
+    def _release(self, lease: Lease) -> None:
+        with self.lock:
+            self.in_flight -= 1
+            duration = time.monotonic() - lease.started
+            if self.hold_time is None:
+                self.hold_time = duration
+            else:
+                self.hold_time += HOLD_TIME_EWMA_ALPHA * (duration - self.hold_time)
+            self._dispatch()
+
+class AdmissionController:
+    """Provider limiters, built on first use from the configured limits."""
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Dict[str, Any]]] = None,
+        count_tokens: Optional[Callable[[str], int]] = None,
+        completion_tokens: Optional[Dict[str, int]] = None,
+    ):
+        """
+        Args:
+            limits: Per-provider overrides of the ProviderLimiter arguments
+            count_tokens: Counts the tokens of a text (defaults to 4 characters per token)
+            completion_tokens: Tokens reserved for the completion of each
+                               provider's calls, i.e. its max_tokens
+                               (DEFAULT_MAX_TOKENS for the others)
+        """
+        self.limits = PROVIDER_LIMITS if limits is None else limits
+        self.count_tokens = count_tokens or (lambda text: len(text) // 4)
+        self.completion_tokens = completion_tokens or {}
+        self.limiters: Dict[str, ProviderLimiter] = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, name: str) -> ProviderLimiter:
+        """Get the limiter of a provider."""
+        limiter = self.limiters.get(name)
+        if limiter is None:
+            with self.lock:
+                limiter = self.limiters.get(name)
+                if limiter is None:
+                    limiter = ProviderLimiter(name, **self.limits.get(name, {}))
+                    self.limiters[name] = limiter
+        return limiter
+
+    def estimate_tokens(self, name: str, messages: List[Dict[str, Any]]) -> int:
+        """Estimate the tokens a call to a provider will use: the prompt plus its completion budget."""
+        prompt_tokens = sum(self.count_tokens(message['content']) for message in messages)
+        return prompt_tokens + self.completion_tokens.get(name, DEFAULT_MAX_TOKENS)
+
+    def acquire(self, name: str, messages: List[Dict[str, Any]]) -> Lease:
+        """Admit a call to a provider, waiting if needed (see ProviderLimiter.acquire)."""
+        return self.limiter(name).acquire(self.estimate_tokens(name, messages))
+
+    async def aacquire(self, name: str, messages: List[Dict[str, Any]]) -> Lease:
+        """Async version of acquire."""
+        return await self.limiter(name).aacquire(self.estimate_tokens(name, messages))
+
+    def try_acquire(self, name: str, messages: List[Dict[str, Any]]) -> Optional[Lease]:
+        """Admit a call only if it can start immediately."""
+        return self.limiter(name).try_acquire(self.estimate_tokens(name, messages))
+
+def create_admission_controller(
+    count_tokens: Optional[Callable[[str], int]] = None,
+    limits: Optional[Dict[str, Dict[str, Any]]] = None,
+    completion_tokens: Optional[Dict[str, int]] = None,
+) -> Optional[AdmissionController]:
+    """
+    Create the admission controller from the environment, or None if disabled.
+
+    Args:
+        count_tokens: Counts the tokens of a text
+        limits: Per-provider limits from the provider registry; AI_PROVIDER_LIMITS
+                takes precedence for the providers it names
+        completion_tokens: The max_tokens of each provider, from the provider registry
+    """
+    if not ADMISSION_ENABLED:
+        return None
+    return AdmissionController(
+        limits=dict(limits or {}, **PROVIDER_LIMITS),
+        count_tokens=count_tokens,
+        completion_tokens=completion_tokens,
+    )
@@ -2,27 +2,93 @@
 AI Service module that handles interactions with OpenAI API.
 """
 import os
+import asyncio
 import logging
-from typing import Dict, List, Any, cast
+import weakref
+from typing import TYPE_CHECKING, Dict, AsyncIterator, Iterator, List, Any, Optional, cast
 
-from openai import OpenAI
-from openai.types.chat import ChatCompletionMessageParam
+import httpx
+
+from services.chat_provider import ChatProvider
+from services.http_client import get_async_http_client, get_http_client, get_timeout
+
+# The OpenAI SDK takes most of the app's import time, so it is only imported
+# when the first client is created
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+    from openai.types.chat import ChatCompletionMessageParam
 
 logger = logging.getLogger(__name__)
 
-class AIService:
+class AIService(ChatProvider):
     """Service for interacting with OpenAI API."""
     
-    def __init__(self):
-        """Initialize the OpenAI client with API key from environment variables."""
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            logger.warning("OPENAI_API_KEY not found in environment variables")
-            
-        self.client = OpenAI(api_key=api_key)
+    def __init__(self, name: str = "openai", api_key_env: str = "OPENAI_API_KEY",
+                 base_url: Optional[str] = None, timeout: Optional[float] = None, **options: Any):
+        """
+        Initialize the OpenAI client with API key from environment variables.
+        
+        Args:
+            name: Name of the provider
+            api_key_env: Environment variable holding the API key
+            base_url: URL of the API (by default OPENAI_BASE_URL, else the OpenAI API)
+            timeout: Read timeout in seconds, if not the shared default
+            **options: Other ChatProvider arguments
+        """
+        options.setdefault("display_name", "OpenAI GPT-4o")
         # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
         # do not change this unless explicitly requested by the user
-        self.model = "gpt-4o"
+        options.setdefault("model", "gpt-4o")
+        super().__init__(name, **options)
+        
+        self.api_key_env = api_key_env
+        self.api_key = os.environ.get(api_key_env)
+        if not self.api_key:
+            logger.warning("%s not found in environment variables", api_key_env)
+        self.base_url = base_url
+        self.timeout = timeout
+            
+        # Clients are created lazily on top of the shared connection pool, so a
+        # worker forked after import opens its own connections
+        self._client: Optional["OpenAI"] = None
+        self._client_pid: Optional[int] = None
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]" = (
+            weakref.WeakKeyDictionary()
+        )
+        
+    @property
+    def client(self) -> "OpenAI":
+        """Get the OpenAI client for this process, backed by the shared HTTP pool."""
+        if self._client is None or self._client_pid != os.getpid():
+            from openai import OpenAI
+            self._client = OpenAI(
+                api_key=self.api_key,
+                http_client=get_http_client(),
+                base_url=self.base_url,
+                timeout=self._get_timeout(),
+            )
+            self._client_pid = os.getpid()
+        return self._client
+        
+    @property
+    def async_client(self) -> "AsyncOpenAI":
+        """Get the async OpenAI client for the running event loop."""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            from openai import AsyncOpenAI
+            client = AsyncOpenAI(
+                api_key=self.api_key,
+                http_client=get_async_http_client(),
+                base_url=self.base_url,
+                timeout=self._get_timeout(),
+            )
+            self._async_clients[loop] = client
+        return client
+        
+    def is_configured(self) -> bool:
+        """Check whether the API key is set."""
+        return bool(self.api_key)
         
     def get_chat_response(self, messages: List[Dict[str, Any]]) -> str:
         """
@@ -39,23 +105,23 @@ class AIService:
             Exception: If there's an error communicating with the OpenAI API
         """
         try:
-            logger.debug(f"Sending request to OpenAI with {len(messages)} messages")
+            logger.debug("Sending request to OpenAI with %s messages", len(messages))
             
             # Create API request
             # Cast the messages to the correct type for OpenAI
-            openai_messages = cast(List[ChatCompletionMessageParam], messages)
+            openai_messages = cast("List[ChatCompletionMessageParam]", messages)
             
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=openai_messages,
-                temperature=0.7,
-                max_tokens=800,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
             )
             
             # Extract and return the AI's response
             ai_response = response.choices[0].message.content
             if ai_response:
-                logger.debug(f"Received response from OpenAI: {ai_response[:50]}...")
+                logger.debug("Received response from OpenAI: %s...", ai_response[:50])
             else:
                 logger.warning("Received an empty response from OpenAI.")
             
@@ -67,46 +133,141 @@ class AIService:
             return ai_response
             
         except Exception as e:
-            error_message = str(e)
-            logger.error(f"Error getting response from OpenAI: {error_message}")
-            
-            # Check for specific error types
-            if "insufficient_quota" in error_message or "429" in error_message:
-                raise Exception("API_QUOTA_EXCEEDED")
-            elif "rate_limit" in error_message:
-                raise Exception("API_RATE_LIMITED")
-            elif "invalid_api_key" in error_message or "authentication" in error_message.lower():
-                raise Exception("API_KEY_INVALID")
-            else:
-                raise Exception(f"Failed to get AI response: {error_message}")
+            self._raise_api_error(e)
 
-    def format_messages_for_api(self, chat_history: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    def stream_chat_response(self, messages: List[Dict[str, Any]]) -> Iterator[str]:
         """
-        Format chat history for the OpenAI API.
+        Stream a response from the OpenAI chat API.
         
         Args:
-            chat_history: List of message objects from the session
+            messages: A list of message objects with role and content keys
+        
+        Yields:
+            Text deltas as they are produced by the model
+            
+        Raises:
+            Exception: If there's an error communicating with the OpenAI API
+        """
+        try:
+            logger.debug("Streaming request to OpenAI with %s messages", len(messages))
+            
+            openai_messages = cast("List[ChatCompletionMessageParam]", messages)
+            
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=openai_messages,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                stream=True,
+            )
             
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+                    
+        except Exception as e:
+            self._raise_api_error(e)
+
+    async def aget_chat_response(self, messages: List[Dict[str, Any]]) -> str:
+        """
+        Get a response from the OpenAI chat API without blocking the event loop.
+        
+        Args:
+            messages: A list of message objects with role and content keys
+        
         Returns:
-            Formatted messages list for OpenAI API
+            The text response from the AI
+            
+        Raises:
+            Exception: If there's an error communicating with the OpenAI API
+        """
+        try:
+            logger.debug("Sending async request to OpenAI with %s messages", len(messages))
+            
+            openai_messages = cast("List[ChatCompletionMessageParam]", messages)
+            
+            response = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=openai_messages,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+            )
+            
+            ai_response = response.choices[0].message.content
+            if ai_response is None:
+                logger.warning("AI response is None. Returning an empty string.")
+                return ""
+            
+            return ai_response
+            
+        except Exception as e:
+            self._raise_api_error(e)
+
+    async def astream_chat_response(self, messages: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        """
+        Stream a response from the OpenAI chat API without blocking the event loop.
+        
+        Args:
+            messages: A list of message objects with role and content keys
+        
+        Yields:
+            Text deltas as they are produced by the model
+            
+        Raises:
+            Exception: If there's an error communicating with the OpenAI API
+        """
+        try:
+            logger.debug("Streaming async request to OpenAI with %s messages", len(messages))
+            
+            openai_messages = cast("List[ChatCompletionMessageParam]", messages)
+            
+            stream = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=openai_messages,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                stream=True,
+            )
+            
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+                    
+        except Exception as e:
+            self._raise_api_error(e)
+
+    def _get_timeout(self) -> httpx.Timeout:
+        """Get the timeouts of a request: the shared ones, with this provider's read timeout."""
+        timeout = get_timeout()
+        if self.timeout is None:
+            return timeout
+        return httpx.Timeout(connect=timeout.connect, read=self.timeout, write=timeout.write, pool=timeout.pool)
+
+    def _raise_api_error(self, e: Exception) -> None:
+        """
+        Translate an OpenAI client error into the error codes used by the routes.
+        
+        Args:
+            e: The exception raised by the OpenAI client
+            
+        Raises:
+            Exception: Always, with one of the known error codes when possible
         """
-        # Add system message at the beginning
-        formatted_messages = [
-            {
-                "role": "system", 
-                "content": (
-                    "You are an AI assistant that is helpful, creative, clever, and very friendly. "
-                    "Provide thoughtful and concise responses to the user's questions or comments. "
-                    "If you don't know something, be honest about it rather than making up information."
-                )
-            }
-        ]
-        
-        # Add all messages from chat history
-        for message in chat_history:
-            formatted_messages.append({
-                "role": message["role"],
-                "content": message["content"]
-            })
-            
-        return formatted_messages
+        error_message = str(e)
+        logger.error("Error getting response from OpenAI: %s", error_message)
+        
+        # Check for specific error types
+        if "insufficient_quota" in error_message or "429" in error_message:
+            raise Exception("API_QUOTA_EXCEEDED")
+        elif "rate_limit" in error_message:
+            raise Exception("API_RATE_LIMITED")
+        elif "invalid_api_key" in error_message or "authentication" in error_message.lower():
+            raise Exception("API_KEY_INVALID")
+        else:
+            raise Exception(f"Failed to get AI response: {error_message}")
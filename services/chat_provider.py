@@ -0,0 +1,417 @@
+"""
+Common interface of the AI providers.
+
+A provider turns the messages built by format_messages_for_api into a
+response, whole or streamed, with sync and async variants. Any backend that
+speaks the OpenAI chat completions wire format (DeepSeek, a vLLM or llama.cpp
+server, ...) is served by OpenAICompatibleProvider from configuration alone;
+see services.provider_registry.
+"""
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import httpx
+
+from services.http_client import get_async_http_client, get_http_client, get_timeout
+
+logger = logging.getLogger(__name__)
+
+# System prompt sent at the start of every conversation
+SYSTEM_PROMPT = (
+    "You are an AI assistant that is helpful, creative, clever, and very friendly. "
+    "Provide thoughtful and concise responses to the user's questions or comments. "
+    "If you don't know something, be honest about it rather than making up information."
+)
+
+# Sampling temperature and completion length of every request
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_MAX_TOKENS = 800
+
+# Reply used when a provider returns an empty completion
+EMPTY_RESPONSE = "I'm sorry, I couldn't generate a response."
+
+def format_messages_for_api(chat_history: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """
+    Format chat history for the chat completions APIs.
+
+    Args:
+        chat_history: List of message objects with role and content keys
+
+    Returns:
+        The system prompt followed by the messages
+    """
+    formatted_messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    for message in chat_history:
+        formatted_messages.append({
+            "role": message["role"],
+            "content": message["content"]
+        })
+    return formatted_messages
+
+class ChatProvider(ABC):
+    """Base class of the AI providers."""
+
+    # Whether the provider runs in-process (no network, nothing to cache)
+    is_local = False
+
+    def __init__(
+        self,
+        name: str,
+        display_name: Optional[str] = None,
+        model: Optional[str] = None,
+        weight: float = 0.0,
+        cost_per_1k_prompt: float = 0.0,
+        cost_per_1k_completion: float = 0.0,
+        temperature: float = DEFAULT_TEMPERATURE,
+        max_tokens: int = DEFAULT_MAX_TOKENS,
+    ):
+        """
+        Args:
+            name: Name of the provider, used in routing, metrics and the UI
+            display_name: Name shown to users
+            model: Model requested from the provider
+            weight: Share of the traffic sent to this provider first (see ProviderRouter)
+            cost_per_1k_prompt: Price of 1000 prompt tokens, for the cost metrics
+            cost_per_1k_completion: Price of 1000 completion tokens
+            temperature: Sampling temperature
+            max_tokens: Longest completion requested
+        """
+        self.name = name
+        self.display_name = display_name or name
+        self.model = model or name
+        self.weight = weight
+        self.cost_per_1k_prompt = cost_per_1k_prompt
+        self.cost_per_1k_completion = cost_per_1k_completion
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+
+    def is_configured(self) -> bool:
+        """Check whether the provider has the credentials it needs."""
+        return True
+
+    @abstractmethod
+    def get_chat_response(self, messages: List[Dict[str, Any]]) -> str:
+        """Get a response to the messages."""
+
+    def stream_chat_response(self, messages: List[Dict[str, Any]]) -> Iterator[str]:
+        """Stream a response as text deltas (by default, the whole response at once)."""
+        yield self.get_chat_response(messages)
+
+    @abstractmethod
+    async def aget_chat_response(self, messages: List[Dict[str, Any]]) -> str:
+        """Async variant of get_chat_response."""
+
+    async def astream_chat_response(self, messages: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        """Async variant of stream_chat_response."""
+        yield await self.aget_chat_response(messages)
+
+    def format_messages_for_api(self, chat_history: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        """Format chat history for the provider (see format_messages_for_api)."""
+        return format_messages_for_api(chat_history)
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.name} ({self.model})>'
+
+class OpenAICompatibleProvider(ChatProvider):
+    """
+    Provider for any API following the OpenAI chat completions format, called
+    over the shared connection pool. Streams are ``data: {...}`` server-sent
+    events terminated by ``data: [DONE]``.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        model: str,
+        api_key_env: Optional[str] = None,
+        timeout: Optional[float] = None,
+        headers: Optional[Dict[str, str]] = None,
+        **options: Any,
+    ):
+        """
+        Args:
+            name: Name of the provider
+            base_url: URL of the API, up to and excluding /chat/completions
+            model: Model requested from the provider
+            api_key_env: Environment variable holding the API key, or None for
+                         servers that need no key (e.g. a self-hosted model)
+            timeout: Read timeout in seconds, if not the shared default
+            headers: Extra HTTP headers sent with every request
+            **options: Other ChatProvider arguments
+        """
+        super().__init__(name, model=model, **options)
+        self.base_url = base_url.rstrip("/")
+        self.api_key_env = api_key_env
+        self.api_key = os.environ.get(api_key_env) if api_key_env else None
+        self.timeout = timeout
+        self.headers = headers or {}
+
+        if api_key_env and not self.api_key:
+            logger.warning("%s not found in environment variables", api_key_env)
+
+    def is_configured(self) -> bool:
+        """Check whether the provider has the credentials it needs."""
+        return not self.api_key_env or bool(self.api_key)
+
+    def get_chat_response(self, messages: List[Dict[str, Any]]) -> str:
+        """
+        Get a response from the API.
+
+        Args:
+            messages: A list of message objects with role and content keys
+
+        Returns:
+            The text response from the AI
+
+        Raises:
+            Exception: If there's an error communicating with the API
+        """
+        self._check_configured()
+
+        try:
+            logger.debug("Sending request to %s with %s messages", self.display_name, len(messages))
+
+            # Make the API request over the shared connection pool
+            response = get_http_client().post(
+                f"{self.base_url}/chat/completions",
+                headers=self._get_headers(),
+                json=self._build_payload(messages),
+                timeout=self._get_timeout()
+            )
+
+            # Check for errors
+            self._check_response(response)
+
+            return self._parse_response(response.json())
+
+        except httpx.HTTPError as e:
+            logger.error("Network error when communicating with %s API: %s", self.display_name, e)
+            raise Exception(f"Failed to connect to {self.display_name} API: {str(e)}")
+        except Exception as e:
+            self._reraise(e)
+
+    async def aget_chat_response(self, messages: List[Dict[str, Any]]) -> str:
+        """
+        Get a response from the API without blocking the event loop.
+
+        Args:
+            messages: A list of message objects with role and content keys
+
+        Returns:
+            The text response from the AI
+
+        Raises:
+            Exception: If there's an error communicating with the API
+        """
+        self._check_configured()
+
+        try:
+            logger.debug("Sending async request to %s with %s messages", self.display_name, len(messages))
+
+            response = await get_async_http_client().post(
+                f"{self.base_url}/chat/completions",
+                headers=self._get_headers(),
+                json=self._build_payload(messages),
+                timeout=self._get_timeout()
+            )
+
+            self._check_response(response)
+
+            return self._parse_response(response.json())
+
+        except httpx.HTTPError as e:
+            logger.error("Network error when communicating with %s API: %s", self.display_name, e)
+            raise Exception(f"Failed to connect to {self.display_name} API: {str(e)}")
+        except Exception as e:
+            self._reraise(e)
+
+    def stream_chat_response(self, messages: List[Dict[str, Any]]) -> Iterator[str]:
+        """
+        Stream a response from the API.
+
+        Args:
+            messages: A list of message objects with role and content keys
+
+        Yields:
+            Text deltas as they are produced by the model
+
+        Raises:
+            Exception: If there's an error communicating with the API
+        """
+        self._check_configured()
+
+        try:
+            logger.debug("Streaming request to %s with %s messages", self.display_name, len(messages))
+
+            with get_http_client().stream(
+                "POST",
+                f"{self.base_url}/chat/completions",
+                headers=self._get_headers(),
+                json=self._build_payload(messages, stream=True),
+                timeout=self._get_timeout()
+            ) as response:
+                if response.status_code != 200:
+                    response.read()
+                    self._check_response(response)
+
+                for line in response.iter_lines():
+                    delta = self._parse_stream_line(line)
+                    if delta is None:
+                        break
+                    if delta:
+                        yield delta
+
+        except httpx.HTTPError as e:
+            logger.error("Network error when communicating with %s API: %s", self.display_name, e)
+            raise Exception(f"Failed to connect to {self.display_name} API: {str(e)}")
+        except Exception as e:
+            self._reraise(e)
+
+    async def astream_chat_response(self, messages: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        """
+        Stream a response from the API without blocking the event loop.
+
+        Args:
+            messages: A list of message objects with role and content keys
+
+        Yields:
+            Text deltas as they are produced by the model
+
+        Raises:
+            Exception: If there's an error communicating with the API
+        """
+        self._check_configured()
+
+        try:
+            logger.debug("Streaming async request to %s with %s messages", self.display_name, len(messages))
+
+            async with get_async_http_client().stream(
+                "POST",
+                f"{self.base_url}/chat/completions",
+                headers=self._get_headers(),
+                json=self._build_payload(messages, stream=True),
+                timeout=self._get_timeout()
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    self._check_response(response)
+
+                async for line in response.aiter_lines():
+                    delta = self._parse_stream_line(line)
+                    if delta is None:
+                        break
+                    if delta:
+                        yield delta
+
+        except httpx.HTTPError as e:
+            logger.error("Network error when communicating with %s API: %s", self.display_name, e)
+            raise Exception(f"Failed to connect to {self.display_name} API: {str(e)}")
+        except Exception as e:
+            self._reraise(e)
+
+    @property
+    def missing_key_error(self) -> str:
+        """Error code raised when the API key is missing, e.g. DEEPSEEK_API_KEY_MISSING."""
+        return f"{self.name.upper()}_API_KEY_MISSING"
+
+    def _check_configured(self) -> None:
+        if not self.is_configured():
+            raise Exception(self.missing_key_error)
+
+    def _get_headers(self) -> Dict[str, str]:
+        """Build the HTTP headers for an API request."""
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        headers.update(self.headers)
+        return headers
+
+    def _get_timeout(self) -> httpx.Timeout:
+        """Get the timeouts of a request: the shared ones, with this provider's read timeout."""
+        timeout = get_timeout()
+        if self.timeout is None:
+            return timeout
+        return httpx.Timeout(connect=timeout.connect, read=self.timeout, write=timeout.write, pool=timeout.pool)
+
+    def _build_payload(self, messages: List[Dict[str, Any]], stream: bool = False) -> Dict[str, Any]:
+        """Build the JSON body for a chat completions request."""
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        """Extract the response text from a chat completions result."""
+        ai_response = result.get("choices", [{}])[0].get("message", {}).get("content", "")
+
+        if not ai_response:
+            logger.warning("Received an empty response from %s", self.display_name)
+            return EMPTY_RESPONSE
+
+        return ai_response
+
+    def _parse_stream_line(self, line: str) -> Optional[str]:
+        """
+        Extract the text delta from one line of a streamed response.
+
+        Returns:
+            The delta text (empty for keep-alives and non-content events),
+            or None once the stream signals it is done
+        """
+        if not line.startswith("data:"):
+            return ""
+
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None
+
+        choices = json.loads(data).get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content") or ""
+
+    def _check_response(self, response: httpx.Response) -> None:
+        """
+        Raise the matching error code if the API returned an error.
+
+        Args:
+            response: The HTTP response from the API
+        """
+        if response.status_code == 200:
+            return
+
+        try:
+            error_message = response.json().get("error", {}).get("message", "Unknown error")
+        except ValueError:
+            error_message = f"HTTP {response.status_code}"
+        logger.error("%s API error: %s", self.display_name, error_message)
+
+        if "quota" in error_message.lower() or response.status_code == 429:
+            raise Exception("API_QUOTA_EXCEEDED")
+        elif "invalid api key" in error_message.lower():
+            raise Exception("API_KEY_INVALID")
+        else:
+            raise Exception(f"{self.display_name} API error: {error_message}")
+
+    def _reraise(self, e: Exception) -> None:
+        """
+        Re-raise known error codes unchanged and wrap everything else.
+
+        Args:
+            e: The exception raised while talking to the API
+        """
+        error_message = str(e)
+        logger.error("Error getting response from %s: %s", self.display_name, error_message)
+
+        # Re-raise specific errors
+        if error_message in ["API_QUOTA_EXCEEDED", "API_KEY_INVALID", self.missing_key_error]:
+            raise e
+        else:
+            raise Exception(f"Failed to get AI response: {error_message}")
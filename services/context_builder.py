@@ -0,0 +1,232 @@
+"""
+Context assembly for AI requests.
+
+Instead of replaying the whole conversation on every turn, the context builder
+keeps the system prompt plus the most recent messages that fit in a token
+budget. Messages that slide out of the window can be folded into a rolling
+summary that is sent in their place.
+"""
+import logging
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Token budget for the messages sent to the provider (system prompt included)
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CHAT_CONTEXT_TOKEN_BUDGET", "3000"))
+
+# Upper bound on the number of history messages kept in the window
+CONTEXT_MAX_MESSAGES = int(os.environ.get("CHAT_CONTEXT_MAX_MESSAGES", "40"))
+
+# Extra messages loaded beyond the window so evicted turns can be summarized
+CONTEXT_EVICTION_LOOKBACK = 10
+
+# Rolling summary of evicted turns ("1" to enable) and its token budget
+CONTEXT_SUMMARY_ENABLED = os.environ.get("CHAT_CONTEXT_SUMMARY", "1") == "1"
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.environ.get("CHAT_CONTEXT_SUMMARY_MAX_TOKENS", "300"))
+
+# Tokenizer used for estimates: "auto", "tiktoken" or "chars"
+CONTEXT_TOKENIZER = os.environ.get("CHAT_CONTEXT_TOKENIZER", "auto")
+
+# Approximate per-message overhead added by the chat format
+MESSAGE_TOKEN_OVERHEAD = 4
+
+class CharacterTokenEstimator:
+    """Estimate token counts from text length (roughly 4 characters per token)."""
+
+    def __init__(self, chars_per_token: float = 4.0):
+        """Initialize the estimator with the average characters per token."""
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        """Estimate the number of tokens in a text."""
+        return int(len(text) / self.chars_per_token) + 1
+
+class TiktokenEstimator:
+    """Count tokens with a tiktoken encoding."""
+
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        """
+        Initialize the estimator with a tiktoken encoding.
+
+        Raises:
+            ImportError: If tiktoken is not installed
+        """
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def count(self, text: str) -> int:
+        """Count the number of tokens in a text."""
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+def get_token_estimator(name: str = CONTEXT_TOKENIZER):
+    """
+    Get a token estimator by name.
+
+    Args:
+        name: "tiktoken", "chars" or "auto" (tiktoken when available)
+
+    Returns:
+        An object with a count(text) -> int method
+    """
+    if name in ("auto", "tiktoken"):
+        try:
+            return TiktokenEstimator()
+        except Exception as e:
+            if name == "tiktoken":
+                raise
+            logger.info("tiktoken unavailable (%s), using character-based token estimates", e)
+    return CharacterTokenEstimator()
+
+class ExtractiveSummarizer:
+    """
+    Build a rolling summary without calling a model.
+
+    Each evicted message contributes its first sentence; the oldest lines are
+    dropped once the summary exceeds its token budget.
+    """
+
+    def __init__(self, estimator, max_tokens: int = CONTEXT_SUMMARY_MAX_TOKENS, max_line_chars: int = 200):
+        """Initialize the summarizer with a token estimator and budget."""
+        self.estimator = estimator
+        self.max_tokens = max_tokens
+        self.max_line_chars = max_line_chars
+
+    def __call__(self, previous_summary: str, evicted: List[Dict[str, Any]]) -> str:
+        """
+        Fold evicted messages into the previous summary.
+
+        Args:
+            previous_summary: The current summary text (may be empty)
+            evicted: Messages that left the context window, oldest first
+
+        Returns:
+            The updated summary text
+        """
+        lines = [line for line in previous_summary.split("\n") if line]
+
+        for message in evicted:
+            text = " ".join(message["content"].split())
+            first_sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+            if len(first_sentence) > self.max_line_chars:
+                first_sentence = first_sentence[:self.max_line_chars].rstrip() + "..."
+            speaker = "User" if message["role"] == "user" else "Assistant"
+            lines.append(f"{speaker}: {first_sentence}")
+
+        # Keep the most recent lines that fit in the summary budget
+        kept: List[str] = []
+        total = 0
+        for line in reversed(lines):
+            total += self.estimator.count(line)
+            if total > self.max_tokens:
+                break
+            kept.append(line)
+
+        return "\n".join(reversed(kept))
+
+class ContextWindow:
+    """The result of assembling a context: messages to send and messages evicted."""
+
+    def __init__(self, messages: List[Dict[str, str]], evicted: List[Dict[str, Any]], token_count: int):
+        self.messages = messages
+        self.evicted = evicted
+        self.token_count = token_count
+
+class ContextBuilder:
+    """Assemble the messages sent to the AI provider under a token budget."""
+
+    def __init__(
+        self,
+        formatter: Callable[[List[Dict[str, Any]]], List[Dict[str, str]]],
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+        max_messages: int = CONTEXT_MAX_MESSAGES,
+        estimator=None,
+        summarizer: Optional[Callable[[str, List[Dict[str, Any]]], str]] = None,
+    ):
+        """
+        Initialize the context builder.
+
+        Args:
+            formatter: Function that turns chat history into API messages,
+                       prepending the system prompt (format_messages_for_api)
+            token_budget: Maximum estimated tokens for the whole request
+            max_messages: Maximum number of history messages in the window
+            estimator: Token estimator (defaults to get_token_estimator())
+            summarizer: Optional callable folding evicted messages into a summary
+        """
+        self.formatter = formatter
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+        self.estimator = estimator or get_token_estimator()
+        self.summarizer = summarizer
+
+    def count_message_tokens(self, message: Dict[str, Any]) -> int:
+        """Estimate the tokens used by one message, including format overhead."""
+        return self.estimator.count(message["content"]) + MESSAGE_TOKEN_OVERHEAD
+
+    def build(self, history: List[Dict[str, Any]], summary: str = "") -> ContextWindow:
+        """
+        Build the context for the next request.
+
+        Args:
+            history: Recent messages, oldest first, ending with the new user message
+            summary: Rolling summary of earlier turns, if any
+
+        Returns:
+            A ContextWindow with the formatted messages and the evicted history
+        """
+        # Fixed cost: system prompt(s) and the summary
+        system_messages = self.formatter([])
+        summary_messages = []
+        if summary:
+            summary_messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{summary}"
+            })
+        used = sum(
+            self.count_message_tokens(message) for message in system_messages + summary_messages
+        )
+
+        # Walk back from the newest message until the budget is exhausted.
+        # The newest message is always kept, even if it is over budget.
+        start = len(history)
+        for index in range(len(history) - 1, -1, -1):
+            cost = self.count_message_tokens(history[index])
+            if start < len(history) and (
+                used + cost > self.token_budget or len(history) - index > self.max_messages
+            ):
+                break
+            used += cost
+            start = index
+
+        # Don't open the window halfway through a turn
+        while start < len(history) - 1 and history[start]["role"] != "user":
+            used -= self.count_message_tokens(history[start])
+            start += 1
+
+        window = history[start:]
+        formatted = self.formatter(window)
+        messages = (
+            formatted[:len(system_messages)] + summary_messages + formatted[len(system_messages):]
+        )
+
+        logger.debug(
+            "Context window: %s of %s messages, ~%s tokens", len(window), len(history), used
+        )
+        return ContextWindow(messages, history[:start], used)
+
+    def update_summary(self, summary: str, evicted: List[Dict[str, Any]]) -> str:
+        """
+        Fold evicted messages into the rolling summary.
+
+        Args:
+            summary: The current summary
+            evicted: Messages that left the window and are not yet summarized
+
+        Returns:
+            The new summary (unchanged when summarization is disabled)
+        """
+        if not self.summarizer or not evicted:
+            return summary
+        return self.summarizer(summary, evicted)
@@ -0,0 +1,109 @@
+"""
+BM25 index of frequently asked questions, for answering simple queries locally.
+
+Every paraphrase of a question is a document. The BM25 weight of each term in
+each document is computed once when the index is built, so scoring a query is
+a single vectorized sum over the columns of its terms. Scores are turned into
+a confidence between 0 and 1 by dividing by the score a document holding each
+query term once would get, counting terms missing from the vocabulary at the
+highest IDF: a query is only answered confidently when it is mostly made of
+the words of a known question.
+"""
+import json
+import os
+import re
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+# Bundled FAQ: a list of {"questions": [...], "answer": "..."}
+FAQ_PATH = os.environ.get(
+    "LOCAL_FAQ_PATH", os.path.join(os.path.dirname(__file__), "data", "faq.json")
+)
+
+# BM25 parameters: term frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+(?:['-][^\W_]+)*")
+
+# Words too common to tell questions apart
+STOPWORDS = frozenset(
+    "a an and are can could do does for i is it me my of on or please the to you your".split()
+)
+
+class FAQMatch(NamedTuple):
+    """The best FAQ entry for a query."""
+    answer: str
+    question: str
+    confidence: float
+
+def tokenize(text: str) -> List[str]:
+    """Split a text into lowercase terms, without stopwords."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+class FAQIndex:
+    """BM25 index over the questions of an FAQ."""
+
+    def __init__(self, entries: List[Dict[str, Any]], k1: float = BM25_K1, b: float = BM25_B):
+        """
+        Args:
+            entries: FAQ entries, each with "questions" (paraphrases) and "answer"
+            k1: BM25 term frequency saturation
+            b: BM25 length normalization
+        """
+        self.questions: List[str] = []
+        self.answers: List[str] = []
+        documents: List[List[str]] = []
+        for entry in entries:
+            for question in entry['questions']:
+                self.questions.append(question)
+                self.answers.append(entry['answer'])
+                documents.append(tokenize(question))
+
+        self.vocabulary: Dict[str, int] = {}
+        for document in documents:
+            for term in document:
+                self.vocabulary.setdefault(term, len(self.vocabulary))
+
+        tf = np.zeros((len(documents), len(self.vocabulary)), dtype=np.float32)
+        for row, document in enumerate(documents):
+            for term in document:
+                tf[row, self.vocabulary[term]] += 1
+
+        lengths = tf.sum(axis=1, keepdims=True)
+        average_length = max(float(lengths.mean()), 1.0) if len(documents) else 1.0
+        document_frequency = (tf > 0).sum(axis=0)
+        self.idf = np.log1p((len(documents) - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+        self.max_idf = float(self.idf.max()) if len(self.idf) else 0.0
+
+        # BM25 weight of every term in every document
+        norm = k1 * (1 - b + b * lengths / average_length)
+        self.weights = self.idf * tf * (k1 + 1) / (tf + norm)
+
+    @classmethod
+    def load(cls, path: str = FAQ_PATH) -> 'FAQIndex':
+        """Build the index of an FAQ file."""
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def match(self, query: str) -> Optional[FAQMatch]:
+        """
+        Find the FAQ entry closest to a query.
+
+        Args:
+            query: The user's message
+
+        Returns:
+            The best match with its confidence, or None if no term is known
+        """
+        terms = tokenize(query)
+        ids = [self.vocabulary[term] for term in terms if term in self.vocabulary]
+        if not ids:
+            return None
+
+        scores = self.weights[:, ids].sum(axis=1)
+        best = int(scores.argmax())
+        ideal = float(self.idf[ids].sum()) + self.max_idf * (len(terms) - len(ids))
+        confidence = min(float(scores[best]) / ideal, 1.0) if ideal > 0 else 0.0
+        return FAQMatch(self.answers[best], self.questions[best], confidence)
@@ -0,0 +1,132 @@
+"""
+Shared, pooled HTTP clients for the AI services.
+
+Every worker process keeps a single httpx client (plus one async client per
+event loop) so that connections to the AI providers are kept alive and reused
+across requests instead of paying a new DNS + TCP + TLS handshake per message.
+"""
+import asyncio
+import atexit
+import logging
+import os
+import threading
+import weakref
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Timeouts in seconds. The read timeout applies between received chunks, so
+# it bounds a stalled upstream without limiting the length of a streamed reply.
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("AI_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("AI_HTTP_READ_TIMEOUT", "60"))
+HTTP_WRITE_TIMEOUT = float(os.environ.get("AI_HTTP_WRITE_TIMEOUT", "10"))
+HTTP_POOL_TIMEOUT = float(os.environ.get("AI_HTTP_POOL_TIMEOUT", "5"))
+
+# Connection pool limits per worker process
+HTTP_MAX_CONNECTIONS = int(os.environ.get("AI_HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("AI_HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("AI_HTTP_KEEPALIVE_EXPIRY", "60"))
+
+# Use HTTP/2 when the optional h2 package is installed
+HTTP2_ENABLED = os.environ.get("AI_HTTP2", "1") == "1"
+
+_client: Optional[httpx.Client] = None
+_client_lock = threading.Lock()
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+def get_timeout() -> httpx.Timeout:
+    """Get the timeout configuration used for AI provider requests."""
+    return httpx.Timeout(
+        connect=HTTP_CONNECT_TIMEOUT,
+        read=HTTP_READ_TIMEOUT,
+        write=HTTP_WRITE_TIMEOUT,
+        pool=HTTP_POOL_TIMEOUT,
+    )
+
+def get_limits() -> httpx.Limits:
+    """Get the connection pool limits used for AI provider requests."""
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+def _use_http2() -> bool:
+    """Check whether HTTP/2 is enabled and supported."""
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def get_http_client() -> httpx.Client:
+    """
+    Get the shared synchronous HTTP client for this process.
+
+    Returns:
+        A pooled httpx client with keep-alive and the configured timeouts
+    """
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(
+                    timeout=get_timeout(),
+                    limits=get_limits(),
+                    http2=_use_http2(),
+                )
+                logger.debug("Created shared HTTP client")
+    return _client
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Get the shared asynchronous HTTP client for the running event loop.
+
+    Async connections are bound to the event loop that opened them, so one
+    client is kept per loop.
+
+    Returns:
+        A pooled httpx async client with keep-alive and the configured timeouts
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=get_timeout(),
+            limits=get_limits(),
+            http2=_use_http2(),
+        )
+        _async_clients[loop] = client
+        logger.debug("Created shared async HTTP client for event loop")
+    return client
+
+def close_http_clients() -> None:
+    """Close the shared synchronous HTTP client."""
+    global _client
+
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+def _reset_after_fork() -> None:
+    """
+    Drop the clients inherited from the parent process. Their sockets belong
+    to the parent, so the child must open its own connections.
+    """
+    global _client, _client_lock
+
+    _client = None
+    _client_lock = threading.Lock()
+    _async_clients.clear()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(close_http_clients)
@@ -3,15 +3,43 @@ Local AI Service module that simulates AI responses when the API is unavailable.
 """
 import logging
 import random
-from typing import Dict, List, Any
+import re
+from typing import Any, Dict, List, Optional
+
+from services.chat_provider import ChatProvider
+from services.faq_index import FAQ_PATH, FAQIndex, FAQMatch
 
 logger = logging.getLogger(__name__)
 
-class LocalAIService:
-    """Service for simulating AI responses when the OpenAI API is unavailable."""
+# Intents of the last user message, in the order they are checked
+GREETING_PATTERN = re.compile(r"\b(?:hello|hi|hey|greetings|olá|oi)\b", re.IGNORECASE)
+QUESTION_PATTERN = re.compile(
+    r"\?|\b(?:what|why|how|when|who|where|can you|could you)\b", re.IGNORECASE
+)
+
+# Lowest confidence of an FAQ answer served by the fallback
+FAQ_MIN_CONFIDENCE = 0.5
+
+class LocalAIService(ChatProvider):
+    """
+    Service for simulating AI responses when the OpenAI API is unavailable.
+    Responses are produced in-process, so streams are a single chunk.
+    """
     
-    def __init__(self):
-        """Initialize the local AI service."""
+    is_local = True
+    
+    def __init__(self, name: str = "local", faq_path: Optional[str] = FAQ_PATH, **options: Any):
+        """
+        Initialize the local AI service.
+        
+        Args:
+            name: Name of the provider
+            faq_path: FAQ answered locally, or None for canned replies only
+            **options: Other ChatProvider arguments
+        """
+        options.setdefault("display_name", "Local AI (Fallback)")
+        super().__init__(name, **options)
+        self.faq = FAQIndex.load(faq_path) if faq_path else None
         self.responses = {
             "greeting": [
                 "Hello! I'm a local AI assistant. The OpenAI service is currently unavailable, so I'm providing limited responses.",
@@ -32,7 +60,9 @@ class LocalAIService:
         
     def get_chat_response(self, messages: List[Dict[str, str]]) -> str:
         """
-        Get a simulated response for when the OpenAI API is unavailable.
+        Get a simulated response for when the OpenAI API is unavailable:
+        a canned reply by intent, or the FAQ answer when the question is a
+        known one.
         
         Args:
             messages: A list of message objects with role and content keys
@@ -40,43 +70,48 @@ class LocalAIService:
         Returns:
             A simulated text response
         """
-        if not messages:
-            return random.choice(self.responses["unknown"])
-        
-        # Get the last user message
-        user_messages = [msg for msg in messages if msg.get("role") == "user"]
-        if not user_messages:
+        last_message = self._last_user_message(messages)
+        if last_message is None:
             return random.choice(self.responses["unknown"])
             
-        last_message = user_messages[-1]["content"].lower()
-        
         # Check if it's a greeting
-        if any(greeting in last_message for greeting in ["hello", "hi", "hey", "greetings", "olá", "oi"]):
+        if GREETING_PATTERN.search(last_message):
             return random.choice(self.responses["greeting"])
             
+        match = self.faq.match(last_message) if self.faq else None
+        if match is not None and match.confidence >= FAQ_MIN_CONFIDENCE:
+            return match.answer
+            
         # Check if it's a question
-        if any(question in last_message for question in ["?", "what", "why", "how", "when", "who", "where", "can you", "could you"]):
+        if QUESTION_PATTERN.search(last_message):
             return random.choice(self.responses["question"])
             
         # Default response
         return random.choice(self.responses["unknown"])
     
-    def format_messages_for_api(self, chat_history: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    def local_answer(self, messages: List[Dict[str, str]]) -> Optional[FAQMatch]:
         """
-        Format chat history for processing.
+        Answer the last user message from the FAQ, so the router can skip the
+        remote providers for simple queries (see ProviderRouter.answer_locally).
         
         Args:
-            chat_history: List of message objects from the session
-            
+            messages: A list of message objects with role and content keys
+        
         Returns:
-            Formatted messages list 
+            The closest FAQ entry with its confidence, or None
         """
-        # Simply return the messages in the format we expect
-        formatted_messages = []
-        for message in chat_history:
-            formatted_messages.append({
-                "role": message["role"],
-                "content": message["content"]
-            })
-            
-        return formatted_messages
\ No newline at end of file
+        last_message = self._last_user_message(messages)
+        if last_message is None or self.faq is None:
+            return None
+        return self.faq.match(last_message)
+    
+    def _last_user_message(self, messages: List[Dict[str, str]]) -> Optional[str]:
+        """Get the content of the last user message, if any."""
+        for message in reversed(messages):
+            if message.get("role") == "user":
+                return message["content"]
+        return None
+    
+    async def aget_chat_response(self, messages: List[Dict[str, str]]) -> str:
+        """Async variant of get_chat_response; the local service never blocks."""
+        return self.get_chat_response(messages)
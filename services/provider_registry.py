@@ -0,0 +1,176 @@
+"""
+Registry of the AI providers, built from configuration.
+
+Providers are described in JSON, given inline or as a path in the
+AI_PROVIDERS_CONFIG environment variable:
+
+    {
+        "providers": {
+            "llama": {
+                "type": "openai_compatible",
+                "base_url": "http://llama.internal:8080/v1",
+                "model": "llama-3.1-8b-instruct",
+                "timeout": 20,
+                "weight": 3,
+                "limits": {"max_in_flight": 32}
+            },
+            "deepseek": {"weight": 1, "cost_per_1k_prompt": 0.00027, "cost_per_1k_completion": 0.0011}
+        },
+        "order": ["llama", "deepseek", "openai", "local"]
+    }
+
+Entries are merged into DEFAULT_PROVIDERS by name (null removes a default
+provider). "type" selects the class in PROVIDER_TYPES; any server speaking the
+OpenAI chat completions format (vLLM, llama.cpp, ...) is an
+"openai_compatible" provider with a base_url, a model and optionally the
+api_key_env variable holding its key. The other keys are the constructor
+arguments of the provider (see services.chat_provider), except "limits", the
+admission limits of the provider (see services.admission).
+
+"order" is the priority order, the last provider being the fallback of last
+resort; it defaults to AI_PROVIDER_ORDER, else to the configured providers with
+the local ones last. Providers with a weight receive a share of the traffic
+first (see services.provider_router).
+"""
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Type
+
+from services.ai_service import AIService
+from services.chat_provider import ChatProvider, OpenAICompatibleProvider
+from services.deepseek_ai_service import DeepSeekAIService
+from services.local_ai_service import LocalAIService
+
+logger = logging.getLogger(__name__)
+
+# Provider configuration: inline JSON or the path of a JSON file (see above)
+AI_PROVIDERS_CONFIG = os.environ.get("AI_PROVIDERS_CONFIG", "")
+
+# Provider classes by type
+PROVIDER_TYPES: Dict[str, Type[ChatProvider]] = {
+    'openai': AIService,
+    'deepseek': DeepSeekAIService,
+    'openai_compatible': OpenAICompatibleProvider,
+    'local': LocalAIService,
+}
+
+# Providers configured when AI_PROVIDERS_CONFIG does not override them
+DEFAULT_PROVIDERS: Dict[str, Dict[str, Any]] = {
+    'deepseek': {'type': 'deepseek'},
+    'openai': {'type': 'openai'},
+    'local': {'type': 'local'},
+}
+
+class ProviderRegistry:
+    """The configured providers with their priority order, weights and limits."""
+
+    def __init__(
+        self,
+        providers: Dict[str, ChatProvider],
+        order: Optional[List[str]] = None,
+        limits: Optional[Dict[str, Dict[str, Any]]] = None,
+    ):
+        """
+        Args:
+            providers: Providers by name
+            order: Provider names in priority order (defaults to the local
+                   providers last)
+            limits: Admission limits by provider name
+        """
+        self.providers = providers
+        self.order = order or (
+            [name for name, provider in providers.items() if not provider.is_local]
+            + [name for name, provider in providers.items() if provider.is_local]
+        )
+        self.limits = limits or {}
+
+    @property
+    def weights(self) -> Dict[str, float]:
+        """Traffic weights of the providers that have one."""
+        return {name: provider.weight for name, provider in self.providers.items() if provider.weight}
+
+    @property
+    def max_tokens(self) -> Dict[str, int]:
+        """Longest completion each provider requests."""
+        return {name: provider.max_tokens for name, provider in self.providers.items()}
+
+    def get(self, name: str) -> Optional[ChatProvider]:
+        """Get a provider by name."""
+        return self.providers.get(name)
+
+    def __iter__(self):
+        return iter(self.providers.values())
+
+def load_providers_config(config: str = AI_PROVIDERS_CONFIG) -> Dict[str, Any]:
+    """
+    Load the provider configuration.
+
+    Args:
+        config: Inline JSON, the path of a JSON file, or empty for the defaults
+
+    Returns:
+        The configuration, with "providers" and optionally "order"
+    """
+    if not config:
+        return {}
+    if config.lstrip().startswith('{'):
+        return json.loads(config)
+    with open(config) as f:
+        return json.load(f)
+
+def create_provider(name: str, spec: Dict[str, Any]) -> ChatProvider:
+    """
+    Create a provider from its configuration.
+
+    Args:
+        name: Name of the provider
+        spec: Its configuration, with a "type" (defaults to the name) and the
+              constructor arguments of that type
+
+    Returns:
+        The provider
+    """
+    options = dict(spec)
+    provider_type = options.pop('type', name)
+    options.pop('limits', None)
+    provider_class = PROVIDER_TYPES.get(provider_type)
+    if provider_class is None:
+        raise ValueError(f"Unknown provider type: {provider_type}")
+    return provider_class(name, **options)
+
+def create_provider_registry(config: Optional[Dict[str, Any]] = None) -> ProviderRegistry:
+    """
+    Create the provider registry from AI_PROVIDERS_CONFIG.
+
+    Args:
+        config: The configuration to use instead of AI_PROVIDERS_CONFIG
+
+    Returns:
+        The provider registry
+    """
+    if config is None:
+        config = load_providers_config()
+
+    specs = dict(DEFAULT_PROVIDERS)
+    for name, spec in config.get('providers', {}).items():
+        if spec is None:
+            specs.pop(name, None)
+        else:
+            specs[name] = dict(specs.get(name, {}), **spec)
+
+    providers = {name: create_provider(name, spec) for name, spec in specs.items()}
+    limits = {name: spec['limits'] for name, spec in specs.items() if spec.get('limits')}
+
+    order = config.get('order')
+    if not order and os.environ.get("AI_PROVIDER_ORDER"):
+        order = [name.strip() for name in os.environ["AI_PROVIDER_ORDER"].split(",")]
+    if order:
+        unknown = [name for name in order if name not in providers]
+        if unknown:
+            logger.warning("Ignoring unconfigured providers in the provider order: %s", ', '.join(unknown))
+        order = [name for name in order if name in providers]
+
+    registry = ProviderRegistry(providers, order, limits)
+    logger.info("AI providers: %s", ', '.join(f'{name} ({providers[name].model})' for name in registry.order))
+    return registry
@@ -0,0 +1,1022 @@
+"""
+Provider router with per-provider circuit breakers.
+
+The router tries the AI providers in order, skipping any whose circuit breaker
+is open. A breaker opens after consecutive failures, lets a single probe
+request through once the recovery period has passed (half-open) and closes
+again when the probe succeeds, so an outage costs a few failed calls instead of
+one per message and recovery is automatic.
+
+Breaker state and latency are kept in a health store shared by all workers on
+the host, so one worker's failures protect the others. The request path only
+reads it while a breaker is closed: it is written on state changes, and with
+each process's latency average at most once per AI_HEALTH_WRITE_INTERVAL.
+
+Traffic can be split between providers by weight: each request starts with a
+healthy weighted provider picked at random in proportion to its weight (e.g.
+most traffic to a cheap self-hosted model), and the others follow in order as
+fallbacks. The providers, their order and weights come from the provider
+registry (see services.provider_registry).
+
+Optionally, requests are hedged: if the primary provider has not produced a
+first token within its recent p95 time-to-first-token, the same request is sent
+to the next provider and whichever answers first wins.
+
+Simple queries (greetings, questions from the bundled FAQ) are answered by
+the local fallback without calling a remote provider when it is confident
+enough in its answer (see services.local_ai_service).
+
+Responses of remote providers are cached per model (see services.response_cache);
+replies of the local fallback are never cached.
+
+Calls to remote providers go through admission control (see services.admission):
+when a provider's concurrency or token budget is exhausted the call waits its
+turn, and if it cannot be admitted in time ProviderOverloaded is raised instead
+of falling back, so a load spike is smoothed rather than spread across providers.
+"""
+import asyncio
+import collections
+import contextvars
+import fcntl
+import json
+import logging
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from services.admission import UNLIMITED, Lease, ProviderOverloaded
+from utils.metrics import (
+    BREAKER_TRANSITIONS, PROVIDER_COST, PROVIDER_FALLBACKS, PROVIDER_LATENCY, PROVIDER_REQUESTS,
+    PROVIDER_TOKENS, PROVIDER_TTFT
+)
+from utils.tracing import start_span, trace_span
+
+logger = logging.getLogger(__name__)
+
+# Provider names, in default priority order
+PROVIDER_ORDER = [
+    name.strip() for name in os.environ.get("AI_PROVIDER_ORDER", "deepseek,openai,local").split(",")
+]
+
+# Circuit breaker settings
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("AI_BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_RECOVERY_SECONDS = float(os.environ.get("AI_BREAKER_RECOVERY_SECONDS", "30"))
+
+# Order healthy providers by observed latency instead of the configured priority
+LATENCY_AWARE_ORDERING = os.environ.get("AI_PROVIDER_LATENCY_AWARE", "0") == "1"
+LATENCY_EWMA_ALPHA = 0.2
+
+# Seconds between writes of a healthy provider's latency to the health store, per process
+HEALTH_WRITE_INTERVAL = float(os.environ.get("AI_HEALTH_WRITE_INTERVAL", "1"))
+
+# Confidence the local fallback needs to answer a query itself, without trying
+# the remote providers (above 1 to disable)
+LOCAL_ANSWER_THRESHOLD = float(os.environ.get("AI_LOCAL_ANSWER_THRESHOLD", "0.8"))
+
+# Health store: "file" (shared by the workers on this host) or "memory" (per process)
+HEALTH_STORE = os.environ.get("AI_HEALTH_STORE", "file")
+HEALTH_STORE_PATH = os.environ.get(
+    "AI_HEALTH_STORE_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "ai_provider_health.json")
+)
+
+# Hedged requests ("1" to enable). The hedge fires after the primary's p95
+# time-to-first-token, clamped to the min/max delay; the default delay is used
+# until enough samples have been collected.
+HEDGING_ENABLED = os.environ.get("AI_HEDGING_ENABLED", "0") == "1"
+HEDGE_MIN_DELAY = float(os.environ.get("AI_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MAX_DELAY = float(os.environ.get("AI_HEDGE_MAX_DELAY", "5"))
+HEDGE_DEFAULT_DELAY = float(os.environ.get("AI_HEDGE_DEFAULT_DELAY", "2"))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLE_SIZE = 200
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+def new_health_state() -> Dict[str, Any]:
+    """Get the health state of a provider that has not been used yet."""
+    return {
+        'state': STATE_CLOSED,
+        'failures': 0,
+        'opened_at': 0.0,
+        'probe_started_at': 0.0,
+        'latency': None,
+    }
+
+class MemoryHealthStore:
+    """Provider health kept in this process only."""
+
+    def __init__(self):
+        self.states: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Get a copy of the health state of every provider."""
+        with self.lock:
+            return {name: dict(state) for name, state in self.states.items()}
+
+    def update(self, provider: str, update: Callable[[Dict[str, Any]], Any]) -> Any:
+        """
+        Atomically read, modify and write the health state of a provider.
+
+        Args:
+            provider: The provider name
+            update: Function that mutates the state in place and returns a result
+
+        Returns:
+            The value returned by `update`
+        """
+        with self.lock:
+            state = self.states.setdefault(provider, new_health_state())
+            return update(state)
+
+class FileHealthStore:
+    """
+    Provider health kept in a small JSON file (on tmpfs when available) and
+    updated under an exclusive flock, so every worker on the host sees the
+    same breaker state.
+    """
+
+    def __init__(self, path: str = HEALTH_STORE_PATH, cache_seconds: float = 0.5):
+        """
+        Args:
+            path: Location of the shared state file
+            cache_seconds: How long snapshot() may serve a cached copy
+        """
+        self.path = path
+        self.cache_seconds = cache_seconds
+        self._cache: Optional[Dict[str, Dict[str, Any]]] = None
+        self._cache_time = 0.0
+
+    def _read(self, handle) -> Dict[str, Dict[str, Any]]:
+        handle.seek(0)
+        raw = handle.read()
+        try:
+            return json.loads(raw) if raw else {}
+        except ValueError:
+            logger.warning("Discarding corrupt provider health file %s", self.path)
+            return {}
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Get the health state of every provider, cached briefly."""
+        now = time.monotonic()
+        if self._cache is not None and now - self._cache_time < self.cache_seconds:
+            return self._cache
+
+        with open(self.path, 'a+') as handle:
+            fcntl.flock(handle, fcntl.LOCK_SH)
+            try:
+                states = self._read(handle)
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+        self._cache, self._cache_time = states, now
+        return states
+
+    def update(self, provider: str, update: Callable[[Dict[str, Any]], Any]) -> Any:
+        """
+        Atomically read, modify and write the health state of a provider.
+
+        Args:
+            provider: The provider name
+            update: Function that mutates the state in place and returns a result
+
+        Returns:
+            The value returned by `update`
+        """
+        with open(self.path, 'a+') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                states = self._read(handle)
+                state = states.setdefault(provider, new_health_state())
+                result = update(state)
+                handle.seek(0)
+                handle.truncate()
+                handle.write(json.dumps(states))
+                handle.flush()
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+        self._cache = None
+        return result
+
+def create_health_store(name: str = HEALTH_STORE):
+    """Create the provider health store by name ("file" or "memory")."""
+    if name == 'memory':
+        return MemoryHealthStore()
+    return FileHealthStore()
+
+class ProviderRouter:
+    """Route chat requests to the first healthy AI provider."""
+
+    def __init__(
+        self,
+        providers: Dict[str, Any],
+        order: Optional[List[str]] = None,
+        store=None,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        recovery_seconds: float = BREAKER_RECOVERY_SECONDS,
+        latency_aware: bool = LATENCY_AWARE_ORDERING,
+        hedging: bool = HEDGING_ENABLED,
+        cache=None,
+        admission=None,
+        count_tokens: Optional[Callable[[str], int]] = None,
+        weights: Optional[Dict[str, float]] = None,
+        local_answer_threshold: float = LOCAL_ANSWER_THRESHOLD,
+    ):
+        """
+        Initialize the router.
+
+        Args:
+            providers: Services by provider name, each with get_chat_response
+                       and stream_chat_response
+            order: Provider names in priority order (the last one is the
+                   fallback of last resort and is always tried)
+            store: Health store shared by the workers
+            failure_threshold: Consecutive failures that open a breaker
+            recovery_seconds: Time an open breaker waits before a probe
+            latency_aware: Order healthy providers by observed latency
+            hedging: Race a second provider when the first one is slow
+            cache: Optional ResponseCache for remote provider responses
+            admission: Optional AdmissionController for remote provider calls
+            count_tokens: Counts the tokens of a text, for the token metrics
+                          (defaults to 4 characters per token)
+            weights: Traffic weights by provider name; a request is first sent
+                     to a healthy weighted provider picked in proportion to
+                     its weight
+            local_answer_threshold: Confidence the local fallback needs to
+                                    answer a query without the remote providers
+        """
+        self.providers = providers
+        self.order = [name for name in (order or PROVIDER_ORDER) if name in providers]
+        self.store = store or create_health_store()
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.latency_aware = latency_aware
+        self.hedging = hedging
+        self.cache = cache
+        self.admission = admission
+        self.count_tokens = count_tokens or (lambda text: len(text) // 4)
+        self.weights = {name: weight for name, weight in (weights or {}).items() if weight > 0}
+        self.local_answer_threshold = local_answer_threshold
+        # Recent time-to-first-token samples of this process, for hedge deadlines
+        self.latency_samples: Dict[str, collections.deque] = collections.defaultdict(
+            lambda: collections.deque(maxlen=LATENCY_SAMPLE_SIZE)
+        )
+        # Latencies of this process not yet folded into the store, as [sum, count]
+        self.pending_latency: Dict[str, List[float]] = collections.defaultdict(lambda: [0.0, 0])
+        self.latency_written_at: Dict[str, float] = {}
+        self.latency_lock = threading.Lock()
+
+    def is_configured(self, name: str) -> bool:
+        """Check whether a provider has the credentials it needs."""
+        service = self.providers[name]
+        if hasattr(service, 'is_configured'):
+            return service.is_configured()
+        return not hasattr(service, 'api_key') or bool(service.api_key)
+
+    def candidates(self) -> List[str]:
+        """
+        Get the providers worth trying, in the order they should be tried.
+
+        Providers with an open breaker are listed only once their recovery
+        period has passed; whether they actually get the probe is decided
+        atomically by try_acquire.
+        """
+        states = self.store.snapshot()
+        now = time.time()
+        fallback = self.order[-1] if self.order else None
+
+        names = []
+        for name in self.order:
+            if name != fallback and not self.is_configured(name):
+                continue
+            state = states.get(name) or new_health_state()
+            if name == fallback or state['state'] == STATE_CLOSED or (
+                now - max(state['opened_at'], state['probe_started_at']) >= self.recovery_seconds
+            ):
+                names.append(name)
+
+        if self.latency_aware:
+            remote = [name for name in names if name != fallback]
+            remote.sort(key=lambda name: (states.get(name) or {}).get('latency') or 0.0)
+            names = remote + [name for name in names if name == fallback]
+
+        weighted = [name for name in names if name in self.weights and name != fallback]
+        if weighted:
+            first = random.choices(weighted, weights=[self.weights[name] for name in weighted])[0]
+            names.remove(first)
+            names.insert(0, first)
+        return names
+
+    def preferred_provider(self) -> str:
+        """Get the provider the next request will most likely be served by."""
+        candidates = self.candidates()
+        return candidates[0] if candidates else self.order[-1]
+
+    def try_acquire(self, name: str) -> bool:
+        """
+        Check whether a request may be sent to a provider. When a breaker's
+        recovery period is over, exactly one caller across all workers is
+        allowed through as the half-open probe. A closed breaker is read from
+        the snapshot, without locking the store.
+        """
+        if name == self.order[-1]:
+            return True
+        state = self.store.snapshot().get(name)
+        if state is None or state['state'] == STATE_CLOSED:
+            return True
+
+        def acquire(state: Dict[str, Any]) -> bool:
+            now = time.time()
+            if state['state'] == STATE_CLOSED:
+                return True
+            if state['state'] == STATE_OPEN and now - state['opened_at'] >= self.recovery_seconds:
+                state['state'] = STATE_HALF_OPEN
+                state['probe_started_at'] = now
+                logger.info("Circuit for %s is half-open, sending a probe request", name)
+                BREAKER_TRANSITIONS.labels(provider=name, state=STATE_HALF_OPEN).inc()
+                return True
+            if state['state'] == STATE_HALF_OPEN and now - state['probe_started_at'] >= self.recovery_seconds:
+                # The previous probe never reported back; let another one through
+                state['probe_started_at'] = now
+                return True
+            return False
+
+        return self.store.update(name, acquire)
+
+    def _cache_model(self, name: str) -> Optional[str]:
+        """Get the model name used in cache keys, or None if the provider is not cached."""
+        if self.cache is None or name == self.order[-1]:
+            return None
+        return getattr(self.providers[name], 'model', name)
+
+    def get_cached_response(self, name: str, messages: List[Dict[str, Any]]) -> Optional[str]:
+        """Look up a cached response of a provider for the messages."""
+        model = self._cache_model(name)
+        if model is None:
+            return None
+        response = self.cache.get(model, messages)
+        if response is not None:
+            logger.info("Serving cached %s response", name)
+            PROVIDER_REQUESTS.labels(provider=name, outcome='cached').inc()
+        return response
+
+    def cache_response(self, name: str, messages: List[Dict[str, Any]], response: str) -> None:
+        """Cache a provider's response for the messages."""
+        model = self._cache_model(name)
+        if model is not None and response:
+            self.cache.set(model, messages, response)
+
+    def complete(self, name: str, messages: List[Dict[str, Any]], response: str, started: float) -> None:
+        """
+        Record a finished provider response: its total latency, estimated
+        tokens and cost, then cache it.
+
+        Args:
+            name: The provider that produced the response
+            messages: Messages formatted for the AI APIs
+            response: The response text
+            started: When the request was sent (time.monotonic)
+        """
+        PROVIDER_LATENCY.labels(provider=name).observe(time.monotonic() - started)
+        PROVIDER_REQUESTS.labels(provider=name, outcome='success').inc()
+        prompt_tokens = sum(self.count_tokens(message['content']) for message in messages)
+        completion_tokens = self.count_tokens(response)
+        PROVIDER_TOKENS.labels(provider=name, kind='prompt').inc(prompt_tokens)
+        PROVIDER_TOKENS.labels(provider=name, kind='completion').inc(completion_tokens)
+        service = self.providers[name]
+        cost = (
+            prompt_tokens * getattr(service, 'cost_per_1k_prompt', 0.0)
+            + completion_tokens * getattr(service, 'cost_per_1k_completion', 0.0)
+        ) / 1000
+        if cost:
+            PROVIDER_COST.labels(provider=name).inc(cost)
+        self.cache_response(name, messages, response)
+
+    def answer_locally(self, messages: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        Answer a simple query with the local fallback, if it is confident enough.
+
+        Args:
+            messages: Messages formatted for the AI APIs
+
+        Returns:
+            The local answer, or None if the query should go to the providers
+        """
+        if not self.order or self.local_answer_threshold > 1:
+            return None
+        name = self.order[-1]
+        local_answer = getattr(self.providers[name], 'local_answer', None)
+        if local_answer is None:
+            return None
+        with trace_span('ai.local_answer'):
+            match = local_answer(messages)
+        if match is None or match.confidence < self.local_answer_threshold:
+            return None
+        logger.info("Answering locally (%.2f confidence)", match.confidence)
+        PROVIDER_REQUESTS.labels(provider=name, outcome='answered').inc()
+        return match.answer
+
+    def record_fallback(self, first: Optional[str], name: str) -> None:
+        """Count a request served by another provider than the first one tried (hedges included)."""
+        if first is not None and first != name:
+            PROVIDER_FALLBACKS.labels(from_provider=first, to_provider=name).inc()
+
+    def admit(self, name: str, messages: List[Dict[str, Any]]) -> Lease:
+        """
+        Wait for a provider to admit a call. The local fallback is not limited.
+
+        Raises:
+            ProviderOverloaded: If the call cannot be admitted in time
+        """
+        if self.admission is None or name == self.order[-1]:
+            return UNLIMITED
+        try:
+            return self.admission.acquire(name, messages)
+        except ProviderOverloaded:
+            PROVIDER_REQUESTS.labels(provider=name, outcome='overloaded').inc()
+            raise
+
+    async def aadmit(self, name: str, messages: List[Dict[str, Any]]) -> Lease:
+        """Async version of admit."""
+        if self.admission is None or name == self.order[-1]:
+            return UNLIMITED
+        try:
+            return await self.admission.aacquire(name, messages)
+        except ProviderOverloaded:
+            PROVIDER_REQUESTS.labels(provider=name, outcome='overloaded').inc()
+            raise
+
+    def try_admit(self, name: str, messages: List[Dict[str, Any]]) -> Optional[Lease]:
+        """Admit a call only if it can start right away (for hedges, which are optional)."""
+        if self.admission is None or name == self.order[-1]:
+            return UNLIMITED
+        return self.admission.try_acquire(name, messages)
+
+    def hedge_delay(self, name: str) -> float:
+        """
+        Get how long to wait for a provider's first token before hedging.
+
+        Args:
+            name: The primary provider
+
+        Returns:
+            The p95 of its recent time-to-first-token, clamped to the
+            configured bounds
+        """
+        samples = sorted(self.latency_samples[name])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        p95 = samples[int(0.95 * (len(samples) - 1))]
+        return min(max(p95, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+    def record_success(self, name: str, latency: float, streamed: bool = False) -> None:
+        """
+        Close the provider's breaker and fold the latency into its average.
+        The store is only written when the breaker was not closed and clean,
+        or when this process last wrote the provider's latency
+        HEALTH_WRITE_INTERVAL ago.
+
+        Args:
+            name: The provider
+            latency: Time to the first token of a stream, or to the whole response
+            streamed: Whether the latency is a time to first token
+        """
+        self.latency_samples[name].append(latency)
+        if streamed:
+            PROVIDER_TTFT.labels(provider=name).observe(latency)
+
+        now = time.monotonic()
+        with self.latency_lock:
+            pending = self.pending_latency[name]
+            pending[0] += latency
+            pending[1] += 1
+            state = self.store.snapshot().get(name)
+            if (
+                state is not None and state['state'] == STATE_CLOSED and not state['failures']
+                and now - self.latency_written_at.get(name, 0.0) < HEALTH_WRITE_INTERVAL
+            ):
+                return
+            average = pending[0] / pending[1]
+            self.pending_latency[name] = [0.0, 0]
+            self.latency_written_at[name] = now
+
+        def succeed(state: Dict[str, Any]) -> None:
+            if state['state'] != STATE_CLOSED:
+                logger.info("Circuit for %s closed, provider recovered", name)
+                BREAKER_TRANSITIONS.labels(provider=name, state=STATE_CLOSED).inc()
+            state['state'] = STATE_CLOSED
+            state['failures'] = 0
+            previous = state['latency']
+            state['latency'] = average if previous is None else (
+                LATENCY_EWMA_ALPHA * average + (1 - LATENCY_EWMA_ALPHA) * previous
+            )
+
+        self.store.update(name, succeed)
+
+    def record_failure(self, name: str, error: Exception) -> None:
+        """Count a failure and open the provider's breaker past the threshold."""
+        PROVIDER_REQUESTS.labels(provider=name, outcome='error').inc()
+
+        def fail(state: Dict[str, Any]) -> None:
+            state['failures'] += 1
+            if state['state'] == STATE_HALF_OPEN or state['failures'] >= self.failure_threshold:
+                if state['state'] != STATE_OPEN:
+                    logger.warning("Circuit for %s opened after %s failures: %s", name, state['failures'], error)
+                    BREAKER_TRANSITIONS.labels(provider=name, state=STATE_OPEN).inc()
+                state['state'] = STATE_OPEN
+                state['opened_at'] = time.time()
+
+        self.store.update(name, fail)
+
+    def get_chat_response(self, messages: List[Dict[str, Any]], use_cache: bool = True) -> Tuple[str, str]:
+        """
+        Get a response from the first healthy provider, falling back in order.
+
+        Args:
+            messages: Messages formatted for the AI APIs
+            use_cache: Whether a cached (or local) response may be served
+
+        Returns:
+            A tuple with the response text and the name of the provider that served it
+
+        Raises:
+            ProviderOverloaded: If the selected provider cannot admit the call in time
+            Exception: The last provider error if every provider failed
+        """
+        local = self.answer_locally(messages) if use_cache else None
+        if local is not None:
+            return local, self.order[-1]
+
+        if self.hedging:
+            # Hedging races on the first token, so use the streaming API
+            name, stream = self.open_stream(messages, use_cache, answer_locally=False)
+            return ''.join(stream), name
+
+        last_error: Optional[Exception] = None
+        first: Optional[str] = None
+
+        for name in self.candidates():
+            cached = self.get_cached_response(name, messages) if use_cache else None
+            if cached is not None:
+                return cached, name
+
+            # The breaker is checked first, so that a call never waits for
+            # admission to a provider it is not going to be sent to
+            if not self.try_acquire(name):
+                continue
+
+            with self.admit(name, messages):
+                logger.info("Using %s AI service", name)
+                first = first or name
+                started = time.monotonic()
+                try:
+                    with trace_span('ai.request', provider=name):
+                        response = self.providers[name].get_chat_response(messages)
+                except Exception as e:
+                    logger.warning("%s AI service failed: %s", name, e)
+                    self.record_failure(name, e)
+                    last_error = e
+                    continue
+
+            self.record_success(name, time.monotonic() - started)
+            self.complete(name, messages, response, started)
+            self.record_fallback(first, name)
+            return response, name
+
+        raise last_error or Exception("No AI provider available")
+
+    def open_stream(
+        self, messages: List[Dict[str, Any]], use_cache: bool = True, answer_locally: bool = True
+    ) -> Tuple[str, Iterator[str]]:
+        """
+        Open a streamed response from the first healthy provider. Providers
+        that fail before producing any output are skipped; failures after the
+        first chunk are reported to the caller.
+
+        Args:
+            messages: Messages formatted for the AI APIs
+            use_cache: Whether a cached (or local) response may be served
+            answer_locally: Whether simple queries may be answered locally
+
+        Returns:
+            A tuple with the provider name and an iterator over text deltas
+
+        Raises:
+            ProviderOverloaded: If the selected provider cannot admit the call in time
+            Exception: The last provider error if every provider failed
+        """
+        local = self.answer_locally(messages) if use_cache and answer_locally else None
+        if local is not None:
+            return self.order[-1], iter([local])
+
+        last_error: Optional[Exception] = None
+        candidates = self.candidates()
+        fallback = self.order[-1]
+        raced: List[str] = []
+        first: Optional[str] = None
+
+        for index, name in enumerate(candidates):
+            if name in raced:
+                continue
+
+            cached = self.get_cached_response(name, messages) if use_cache else None
+            if cached is not None:
+                return name, iter([cached])
+
+            if not self.try_acquire(name):
+                continue
+            lease = self.admit(name, messages)
+            first = first or name
+
+            # Hedge only between remote providers; the local fallback answers instantly
+            alternate = next((other for other in candidates[index + 1:] if other != fallback), None)
+            if self.hedging and name != fallback and alternate is not None:
+                winner, stream, error, launched = self._race(name, alternate, messages, lease)
+                if winner is not None:
+                    self.record_fallback(first, winner)
+                    return winner, stream
+                last_error = error
+                # An alternate that could not be admitted is still tried on its own
+                raced.extend(launched)
+                continue
+
+            logger.info("Streaming from %s AI service", name)
+            started = time.monotonic()
+            try:
+                with trace_span('ai.first_token', provider=name):
+                    stream = self.providers[name].stream_chat_response(messages)
+                    first_chunk = next(stream, None)
+            except Exception as e:
+                logger.warning("%s AI service failed: %s", name, e)
+                lease.release()
+                self.record_failure(name, e)
+                last_error = e
+                continue
+
+            # Latency is measured to the first token, which is what users wait on
+            self.record_success(name, time.monotonic() - started, streamed=True)
+            self.record_fallback(first, name)
+            return name, self._continue_stream(name, first_chunk, stream, messages, lease, started)
+
+        raise last_error or Exception("No AI provider available")
+
+    def _race(
+        self, primary: str, alternate: str, messages: List[Dict[str, Any]], lease: Lease
+    ) -> Tuple[Optional[str], Optional[Iterator[str]], Optional[Exception], List[str]]:
+        """
+        Stream from the primary provider and, if it has not produced a first
+        token by its hedge deadline (or failed), from the alternate as well.
+        The first stream to produce a token wins; the other one is closed as
+        soon as its own first token or error arrives. The hedge is only sent
+        if the alternate can admit it right away.
+
+        Returns:
+            A tuple with the winning provider and its stream, or (None, None,
+            last error) if every raced provider failed, and the providers
+            that were called
+        """
+        results: "queue.Queue[Tuple[str, Optional[Iterator[str]], Optional[Exception]]]" = queue.Queue()
+        claim = threading.Lock()
+        winner: List[str] = []
+
+        def attempt(name: str, lease: Lease) -> None:
+            started = time.monotonic()
+            try:
+                with trace_span('ai.first_token', provider=name):
+                    stream = self.providers[name].stream_chat_response(messages)
+                    first_chunk = next(stream, None)
+            except Exception as e:
+                logger.warning("%s AI service failed: %s", name, e)
+                lease.release()
+                self.record_failure(name, e)
+                results.put((name, None, e))
+                return
+
+            # A late loser still reports its latency so the p95 sees the stalls
+            self.record_success(name, time.monotonic() - started, streamed=True)
+            with claim:
+                won = not winner
+                if won:
+                    winner.append(name)
+            if won:
+                results.put((name, self._continue_stream(name, first_chunk, stream, messages, lease, started), None))
+            else:
+                logger.info("Cancelling hedged request to %s", name)
+                stream.close()
+                lease.release()
+
+        def launch(name: str, lease: Lease) -> None:
+            # The thread joins the caller's trace
+            context = contextvars.copy_context()
+            threading.Thread(
+                target=context.run, args=(attempt, name, lease), name=f"hedge-{name}", daemon=True
+            ).start()
+
+        logger.info("Streaming from %s AI service", primary)
+        launch(primary, lease)
+        launched = [primary]
+        try:
+            outcome = results.get(timeout=self.hedge_delay(primary))
+        except queue.Empty:
+            outcome = None
+
+        # Primary stalled or failed: fire the hedge
+        if outcome is None or outcome[2] is not None:
+            alternate_lease = self.try_admit(alternate, messages)
+            if alternate_lease is not None and self.try_acquire(alternate):
+                logger.info("%s has no first token yet, hedging with %s", primary, alternate)
+                launch(alternate, alternate_lease)
+                launched.append(alternate)
+            elif alternate_lease is not None:
+                alternate_lease.release()
+
+        last_error: Optional[Exception] = None
+        pending = len(launched)
+        while True:
+            if outcome is not None:
+                pending -= 1
+                name, stream, error = outcome
+                if error is None:
+                    return name, stream, None, launched
+                last_error = error
+            if pending == 0:
+                return None, None, last_error, launched
+            outcome = results.get()
+
+    def _continue_stream(
+        self, name: str, first_chunk: Optional[str], stream: Iterator[str], messages: List[Dict[str, Any]],
+        lease: Lease, started: float
+    ) -> Iterator[str]:
+        """
+        Yield the rest of a stream, counting a mid-stream error as a failure
+        and recording and caching the response once it is complete. The
+        provider's admission slot is held until the stream ends or is closed.
+        """
+        chunks = []
+        span = start_span('ai.stream', provider=name)
+        try:
+            if first_chunk is not None:
+                chunks.append(first_chunk)
+                yield first_chunk
+            try:
+                for chunk in stream:
+                    chunks.append(chunk)
+                    yield chunk
+            except Exception as e:
+                self.record_failure(name, e)
+                if span is not None:
+                    span.end(e)
+                raise
+        finally:
+            lease.release()
+            if span is not None:
+                span.set_attribute('chunks', len(chunks))
+                span.end()
+        self.complete(name, messages, ''.join(chunks), started)
+
+    async def aget_chat_response(self, messages: List[Dict[str, Any]], use_cache: bool = True) -> Tuple[str, str]:
+        """
+        Async version of get_chat_response, for the ASGI entry point.
+
+        Args:
+            messages: Messages formatted for the AI APIs
+            use_cache: Whether a cached (or local) response may be served
+
+        Returns:
+            A tuple with the response text and the name of the provider that served it
+
+        Raises:
+            ProviderOverloaded: If the selected provider cannot admit the call in time
+            Exception: The last provider error if every provider failed
+        """
+        local = self.answer_locally(messages) if use_cache else None
+        if local is not None:
+            return local, self.order[-1]
+
+        if self.hedging:
+            name, stream = await self.aopen_stream(messages, use_cache, answer_locally=False)
+            return ''.join([chunk async for chunk in stream]), name
+
+        last_error: Optional[Exception] = None
+        first: Optional[str] = None
+
+        for name in self.candidates():
+            cached = self.get_cached_response(name, messages) if use_cache else None
+            if cached is not None:
+                return cached, name
+
+            if not self.try_acquire(name):
+                continue
+
+            with await self.aadmit(name, messages):
+                logger.info("Using %s AI service", name)
+                first = first or name
+                started = time.monotonic()
+                try:
+                    with trace_span('ai.request', provider=name):
+                        response = await self.providers[name].aget_chat_response(messages)
+                except Exception as e:
+                    logger.warning("%s AI service failed: %s", name, e)
+                    self.record_failure(name, e)
+                    last_error = e
+                    continue
+
+            self.record_success(name, time.monotonic() - started)
+            self.complete(name, messages, response, started)
+            self.record_fallback(first, name)
+            return response, name
+
+        raise last_error or Exception("No AI provider available")
+
+    async def aopen_stream(
+        self, messages: List[Dict[str, Any]], use_cache: bool = True, answer_locally: bool = True
+    ) -> Tuple[str, AsyncIterator[str]]:
+        """
+        Async version of open_stream, for the ASGI entry point.
+
+        Args:
+            messages: Messages formatted for the AI APIs
+            use_cache: Whether a cached (or local) response may be served
+            answer_locally: Whether simple queries may be answered locally
+
+        Returns:
+            A tuple with the provider name and an async iterator over text deltas
+
+        Raises:
+            ProviderOverloaded: If the selected provider cannot admit the call in time
+            Exception: The last provider error if every provider failed
+        """
+        local = self.answer_locally(messages) if use_cache and answer_locally else None
+        if local is not None:
+            return self.order[-1], self._acontinue_stream(self.order[-1], local, None, messages)
+
+        last_error: Optional[Exception] = None
+        candidates = self.candidates()
+        fallback = self.order[-1]
+        raced: List[str] = []
+        first: Optional[str] = None
+
+        for index, name in enumerate(candidates):
+            if name in raced:
+                continue
+
+            cached = self.get_cached_response(name, messages) if use_cache else None
+            if cached is not None:
+                return name, self._acontinue_stream(name, cached, None, messages)
+
+            if not self.try_acquire(name):
+                continue
+            lease = await self.aadmit(name, messages)
+            first = first or name
+
+            alternate = next((other for other in candidates[index + 1:] if other != fallback), None)
+            if self.hedging and name != fallback and alternate is not None:
+                winner, stream, error, launched = await self._arace(name, alternate, messages, lease)
+                if winner is not None:
+                    self.record_fallback(first, winner)
+                    return winner, stream
+                last_error = error
+                raced.extend(launched)
+                continue
+
+            logger.info("Streaming from %s AI service", name)
+            try:
+                first_chunk, stream, started = await self._afirst_chunk(name, messages, lease)
+            except Exception as e:
+                last_error = e
+                continue
+            self.record_fallback(first, name)
+            return name, self._acontinue_stream(name, first_chunk, stream, messages, lease, started)
+
+        raise last_error or Exception("No AI provider available")
+
+    async def _afirst_chunk(
+        self, name: str, messages: List[Dict[str, Any]], lease: Lease
+    ) -> Tuple[Optional[str], AsyncIterator[str], float]:
+        """
+        Open a provider stream and wait for its first chunk, recording the
+        outcome. The lease is released if the call fails or is cancelled.
+
+        Returns:
+            A tuple with the first chunk, the stream and when it was opened
+        """
+        started = time.monotonic()
+        stream = self.providers[name].astream_chat_response(messages)
+        try:
+            with trace_span('ai.first_token', provider=name):
+                first_chunk = await stream.__anext__()
+        except StopAsyncIteration:
+            first_chunk = None
+        except asyncio.CancelledError:
+            lease.release()
+            raise
+        except Exception as e:
+            logger.warning("%s AI service failed: %s", name, e)
+            lease.release()
+            self.record_failure(name, e)
+            raise
+
+        self.record_success(name, time.monotonic() - started, streamed=True)
+        return first_chunk, stream, started
+
+    async def _arace(
+        self, primary: str, alternate: str, messages: List[Dict[str, Any]], lease: Lease
+    ) -> Tuple[Optional[str], Optional[AsyncIterator[str]], Optional[Exception], List[str]]:
+        """
+        Async version of _race: the losing request is cancelled outright.
+
+        Returns:
+            A tuple with the winning provider and its stream, or (None, None,
+            last error) if every raced provider failed, and the providers
+            that were called
+        """
+        logger.info("Streaming from %s AI service", primary)
+        tasks = {asyncio.ensure_future(self._afirst_chunk(primary, messages, lease)): primary}
+        leases = {primary: lease}
+        winner: Optional[asyncio.Future] = None
+
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=self.hedge_delay(primary))
+
+            primary_failed = bool(done) and next(iter(done)).exception() is not None
+            if not done or primary_failed:
+                alternate_lease = self.try_admit(alternate, messages)
+                if alternate_lease is not None and self.try_acquire(alternate):
+                    logger.info("%s has no first token yet, hedging with %s", primary, alternate)
+                    leases[alternate] = alternate_lease
+                    tasks[asyncio.ensure_future(self._afirst_chunk(alternate, messages, alternate_lease))] = alternate
+                elif alternate_lease is not None:
+                    alternate_lease.release()
+
+            last_error: Optional[Exception] = None
+            pending = {task for task in tasks if not task.done()}
+            finished = [task for task in tasks if task.done()]
+
+            while True:
+                for task in finished:
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        continue
+                    winner = task
+                    name = tasks[task]
+                    first_chunk, stream, started = task.result()
+                    return (
+                        name, self._acontinue_stream(name, first_chunk, stream, messages, leases[name], started), None,
+                        list(leases)
+                    )
+                if not pending:
+                    return None, None, last_error, list(leases)
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                finished = list(done)
+        finally:
+            # Stop the losers, and every request if the caller was cancelled while waiting
+            opened = []
+            for task, name in tasks.items():
+                if task is winner:
+                    continue
+                if not task.done():
+                    logger.info("Cancelling hedged request to %s", name)
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    # A loser that produced its first token in the same instant
+                    opened.append(task.result()[1])
+                leases[name].release()
+            for stream in opened:
+                await stream.aclose()
+
+    async def _acontinue_stream(
+        self, name: str, first_chunk: Optional[str], stream: Optional[AsyncIterator[str]],
+        messages: List[Dict[str, Any]], lease: Lease = UNLIMITED, started: float = 0.0
+    ) -> AsyncIterator[str]:
+        """Async version of _continue_stream (a None stream yields only the first chunk)."""
+        chunks = []
+        try:
+            if first_chunk is not None:
+                chunks.append(first_chunk)
+                yield first_chunk
+            if stream is None:
+                return
+            span = start_span('ai.stream', provider=name)
+            try:
+                async for chunk in stream:
+                    chunks.append(chunk)
+                    yield chunk
+            except Exception as e:
+                self.record_failure(name, e)
+                if span is not None:
+                    span.end(e)
+                raise
+            finally:
+                if span is not None:
+                    span.set_attribute('chunks', len(chunks))
+                    span.end()
+        finally:
+            lease.release()
+        self.complete(name, messages, ''.join(chunks), started)
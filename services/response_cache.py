@@ -0,0 +1,186 @@
+"""
+Cache of AI responses for repeated prompts.
+
+Many conversations open with the same message ("hi", "what can you do?") and
+the same system prompt, so the reply can be served from a cache instead of the
+provider. Entries are keyed on a hash of the model and the normalized message
+list, kept in a per-process LRU with a TTL, and optionally shared between
+workers through Redis.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from utils.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# Response caching ("1" to enable), entry lifetime and per-process capacity
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+
+# Shared tier: Redis URL, empty to keep the cache in memory only
+RESPONSE_CACHE_REDIS_URL = os.environ.get("RESPONSE_CACHE_REDIS_URL", "")
+
+# Characters ignored at the end of a message ("Hi!" and "hi" share an entry)
+TRAILING_PUNCTUATION = " \t\n.!?;,"
+
+def normalize_content(content: str) -> str:
+    """Normalize message text so near-identical prompts share a cache key."""
+    text = unicodedata.normalize("NFKC", content).casefold()
+    return " ".join(text.split()).rstrip(TRAILING_PUNCTUATION)
+
+def make_cache_key(model: str, messages: List[Dict[str, Any]]) -> str:
+    """
+    Build the cache key for a request.
+
+    Args:
+        model: The model the request is sent to
+        messages: Messages formatted for the AI APIs
+
+    Returns:
+        A hex digest of the model and the normalized messages
+    """
+    normalized = [[message["role"], normalize_content(message["content"])] for message in messages]
+    payload = json.dumps([model, normalized], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class MemoryCache:
+    """Process-local LRU cache with a TTL per entry."""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get a cached value, or None if it is missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: int) -> None:
+        """Store a value, evicting the least recently used entry when full."""
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        """Remove an entry if present."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+class RedisCache:
+    """Cache tier shared by all workers, stored in Redis with native expiry."""
+
+    def __init__(self, client=None, url: str = RESPONSE_CACHE_REDIS_URL, prefix: str = 'aicache:'):
+        """
+        Args:
+            client: A redis-py compatible client; created from `url` if omitted
+            url: Redis connection URL
+            prefix: Prefix for the cache keys
+        """
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[str]:
+        """Get a cached value, or None if it is missing."""
+        value = self.client.get(self.prefix + key)
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        """Store a value with a TTL."""
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def delete(self, key: str) -> None:
+        """Remove an entry if present."""
+        self.client.delete(self.prefix + key)
+
+class ResponseCache:
+    """Two-tier response cache: process memory first, then the shared tier."""
+
+    def __init__(self, memory: Optional[MemoryCache] = None, shared=None, ttl: int = RESPONSE_CACHE_TTL):
+        """
+        Args:
+            memory: The in-process tier
+            shared: Optional tier shared by the workers (e.g. RedisCache)
+            ttl: Lifetime of an entry in seconds
+        """
+        self.memory = memory or MemoryCache()
+        self.shared = shared
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model: str, messages: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        Look up the cached response for a request.
+
+        Args:
+            model: The model the request would be sent to
+            messages: Messages formatted for the AI APIs
+
+        Returns:
+            The cached response text, or None on a miss
+        """
+        key = make_cache_key(model, messages)
+        value = self.memory.get(key)
+
+        if value is None and self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                logger.warning("Shared response cache unavailable: %s", e)
+            if value is not None:
+                self.memory.set(key, value, self.ttl)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        CACHE_REQUESTS.labels(cache='response', result='miss' if value is None else 'hit').inc()
+        return value
+
+    def set(self, model: str, messages: List[Dict[str, Any]], response: str) -> None:
+        """
+        Store the response for a request in both tiers.
+
+        Args:
+            model: The model that produced the response
+            messages: Messages formatted for the AI APIs
+            response: The response text
+        """
+        key = make_cache_key(model, messages)
+        self.memory.set(key, response, self.ttl)
+
+        if self.shared is not None:
+            try:
+                self.shared.set(key, response, self.ttl)
+            except Exception as e:
+                logger.warning("Shared response cache unavailable: %s", e)
+
+def create_response_cache() -> Optional[ResponseCache]:
+    """Create the response cache from the environment, or None if disabled."""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    shared = RedisCache() if RESPONSE_CACHE_REDIS_URL else None
+    return ResponseCache(shared=shared)
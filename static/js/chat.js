@@ -19,6 +19,19 @@ document.addEventListener('DOMContentLoaded', function() {
     let countdownInterval;
     let rateLimitResetTime;
     
+    // History pagination: older messages are fetched when scrolled to the top
+    const loadOlderElement = document.getElementById('load-older');
+    let loadingOlder = false;
+    
+    if (loadOlderElement) {
+        loadOlderElement.querySelector('button').addEventListener('click', loadOlderMessages);
+    }
+    messagesContainer.addEventListener('scroll', function() {
+        if (messagesContainer.scrollTop < 50) {
+            loadOlderMessages();
+        }
+    });
+    
     // Auto-resize textarea as user types
     userInput.addEventListener('input', function() {
         this.style.height = 'auto';
@@ -54,54 +67,63 @@ document.addEventListener('DOMContentLoaded', function() {
         showTypingIndicator();
         
         try {
-            // Send message to server
-            const response = await fetch('/api/chat', {
+            // Send message to server and stream the reply as it is generated
+            const response = await fetch('/api/chat/stream', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json'
+                    'Content-Type': 'application/json',
+                    'Accept': 'text/event-stream'
                 },
                 body: JSON.stringify({ message: userMessage })
             });
             
-            // Get the response data
-            const data = await response.json();
-            
-            // Hide typing indicator
-            hideTypingIndicator();
-            
-            // Check for specific errors
-            if (response.status === 429 && data.error === 'rate_limit_exceeded') {
-                // User rate limit error
-                handleRateLimit(data.limit_info);
-                return;
-            } else if (data.error === 'openai_quota_exceeded') {
-                // API quota exceeded error
-                showErrorMessage('OpenAI API quota exceeded. Switching to an alternative AI model.');
-                return;
-            } else if (data.error === 'openai_rate_limited') {
-                // API rate limited error
-                showErrorMessage('OpenAI API is currently rate limited. Please try again in a few minutes.');
-                return;
-            } else if (data.error === 'openai_key_invalid') {
-                // API key invalid error
-                showErrorMessage('OpenAI API key is invalid. Switching to an alternative AI model.');
+            // Errors raised before the stream opens come back as JSON
+            const contentType = response.headers.get('Content-Type') || '';
+            if (!contentType.includes('text/event-stream')) {
+                const data = await response.json();
+                hideTypingIndicator();
+                
+                if (response.status === 429 && data.error === 'rate_limit_exceeded') {
+                    // User rate limit error
+                    handleRateLimit(data.limit_info);
+                } else if (!handleApiError(data)) {
+                    throw new Error('Failed to get response');
+                }
                 return;
-            } else if (!response.ok) {
-                throw new Error('Failed to get response');
             }
             
-            // Add AI response to chat
-            addMessageToChat('ai', data.response);
+            let aiContentElement = null;
+            let aiResponse = '';
             
-            // Update remaining messages counter
-            if (data.remaining_messages !== undefined) {
-                updateRemainingMessages(data.remaining_messages);
-            }
+            await readEventStream(response, function(event, data) {
+                if (event === 'delta') {
+                    // Render tokens as they arrive
+                    if (!aiContentElement) {
+                        hideTypingIndicator();
+                        aiContentElement = addMessageToChat('ai', '');
+                    }
+                    aiResponse += data.content;
+                    aiContentElement.innerHTML = escapeHtml(aiResponse);
+                    scrollToBottom();
+                } else if (event === 'done') {
+                    // Update remaining messages counter
+                    if (data.remaining_messages !== undefined) {
+                        updateRemainingMessages(data.remaining_messages);
+                    }
+                    
+                    // Check if AI model info is available and update UI
+                    if (data.ai_info) {
+                        updateAIModelInfo(data.ai_info);
+                    }
+                } else if (event === 'error') {
+                    hideTypingIndicator();
+                    if (!handleApiError(data)) {
+                        showErrorMessage('Sorry, I encountered an error. Please try again later.');
+                    }
+                }
+            });
             
-            // Check if AI model info is available and update UI
-            if (data.ai_info) {
-                updateAIModelInfo(data.ai_info);
-            }
+            hideTypingIndicator();
             
             // Scroll to bottom
             scrollToBottom();
@@ -115,6 +137,26 @@ document.addEventListener('DOMContentLoaded', function() {
             scrollToBottom();
         }
         
+        // Helper function to show a message for known API errors
+        function handleApiError(data) {
+            if (data.error === 'openai_quota_exceeded') {
+                // API quota exceeded error
+                showErrorMessage('OpenAI API quota exceeded. Switching to an alternative AI model.');
+            } else if (data.error === 'openai_rate_limited') {
+                // API rate limited error
+                showErrorMessage('OpenAI API is currently rate limited. Please try again in a few minutes.');
+            } else if (data.error === 'provider_overloaded') {
+                // AI service busy
+                showErrorMessage('The AI service is busy right now. Please try again in a few seconds.');
+            } else if (data.error === 'openai_key_invalid') {
+                // API key invalid error
+                showErrorMessage('OpenAI API key is invalid. Switching to an alternative AI model.');
+            } else {
+                return false;
+            }
+            return true;
+        }
+        
         // Helper function to show error message in chat
         function showErrorMessage(message) {
             // Add system message to chat
@@ -141,7 +183,8 @@ document.addEventListener('DOMContentLoaded', function() {
             const response = await fetch('/api/chat/clear', { method: 'POST' });
             
             if (response.ok) {
-                // Clear messages container
+                // Clear messages container; there is no older history left to load
+                messagesContainer.dataset.hasMore = 'false';
                 messagesContainer.innerHTML = `
                     <div class="empty-state text-center py-5">
                         <i class="fas fa-robot fa-4x mb-3 text-secondary"></i>
@@ -232,14 +275,43 @@ document.addEventListener('DOMContentLoaded', function() {
         remainingMessagesElement.textContent = count;
     }
     
-    // Helper function to add a message to the chat
-    function addMessageToChat(role, content) {
-        // Remove empty state if present
-        const emptyState = messagesContainer.querySelector('.empty-state');
-        if (emptyState) {
-            emptyState.remove();
-        }
+    // Read a Server-Sent Events response, calling onEvent(event, data) per event
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
         
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            
+            buffer += decoder.decode(value, { stream: true });
+            
+            // Events are separated by a blank line
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                
+                let event = 'message';
+                let data = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        event = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        data += line.slice(5).trim();
+                    }
+                });
+                
+                if (data) {
+                    onEvent(event, JSON.parse(data));
+                }
+            }
+        }
+    }
+    
+    // Helper function to build the element for a chat message
+    function createMessageElement(role, content) {
         const messageWrapper = document.createElement('div');
         messageWrapper.className = `message-wrapper ${role === 'user' ? 'user-message' : 'ai-message'}`;
         
@@ -252,7 +324,60 @@ document.addEventListener('DOMContentLoaded', function() {
             </div>
         `;
         
+        return messageWrapper;
+    }
+    
+    // Helper function to add a message to the chat; returns the content element
+    function addMessageToChat(role, content) {
+        // Remove empty state if present
+        const emptyState = messagesContainer.querySelector('.empty-state');
+        if (emptyState) {
+            emptyState.remove();
+        }
+        
+        const messageWrapper = createMessageElement(role, content);
         messagesContainer.appendChild(messageWrapper);
+        return messageWrapper.querySelector('.message-content');
+    }
+    
+    // Fetch the page of messages before the oldest one shown and prepend it
+    async function loadOlderMessages() {
+        if (loadingOlder || messagesContainer.dataset.hasMore !== 'true') return;
+        
+        const conversationId = messagesContainer.dataset.conversationId;
+        const oldestMessage = messagesContainer.querySelector('[data-message-id]');
+        if (!conversationId || !oldestMessage) return;
+        
+        loadingOlder = true;
+        try {
+            const response = await fetch(
+                `/api/conversations/${conversationId}/messages?before=${oldestMessage.dataset.messageId}`
+            );
+            if (!response.ok) {
+                throw new Error('Failed to load older messages');
+            }
+            const data = await response.json();
+            
+            // Keep the viewport anchored on the messages the user was reading
+            const previousHeight = messagesContainer.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            data.messages.forEach(message => {
+                const messageWrapper = createMessageElement(message.role, message.content);
+                messageWrapper.dataset.messageId = message.id;
+                fragment.appendChild(messageWrapper);
+            });
+            messagesContainer.insertBefore(fragment, oldestMessage);
+            messagesContainer.scrollTop += messagesContainer.scrollHeight - previousHeight;
+            
+            messagesContainer.dataset.hasMore = data.has_more ? 'true' : 'false';
+            if (!data.has_more && loadOlderElement) {
+                loadOlderElement.remove();
+            }
+        } catch (error) {
+            console.error('Error loading older messages:', error);
+        } finally {
+            loadingOlder = false;
+        }
     }
     
     // Helper function to escape HTML
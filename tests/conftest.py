@@ -0,0 +1,108 @@
+"""
+Shared fixtures: an app on a throwaway SQLite database, and an in-memory
+stand-in for Redis.
+"""
+import os
+import time
+
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+
+import pytest
+from flask import Flask
+
+from models import db
+
+class FakeRedis:
+    """
+    In-memory stand-in for the subset of redis-py the app uses: strings with
+    an expiry, INCR/DECR and pipelines. Values are returned as bytes, like
+    redis-py without decode_responses.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.expires_at = {}
+
+    def _expire(self, key):
+        if key in self.expires_at and self.expires_at[key] <= time.time():
+            del self.values[key]
+            del self.expires_at[key]
+
+    def get(self, key):
+        self._expire(key)
+        value = self.values.get(key)
+        return None if value is None else str(value).encode()
+
+    def set(self, key, value, ex=None, nx=False):
+        self._expire(key)
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        self.expires_at.pop(key, None)
+        if ex is not None:
+            self.expires_at[key] = time.time() + ex
+        return True
+
+    def incr(self, key, amount=1):
+        self._expire(key)
+        self.values[key] = int(self.values.get(key, 0)) + amount
+        return self.values[key]
+
+    def decr(self, key, amount=1):
+        return self.incr(key, -amount)
+
+    def pttl(self, key):
+        self._expire(key)
+        if key not in self.values:
+            return -2
+        if key not in self.expires_at:
+            return -1
+        return int((self.expires_at[key] - time.time()) * 1000)
+
+    def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            self._expire(key)
+            if key in self.values:
+                del self.values[key]
+                self.expires_at.pop(key, None)
+                deleted += 1
+        return deleted
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+class FakePipeline:
+    """Queues commands and runs them in order on execute(), like a MULTI/EXEC block."""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+@pytest.fixture
+def fake_redis():
+    return FakeRedis()
+
+@pytest.fixture
+def app(tmp_path):
+    """A minimal app with the models' tables on a fresh SQLite database."""
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'test.db'}"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
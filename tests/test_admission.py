@@ -0,0 +1,134 @@
+"""
+Tests for the provider limiters of services.admission.
+"""
+import threading
+import time
+
+import pytest
+
+from services import admission
+from services.admission import AdmissionController, ProviderLimiter, ProviderOverloaded
+
+class FakeTime:
+    """Stands in for the time module of services.admission, with a clock moved by hand."""
+
+    def __init__(self):
+        self.now = 1_000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(admission, 'time', fake)
+    return fake
+
+def queue_call(limiter, admitted, **options):
+    """Call acquire on a thread; the admitted lease is appended to `admitted` and released."""
+    queued = len(limiter.waiters)
+
+    def call():
+        with limiter.acquire(**options) as lease:
+            admitted.append(lease)
+
+    thread = threading.Thread(target=call, daemon=True)
+    thread.start()
+    while len(limiter.waiters) == queued:
+        time.sleep(0.001)
+    return thread
+
+def test_queued_calls_are_admitted_in_order(clock):
+    limiter = ProviderLimiter('openai', max_in_flight=1)
+    lease = limiter.acquire()
+    admitted = []
+    threads = [queue_call(limiter, admitted, tokens=tokens) for tokens in (1, 2, 3)]
+
+    lease.release()
+    for thread in threads:
+        thread.join(2)
+
+    assert [lease.tokens for lease in admitted] == [1, 2, 3]
+    assert limiter.in_flight == 0
+
+def test_a_full_queue_rejects_calls(clock):
+    limiter = ProviderLimiter('openai', max_in_flight=1, max_queue=1)
+    lease = limiter.acquire()
+    thread = queue_call(limiter, [])
+
+    with pytest.raises(ProviderOverloaded) as excinfo:
+        limiter.acquire()
+    assert excinfo.value.provider == 'openai'
+    assert excinfo.value.retry_after >= 1
+
+    lease.release()
+    thread.join(2)
+
+def test_a_call_that_would_miss_its_deadline_is_rejected_at_once(clock):
+    limiter = ProviderLimiter('openai', max_in_flight=1)
+    lease = limiter.acquire()
+    clock.now += 30
+    lease.release()
+    lease = limiter.acquire()
+
+    # One call ahead of it holding the slot for ~30 seconds, plus its own
+    with pytest.raises(ProviderOverloaded) as excinfo:
+        limiter.acquire(timeout=5)
+    assert excinfo.value.retry_after == 60
+    assert not limiter.waiters
+    lease.release()
+
+def test_a_queued_call_gives_up_at_its_deadline():
+    limiter = ProviderLimiter('openai', max_in_flight=1)
+    lease = limiter.acquire()
+
+    with pytest.raises(ProviderOverloaded):
+        limiter.acquire(timeout=0.05)
+
+    assert not limiter.waiters
+    lease.release()
+    assert limiter.try_acquire() is not None
+
+def test_the_token_budget_refills_over_time(clock):
+    limiter = ProviderLimiter('openai', tokens_per_minute=600)
+    limiter.try_acquire(600).release()
+    assert limiter.try_acquire(100) is None
+
+    clock.now += 10
+    assert limiter.try_acquire(100) is not None
+    assert limiter.try_acquire(1) is None
+
+    # The budget never grows past a minute's worth
+    clock.now += 3600
+    limiter._refill()
+    assert limiter.tokens == 600
+
+def test_a_call_larger_than_the_budget_waits_for_a_full_bucket(clock):
+    limiter = ProviderLimiter('openai', tokens_per_minute=600)
+    limiter.try_acquire(300).release()
+    assert limiter.try_acquire(1000) is None
+
+    clock.now += 30
+    assert limiter.try_acquire(1000) is not None
+
+def test_releasing_a_lease_twice_frees_one_slot(clock):
+    limiter = ProviderLimiter('openai', max_in_flight=2)
+    first = limiter.acquire()
+    limiter.acquire()
+
+    first.release()
+    first.release()
+
+    assert limiter.in_flight == 1
+
+def test_controller_reserves_the_completion_budget(clock):
+    controller = AdmissionController(
+        limits={'openai': {'tokens_per_minute': 1000}}, completion_tokens={'openai': 500}
+    )
+    messages = [{'role': 'user', 'content': 'x' * 400}]
+
+    lease = controller.try_acquire('openai', messages)
+
+    assert lease.tokens == 600
+    assert controller.limiter('openai').tokens == 400
+    assert controller.try_acquire('openai', messages) is None
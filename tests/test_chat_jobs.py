@@ -0,0 +1,154 @@
+"""
+Tests for the job queue of utils.chat_jobs.
+"""
+import json
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import db, ChatJob
+from utils import chat_jobs
+from utils.chat_jobs import (
+    JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, claim_chat_job, get_chat_job, run_chat_job
+)
+from utils.rate_limiter import create_rate_limiter
+
+TIER = {'limit': 3, 'window_seconds': 3600}
+
+@pytest.fixture
+def rate_limiter(monkeypatch):
+    rate_limiter = create_rate_limiter('memory')
+    monkeypatch.setattr(chat_jobs, 'get_rate_limiter', lambda: rate_limiter)
+    return rate_limiter
+
+def add_job(priority=0, max_attempts=3, status=JOB_QUEUED, **columns):
+    """Queue an anonymous job directly, as enqueue_chat_job would."""
+    payload = {
+        'user_message': 'hello',
+        'received_at': datetime.utcnow().isoformat(),
+        'messages': [{'role': 'user', 'content': 'hello'}],
+        'summary': None,
+        'remaining': 2,
+        'use_cache': True,
+        'rate_limit_key': 'ip:203.0.113.7',
+        'rate_limit_tier': TIER,
+    }
+    job = ChatJob(
+        status=status, priority=priority, payload=json.dumps(payload), max_attempts=max_attempts,
+        available_at=datetime.utcnow(), **columns
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+def answer(messages, use_cache):
+    return 'hi there', 'openai'
+
+def fail(messages, use_cache):
+    raise RuntimeError("AI_SERVICE_ERROR")
+
+def test_jobs_are_claimed_by_priority_then_age(app):
+    low = add_job(priority=0)
+    first_high = add_job(priority=10)
+    second_high = add_job(priority=10)
+
+    assert [claim_chat_job()['id'] for _ in range(3)] == [first_high, second_high, low]
+    assert claim_chat_job() is None
+
+def test_a_job_is_never_claimed_by_two_workers(app):
+    job_ids = [add_job() for _ in range(5)]
+    claimed = []
+
+    def worker():
+        with app.app_context():
+            while True:
+                job = claim_chat_job()
+                if job is None:
+                    break
+                claimed.append(job['id'])
+            db.session.remove()
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert sorted(claimed) == job_ids
+
+def test_an_expired_lease_is_claimed_again(app):
+    job_id = add_job()
+    job = claim_chat_job()
+    assert claim_chat_job() is None
+
+    ChatJob.query.filter_by(id=job_id).update({ChatJob.locked_until: datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+    retaken = claim_chat_job()
+
+    assert retaken['id'] == job_id
+    assert retaken['attempts'] == 2
+    # The worker that lost the lease cannot store its outcome
+    run_chat_job(job, answer)
+    assert get_chat_job(job_id).status == JOB_RUNNING
+    run_chat_job(retaken, answer)
+    assert get_chat_job(job_id).status == JOB_SUCCEEDED
+    assert get_chat_job(job_id).result == 'hi there'
+
+def test_failed_attempts_are_retried_with_backoff(app, rate_limiter):
+    job_id = add_job()
+
+    before = datetime.utcnow()
+    run_chat_job(claim_chat_job(), fail)
+    job = get_chat_job(job_id)
+    assert job.status == JOB_QUEUED
+    assert job.error == 'AI_SERVICE_ERROR'
+    first_backoff = job.available_at - before
+    assert timedelta(seconds=chat_jobs.CHAT_JOB_RETRY_BACKOFF) <= first_backoff
+    # Not runnable until the backoff has elapsed
+    assert claim_chat_job() is None
+
+    ChatJob.query.filter_by(id=job_id).update({ChatJob.available_at: datetime.utcnow()})
+    db.session.commit()
+    before = datetime.utcnow()
+    run_chat_job(claim_chat_job(), fail)
+    assert get_chat_job(job_id).available_at - before >= 2 * first_backoff - timedelta(seconds=1)
+
+def test_an_overloaded_provider_sets_the_backoff(app, rate_limiter):
+    job_id = add_job()
+
+    def overloaded(messages, use_cache):
+        error = Exception("PROVIDER_OVERLOADED")
+        error.retry_after = 30
+        raise error
+
+    before = datetime.utcnow()
+    run_chat_job(claim_chat_job(), overloaded)
+
+    assert get_chat_job(job_id).available_at - before >= timedelta(seconds=30)
+
+def test_the_message_is_refunded_when_the_job_finally_fails(app, rate_limiter):
+    for _ in range(TIER['limit']):
+        rate_limiter.consume('ip:203.0.113.7', TIER['limit'], TIER['window_seconds'])
+    job_id = add_job(max_attempts=2)
+
+    run_chat_job(claim_chat_job(), fail)
+    assert rate_limiter.peek('ip:203.0.113.7', TIER['limit'], TIER['window_seconds']).remaining == 0
+
+    ChatJob.query.filter_by(id=job_id).update({ChatJob.available_at: datetime.utcnow()})
+    db.session.commit()
+    run_chat_job(claim_chat_job(), fail)
+
+    job = get_chat_job(job_id)
+    assert job.status == JOB_FAILED
+    assert job.finished_at is not None
+    assert rate_limiter.peek('ip:203.0.113.7', TIER['limit'], TIER['window_seconds']).remaining == 1
+
+def test_finished_jobs_are_deleted_after_the_retention(app):
+    old = add_job(status=JOB_SUCCEEDED, finished_at=datetime.utcnow() - timedelta(hours=2))
+    recent = add_job(status=JOB_SUCCEEDED, finished_at=datetime.utcnow())
+    queued = add_job()
+
+    assert chat_jobs.delete_finished_jobs(retention=3600) == 1
+    assert [job.id for job in ChatJob.query.order_by(ChatJob.id)] == [recent, queued]
+    assert get_chat_job(old) is None
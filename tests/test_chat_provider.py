@@ -0,0 +1,39 @@
+"""
+Tests for the provider base class of services.chat_provider.
+"""
+import asyncio
+
+import pytest
+
+from services.chat_provider import SYSTEM_PROMPT, ChatProvider, format_messages_for_api
+
+class EchoProvider(ChatProvider):
+    """Answers with the last message."""
+
+    def get_chat_response(self, messages):
+        return messages[-1]['content']
+
+    async def aget_chat_response(self, messages):
+        return self.get_chat_response(messages)
+
+def test_a_provider_must_implement_the_responses():
+    class Incomplete(ChatProvider):
+        def get_chat_response(self, messages):
+            return ''
+
+    with pytest.raises(TypeError):
+        ChatProvider('base')
+    with pytest.raises(TypeError):
+        Incomplete('incomplete')
+
+def test_streams_default_to_the_whole_response():
+    provider = EchoProvider('echo')
+    messages = format_messages_for_api([{'role': 'user', 'content': 'hello', 'created_at': None}])
+
+    async def astream():
+        return [chunk async for chunk in provider.astream_chat_response(messages)]
+
+    assert messages == [{'role': 'system', 'content': SYSTEM_PROMPT}, {'role': 'user', 'content': 'hello'}]
+    assert list(provider.stream_chat_response(messages)) == ['hello']
+    assert asyncio.run(astream()) == ['hello']
+    assert provider.model == 'echo' and provider.display_name == 'echo'
@@ -0,0 +1,69 @@
+"""
+Tests for the paging and highlighting of utils.message_search.
+"""
+import pytest
+
+from models import db, Conversation, Message, User
+from utils import message_search
+from utils.message_search import (
+    HIGHLIGHT_END, HIGHLIGHT_START, MessageSearchBackend, decode_cursor, encode_cursor,
+    format_highlight, search_messages
+)
+
+class ListSearch(MessageSearchBackend):
+    """Ranks messages by how often they contain the query, without an index."""
+
+    def search(self, user_id, query, conversation_id, after, limit):
+        hits = sorted(
+            (
+                (message.id, float(message.content.count(query)))
+                for message in Message.query.filter_by(user_id=user_id)
+                if query in message.content
+            ),
+            key=lambda hit: (-hit[1], -hit[0])
+        )
+        if after is not None:
+            hits = [(id, rank) for id, rank in hits if (rank, id) < after]
+        return hits[:limit]
+
+    def highlight(self, query, message_ids):
+        return {
+            message.id: message.content.replace(query, f"{HIGHLIGHT_START}{query}{HIGHLIGHT_END}")
+            for message in Message.query.filter(Message.id.in_(message_ids))
+        }
+
+@pytest.fixture
+def messages(app, monkeypatch):
+    monkeypatch.setitem(message_search.SEARCH_BACKENDS, 'sqlite', ListSearch)
+    db.session.add(User(id=1, username='alice', email='alice@example.com', password_hash='x'))
+    db.session.add(Conversation(id=1, user_id=1, title='Cooking'))
+    for content in ('pasta', 'pasta <b>pasta</b>', 'rice', 'pasta pasta pasta'):
+        db.session.add(Message(user_id=1, conversation_id=1, role='user', content=content))
+    db.session.commit()
+
+def test_a_backend_must_implement_search_and_highlight():
+    class SearchOnly(MessageSearchBackend):
+        def search(self, user_id, query, conversation_id, after, limit):
+            return []
+
+    with pytest.raises(TypeError):
+        SearchOnly()
+
+def test_results_are_paged_with_a_cursor(messages):
+    first_page, after = search_messages(1, 'pasta', limit=2)
+    second_page, last = search_messages(1, 'pasta', after=decode_cursor(encode_cursor(*after)), limit=2)
+
+    assert [result['content'] for result in first_page] == ['pasta pasta pasta', 'pasta <b>pasta</b>']
+    assert first_page[0]['conversation_title'] == 'Cooking'
+    assert [result['content'] for result in second_page] == ['pasta']
+    assert last is None
+
+def test_matches_are_highlighted_in_escaped_html(messages):
+    results, _ = search_messages(1, 'pasta')
+
+    assert results[1]['highlight'] == '<mark>pasta</mark> &lt;b&gt;<mark>pasta</mark>&lt;/b&gt;'
+    assert format_highlight(f"{HIGHLIGHT_START}<i>{HIGHLIGHT_END}") == '<mark>&lt;i&gt;</mark>'
+
+def test_malformed_cursors_are_rejected():
+    with pytest.raises(ValueError):
+        decode_cursor('nope')
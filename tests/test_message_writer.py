@@ -0,0 +1,172 @@
+"""
+Tests for the write-behind queue of utils.message_writer.
+"""
+import fcntl
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from models import db, Conversation, Message, User
+from utils import message_writer
+from utils.message_writer import MessageWriteBehind, make_chat_turn
+
+@pytest.fixture
+def conversation(app):
+    db.session.add(User(id=1, username='alice', email='alice@example.com', password_hash='x'))
+    db.session.add(Conversation(id=1, user_id=1))
+    db.session.commit()
+    return 1
+
+@pytest.fixture
+def writes(monkeypatch):
+    """Records the batches passed to write_chat_turns; a batch containing 'poison' fails."""
+    batches = []
+    write_chat_turns = message_writer.write_chat_turns
+
+    def record(turns):
+        batches.append([turn['messages'][0]['content'] for turn in turns])
+        if any(turn['messages'][0]['content'] == 'poison' for turn in turns):
+            raise ValueError("A string literal cannot contain NUL (0x00) characters.")
+        write_chat_turns(turns)
+
+    monkeypatch.setattr(message_writer, 'write_chat_turns', record)
+    return batches
+
+@pytest.fixture
+def writer(app, tmp_path):
+    writer = MessageWriteBehind(app, journal_dir=str(tmp_path))
+    yield writer
+    writer.close()
+
+def turn(content):
+    now = datetime.utcnow().isoformat()
+    return make_chat_turn(1, 1, [
+        {'role': 'user', 'content': content, 'created_at': now},
+        {'role': 'assistant', 'content': 'reply', 'created_at': now},
+    ])
+
+def journaled(journal_dir):
+    """The user messages of the turns in the journal segments, by file name."""
+    segments = {}
+    for name in sorted(os.listdir(journal_dir)):
+        if name.endswith('.jsonl'):
+            with open(os.path.join(journal_dir, name)) as f:
+                segments[name] = [json.loads(line)['messages'][0]['content'] for line in f]
+    return segments
+
+def user_messages():
+    return [message.content for message in Message.query.filter_by(role='user').order_by(Message.id)]
+
+def test_flush_writes_the_queue_in_one_transaction(writer, conversation, writes, tmp_path):
+    writer.submit(turn('first'))
+    writer.submit(turn('second'))
+
+    writer.flush()
+
+    assert writes == [['first', 'second']]
+    assert user_messages() == ['first', 'second']
+    # Only the fresh, empty segment is left
+    assert list(journaled(tmp_path).values()) == [[]]
+
+def test_failed_flush_keeps_the_turns_queued_and_journaled(writer, conversation, monkeypatch, tmp_path):
+    def fail(turns):
+        raise RuntimeError("database is down")
+
+    monkeypatch.setattr(message_writer, 'write_chat_turns', fail)
+    writer.submit(turn('first'))
+    writer.submit(turn('second'))
+
+    writer.flush()
+
+    assert [queued['messages'][0]['content'] for _, queued in writer.failed] == ['first', 'second']
+    assert sorted(sum(journaled(tmp_path).values(), [])) == ['first', 'second']
+    assert len(writer.sealed_segments) == 1
+
+    # Retried after a backoff, not on the next tick
+    monkeypatch.undo()
+    writer.flush()
+    assert user_messages() == []
+    writer.flush(force=True)
+    assert user_messages() == ['first', 'second']
+    assert writer.failed == [] and writer.sealed_segments == []
+    assert sum(journaled(tmp_path).values(), []) == []
+
+def test_a_turn_that_keeps_failing_is_dead_lettered(writer, conversation, writes, tmp_path):
+    for content in ('first', 'poison', 'second'):
+        writer.submit(turn(content))
+
+    for _ in range(message_writer.MESSAGE_FLUSH_MAX_ATTEMPTS):
+        writer.flush(force=True)
+
+    # Batches first, then one turn per transaction
+    assert writes[0] == ['first', 'poison', 'second']
+    assert ['first'] in writes and ['second'] in writes
+    assert user_messages() == ['first', 'second']
+    assert writer.failed == []
+    assert sum(journaled(tmp_path).values(), []) == []
+    with open(tmp_path / 'dead_letter' / f'{writer.owner}.jsonl') as f:
+        dead_letters = [json.loads(line) for line in f]
+    assert [record['turn']['messages'][0]['content'] for record in dead_letters] == ['poison']
+    assert 'NUL' in dead_letters[0]['error']
+
+    # Later turns are written normally
+    writer.submit(turn('third'))
+    writer.flush()
+    assert user_messages() == ['first', 'second', 'third']
+
+def test_submit_refuses_turns_when_the_queue_is_full(app, conversation, tmp_path, monkeypatch):
+    writer = MessageWriteBehind(app, journal_dir=str(tmp_path), max_queue_size=1)
+    assert writer.submit(turn('first'))
+    assert not writer.submit(turn('second'))
+
+    # submit_chat_turn then writes it synchronously
+    monkeypatch.setattr(message_writer, '_get_write_behind', lambda: writer)
+    message_writer.submit_chat_turn(turn('second'))
+    assert user_messages() == ['second']
+    writer.close()
+    assert user_messages() == ['second', 'first']
+
+def test_replay_skips_locked_segments_and_queues_orphaned_ones(app, writer, conversation, tmp_path):
+    live = MessageWriteBehind(app, journal_dir=str(tmp_path))
+    live.submit(turn('live'))
+    orphan = tmp_path / 'deadbeef.000000000.jsonl'
+    orphan.write_text(json.dumps(turn('orphaned')) + '\n{"torn')
+
+    writer.replay_orphaned_journals()
+
+    assert [queued['messages'][0]['content'] for queued in writer.queue] == ['orphaned']
+    assert not orphan.exists()
+    assert journaled(tmp_path)[os.path.basename(live.segment_path)] == ['live']
+    writer.flush()
+    assert user_messages() == ['orphaned']
+    live.close()
+    assert user_messages() == ['orphaned', 'live']
+
+def test_replay_skips_segments_locked_by_another_handle(writer, tmp_path):
+    path = tmp_path / 'deadbeef.000000000.jsonl'
+    path.write_text(json.dumps(turn('locked')) + '\n')
+    with open(path) as handle:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        writer.replay_orphaned_journals()
+
+    assert writer.queue == []
+    assert path.exists()
+
+def test_close_leaves_unwritten_turns_for_the_next_process(app, conversation, monkeypatch, tmp_path):
+    def fail(turns):
+        raise RuntimeError("database is down")
+
+    writer = MessageWriteBehind(app, journal_dir=str(tmp_path))
+    monkeypatch.setattr(message_writer, 'write_chat_turns', fail)
+    writer.submit(turn('unwritten'))
+    writer.close()
+    assert list(journaled(tmp_path).values()) == [['unwritten']]
+
+    monkeypatch.undo()
+    successor = MessageWriteBehind(app, journal_dir=str(tmp_path))
+    successor.replay_orphaned_journals()
+    successor.close()
+    assert user_messages() == ['unwritten']
+    assert sum(journaled(tmp_path).values(), []) == []
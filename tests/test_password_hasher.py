@@ -0,0 +1,80 @@
+"""
+Tests for the hashing slots of utils.password_hasher.
+"""
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from utils import password_hasher
+
+class BrokenPool:
+    """A pool whose processes have died: every hash fails with BrokenProcessPool."""
+
+    def __init__(self):
+        self.shut_down = False
+
+    def submit(self, function, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+        return future
+
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+def use_pool(monkeypatch, pool, max_pending=1):
+    """Make `pool` the hashing pool of this process, with `max_pending` slots."""
+    monkeypatch.setattr(password_hasher, 'PASSWORD_HASH_WORKERS', 1)
+    monkeypatch.setattr(password_hasher, 'PASSWORD_HASH_WAIT_SECONDS', 0.05)
+    monkeypatch.setattr(password_hasher, 'PASSWORD_HASH_TIMEOUT', 0.05)
+    monkeypatch.setattr(password_hasher, '_pool', pool)
+    monkeypatch.setattr(password_hasher, '_pool_pid', os.getpid())
+    monkeypatch.setattr(password_hasher, '_slots', threading.BoundedSemaphore(max_pending))
+
+def test_a_timed_out_hash_holds_its_slot_until_it_finishes(monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=1)
+    use_pool(monkeypatch, pool)
+    release = threading.Event()
+
+    with pytest.raises(FutureTimeoutError):
+        password_hasher._run(release.wait, 5)
+    # The hash is still running, so there is no slot for another one
+    with pytest.raises(Exception, match="PASSWORD_HASH_BUSY"):
+        password_hasher._run(len, 'password')
+
+    release.set()
+    pool.shutdown(wait=True)
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(password_hasher, '_pool', pool)
+    assert password_hasher._run(len, 'password') == 8
+    pool.shutdown()
+
+def test_a_queued_hash_that_timed_out_is_cancelled(monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=1)
+    use_pool(monkeypatch, pool, max_pending=2)
+    release = threading.Event()
+    pool.submit(release.wait, 5)
+    ran = []
+
+    with pytest.raises(FutureTimeoutError):
+        password_hasher._run(ran.append, 'queued')
+
+    release.set()
+    pool.shutdown(wait=True)
+    assert ran == []
+    # Both slots are free again
+    assert password_hasher._slots.acquire(blocking=False)
+    assert password_hasher._slots.acquire(blocking=False)
+
+def test_a_broken_pool_is_shut_down_and_replaced(monkeypatch):
+    pool = BrokenPool()
+    use_pool(monkeypatch, pool)
+
+    with pytest.raises(BrokenProcessPool):
+        password_hasher._run(len, 'password')
+
+    assert pool.shut_down
+    assert password_hasher._pool_pid is None
+    assert password_hasher._slots.acquire(blocking=False)
@@ -0,0 +1,312 @@
+"""
+Tests for the circuit breakers and routing of services.provider_router.
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from services import provider_router
+from services.admission import AdmissionController
+from services.provider_router import (
+    STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, MemoryHealthStore, ProviderRouter
+)
+
+MESSAGES = [{'role': 'user', 'content': 'hello'}]
+
+class StubProvider:
+    """A provider that answers with its name, or fails while `failing` is set."""
+
+    def __init__(self, name, failing=False):
+        self.name = name
+        self.failing = failing
+        self.calls = 0
+
+    def get_chat_response(self, messages):
+        self.calls += 1
+        if self.failing:
+            raise RuntimeError(f"{self.name} is down")
+        return f"{self.name} reply"
+
+    def stream_chat_response(self, messages):
+        self.calls += 1
+        if self.failing:
+            raise RuntimeError(f"{self.name} is down")
+        yield f"{self.name} reply"
+
+    async def aget_chat_response(self, messages):
+        return self.get_chat_response(messages)
+
+    async def astream_chat_response(self, messages):
+        for chunk in self.stream_chat_response(messages):
+            yield chunk
+
+class CountingStore(MemoryHealthStore):
+    """A MemoryHealthStore that counts its (locked) updates."""
+
+    def __init__(self):
+        super().__init__()
+        self.updates = 0
+
+    def update(self, provider, update):
+        self.updates += 1
+        return super().update(provider, update)
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controls time.time() for the breaker's recovery periods."""
+    now = [1_000_000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+@pytest.fixture
+def providers():
+    return {name: StubProvider(name) for name in ('primary', 'secondary', 'local')}
+
+def make_router(providers, **options):
+    options.setdefault('store', CountingStore())
+    options.setdefault('failure_threshold', 2)
+    options.setdefault('recovery_seconds', 30)
+    return ProviderRouter(providers, order=['primary', 'secondary', 'local'], **options)
+
+def state(router, name):
+    return router.store.snapshot().get(name, {}).get('state', STATE_CLOSED)
+
+def test_breaker_opens_after_the_failure_threshold(providers, clock):
+    router = make_router(providers)
+    providers['primary'].failing = True
+
+    assert router.get_chat_response(MESSAGES) == ('secondary reply', 'secondary')
+    assert state(router, 'primary') == STATE_CLOSED
+    assert router.get_chat_response(MESSAGES) == ('secondary reply', 'secondary')
+    assert state(router, 'primary') == STATE_OPEN
+
+    # An open breaker is skipped without calling the provider
+    router.get_chat_response(MESSAGES)
+    assert providers['primary'].calls == 2
+    assert router.candidates() == ['secondary', 'local']
+
+def test_success_resets_the_failure_count(providers, clock):
+    router = make_router(providers)
+    providers['primary'].failing = True
+    router.get_chat_response(MESSAGES)
+    providers['primary'].failing = False
+    router.get_chat_response(MESSAGES)
+    providers['primary'].failing = True
+    router.get_chat_response(MESSAGES)
+
+    assert state(router, 'primary') == STATE_CLOSED
+
+def test_exactly_one_half_open_probe(providers, clock):
+    router = make_router(providers)
+    for _ in range(2):
+        router.record_failure('primary', RuntimeError("down"))
+
+    assert not router.try_acquire('primary')
+    clock[0] += 30
+    assert router.candidates()[0] == 'primary'
+    assert router.try_acquire('primary')
+    assert state(router, 'primary') == STATE_HALF_OPEN
+    assert not router.try_acquire('primary')
+
+    # A probe that never reports back is replaced after another recovery period
+    clock[0] += 30
+    assert router.try_acquire('primary')
+
+def test_failed_probe_reopens_the_breaker(providers, clock):
+    router = make_router(providers)
+    for _ in range(2):
+        router.record_failure('primary', RuntimeError("down"))
+    clock[0] += 30
+    providers['primary'].failing = True
+
+    assert router.get_chat_response(MESSAGES) == ('secondary reply', 'secondary')
+    assert providers['primary'].calls == 1
+    assert state(router, 'primary') == STATE_OPEN
+    assert not router.try_acquire('primary')
+
+def test_successful_probe_closes_the_breaker(providers, clock):
+    router = make_router(providers)
+    for _ in range(2):
+        router.record_failure('primary', RuntimeError("down"))
+    clock[0] += 30
+
+    assert router.get_chat_response(MESSAGES) == ('primary reply', 'primary')
+    health = router.store.snapshot()['primary']
+    assert health['state'] == STATE_CLOSED
+    assert health['failures'] == 0
+
+def test_the_fallback_is_always_tried(providers, clock):
+    router = make_router(providers)
+    for name in ('primary', 'secondary', 'local'):
+        for _ in range(2):
+            router.record_failure(name, RuntimeError("down"))
+
+    assert router.candidates() == ['local']
+    assert router.try_acquire('local')
+    assert router.get_chat_response(MESSAGES) == ('local reply', 'local')
+
+def test_closed_breakers_do_not_write_the_store(providers, clock, monkeypatch):
+    monkeypatch.setattr(provider_router, 'HEALTH_WRITE_INTERVAL', 60)
+    router = make_router(providers)
+    router.get_chat_response(MESSAGES)
+    updates = router.store.updates
+
+    for _ in range(10):
+        router.get_chat_response(MESSAGES)
+
+    assert router.store.updates == updates
+    # A failure is still recorded, and the next success resets it
+    router.record_failure('primary', RuntimeError("down"))
+    router.get_chat_response(MESSAGES)
+    assert router.store.snapshot()['primary']['failures'] == 0
+
+def test_latency_is_written_at_most_once_per_interval(providers, monkeypatch):
+    monkeypatch.setattr(provider_router, 'HEALTH_WRITE_INTERVAL', 60)
+    router = make_router(providers)
+    router.record_success('primary', 1.0)
+    router.record_success('primary', 3.0)
+    assert router.store.snapshot()['primary']['latency'] == 1.0
+
+    # The samples since the last write are folded in as their average
+    monkeypatch.setattr(provider_router, 'HEALTH_WRITE_INTERVAL', 0)
+    router.record_success('primary', 5.0)
+    expected = provider_router.LATENCY_EWMA_ALPHA * 4.0 + (1 - provider_router.LATENCY_EWMA_ALPHA) * 1.0
+    assert router.store.snapshot()['primary']['latency'] == pytest.approx(expected)
+
+def test_latency_aware_ordering(providers, monkeypatch):
+    monkeypatch.setattr(provider_router, 'HEALTH_WRITE_INTERVAL', 0)
+    router = make_router(providers, latency_aware=True)
+    router.record_success('primary', 2.0)
+    router.record_success('secondary', 0.5)
+    router.record_success('local', 0.01)
+
+    # The fallback stays last however fast it is
+    assert router.candidates() == ['secondary', 'primary', 'local']
+
+    router.latency_aware = False
+    assert router.candidates() == ['primary', 'secondary', 'local']
+
+def test_a_breaker_is_checked_before_waiting_for_admission(providers, clock, monkeypatch):
+    admission = AdmissionController(limits={'primary': {'max_in_flight': 1, 'max_queue': 0}})
+    router = make_router(providers, admission=admission)
+    for _ in range(2):
+        router.record_failure('primary', RuntimeError("down"))
+    clock[0] += 30
+    # Another worker takes the probe right after primary was listed, and
+    # holds its only slot: admission would refuse the call
+    lease = admission.try_acquire('primary', MESSAGES)
+    candidates = router.candidates
+
+    def listed_then_probed():
+        names = candidates()
+        router.try_acquire('primary')
+        return names
+
+    monkeypatch.setattr(router, 'candidates', listed_then_probed)
+
+    assert router.get_chat_response(MESSAGES) == ('secondary reply', 'secondary')
+    assert router.open_stream(MESSAGES)[0] == 'secondary'
+    assert providers['primary'].calls == 0
+    lease.release()
+    assert admission.limiter('primary').in_flight == 0
+
+def test_weighted_providers_go_first(providers, clock, monkeypatch):
+    router = make_router(providers, weights={'primary': 1, 'secondary': 3, 'local': 5})
+    picks = []
+
+    def choices(names, weights):
+        picks.append(dict(zip(names, weights)))
+        return [names[-1]]
+
+    monkeypatch.setattr(provider_router.random, 'choices', choices)
+
+    # The fallback is never weighted, and keeps its place
+    assert router.candidates() == ['secondary', 'primary', 'local']
+    assert picks == [{'primary': 1, 'secondary': 3}]
+
+    # A weighted provider with an open breaker is not picked
+    for _ in range(2):
+        router.record_failure('secondary', RuntimeError("down"))
+    assert router.candidates() == ['primary', 'local']
+    assert picks[-1] == {'primary': 1}
+
+class SlowProvider(StubProvider):
+    """A provider whose first token only arrives once `release` is set."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.release = threading.Event()
+        self.closed = threading.Event()
+
+    def stream_chat_response(self, messages):
+        self.calls += 1
+        try:
+            self.release.wait(5)
+            yield f"{self.name} reply"
+            yield "more"
+        finally:
+            self.closed.set()
+
+def wait_for_release(admission, timeout=2):
+    """Wait until every admitted call has released its lease."""
+    deadline = time.monotonic() + timeout
+    while any(limiter.in_flight for limiter in admission.limiters.values()):
+        assert time.monotonic() < deadline, "a lease was not released"
+        time.sleep(0.01)
+
+def test_hedge_wins_and_the_slow_request_is_closed(providers):
+    providers['primary'] = SlowProvider('primary')
+    admission = AdmissionController()
+    router = make_router(providers, hedging=True, admission=admission)
+    router.hedge_delay = lambda name: 0.05
+
+    name, stream = router.open_stream(MESSAGES)
+
+    assert name == 'secondary'
+    assert list(stream) == ['secondary reply']
+    # The loser is closed as soon as its first token arrives
+    providers['primary'].release.set()
+    assert providers['primary'].closed.wait(2)
+    assert providers['primary'].calls == 1
+    # Both the winner and the loser gave their admission slots back
+    assert set(admission.limiters) == {'primary', 'secondary'}
+    wait_for_release(admission)
+
+def test_no_hedge_when_the_primary_is_fast(providers):
+    router = make_router(providers, hedging=True)
+    router.hedge_delay = lambda name: 1
+
+    assert router.get_chat_response(MESSAGES) == ('primary reply', 'primary')
+    assert providers['secondary'].calls == 0
+
+class AsyncSlowProvider(StubProvider):
+    """A provider whose first token never arrives; records the cancellation."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.cancelled = False
+
+    async def astream_chat_response(self, messages):
+        self.calls += 1
+        try:
+            await asyncio.sleep(10)
+            yield f"{self.name} reply"
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+def test_async_hedge_cancels_the_slow_request(providers):
+    providers['primary'] = AsyncSlowProvider('primary')
+    admission = AdmissionController()
+    router = make_router(providers, hedging=True, admission=admission)
+    router.hedge_delay = lambda name: 0.05
+
+    async def run():
+        name, stream = await router.aopen_stream(MESSAGES)
+        return name, [chunk async for chunk in stream]
+
+    assert asyncio.run(run()) == ('secondary', ['secondary reply'])
+    assert providers['primary'].cancelled
+    wait_for_release(admission)
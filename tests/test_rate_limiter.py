@@ -0,0 +1,201 @@
+"""
+Tests for the rate limit backends of utils.rate_limiter.
+"""
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import db, RateLimitCounter, User
+from utils import db_rate_limit
+from utils.rate_limiter import (
+    DatabaseRateLimitBackend, RateLimitBackend, RedisRateLimitBackend, SlidingWindowLogBackend,
+    TokenBucketBackend, create_rate_limiter
+)
+
+LIMIT = 3
+WINDOW_SECONDS = 3600
+
+# The keys each backend is exercised with: a user, an anonymous client and a sign-in throttle
+KEYS = ['user:1', 'ip:203.0.113.7', 'login-user:alice']
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controls time.time() for the in-process backends."""
+    now = [1_000_000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+@pytest.fixture(params=['memory', 'sliding_window', 'redis', 'database'])
+def backend(request, fake_redis):
+    if request.param == 'redis':
+        return RedisRateLimitBackend(client=fake_redis)
+    if request.param == 'database':
+        request.getfixturevalue('app')
+        db.session.add(User(id=1, username='alice', email='alice@example.com', password_hash='x'))
+        db.session.commit()
+        return DatabaseRateLimitBackend()
+    return create_rate_limiter(request.param)
+
+@pytest.mark.parametrize('key', KEYS)
+def test_consume_stops_at_the_limit(backend, key):
+    results = [backend.consume(key, LIMIT, WINDOW_SECONDS) for _ in range(LIMIT + 1)]
+
+    assert [result.allowed for result in results] == [True, True, True, False]
+    assert [result.remaining for result in results] == [2, 1, 0, 0]
+    assert all(result.limit == LIMIT for result in results)
+    assert results[-1].reset_at > time.time()
+
+@pytest.mark.parametrize('key', KEYS)
+def test_peek_does_not_consume(backend, key):
+    assert backend.peek(key, LIMIT, WINDOW_SECONDS).remaining == LIMIT
+    assert backend.peek(key, LIMIT, WINDOW_SECONDS).remaining == LIMIT
+
+    backend.consume(key, LIMIT, WINDOW_SECONDS)
+    result = backend.peek(key, LIMIT, WINDOW_SECONDS)
+    assert result.allowed
+    assert result.remaining == LIMIT - 1
+
+    for _ in range(LIMIT - 1):
+        backend.consume(key, LIMIT, WINDOW_SECONDS)
+    result = backend.peek(key, LIMIT, WINDOW_SECONDS)
+    assert not result.allowed
+    assert result.remaining == 0
+
+@pytest.mark.parametrize('key', KEYS)
+def test_refund_gives_back_a_message(backend, key):
+    for _ in range(LIMIT):
+        backend.consume(key, LIMIT, WINDOW_SECONDS)
+
+    backend.refund(key, LIMIT, WINDOW_SECONDS)
+
+    result = backend.peek(key, LIMIT, WINDOW_SECONDS)
+    assert result.allowed
+    assert result.remaining == 1
+    assert backend.consume(key, LIMIT, WINDOW_SECONDS).allowed
+    assert not backend.consume(key, LIMIT, WINDOW_SECONDS).allowed
+
+@pytest.mark.parametrize('key', KEYS)
+def test_rejected_requests_do_not_swallow_a_refund(backend, key):
+    for _ in range(LIMIT):
+        backend.consume(key, LIMIT, WINDOW_SECONDS)
+    # Rejected while a consumed request is still in flight, which then fails
+    assert not backend.consume(key, LIMIT, WINDOW_SECONDS).allowed
+    assert not backend.consume(key, LIMIT, WINDOW_SECONDS).allowed
+
+    backend.refund(key, LIMIT, WINDOW_SECONDS)
+
+    assert backend.peek(key, LIMIT, WINDOW_SECONDS).remaining == 1
+    assert backend.consume(key, LIMIT, WINDOW_SECONDS).allowed
+    assert not backend.consume(key, LIMIT, WINDOW_SECONDS).allowed
+
+@pytest.mark.parametrize('key', KEYS)
+def test_reset_forgets_usage(backend, key):
+    for _ in range(LIMIT + 1):
+        backend.consume(key, LIMIT, WINDOW_SECONDS)
+
+    backend.reset(key)
+
+    assert backend.peek(key, LIMIT, WINDOW_SECONDS).remaining == LIMIT
+    assert backend.consume(key, LIMIT, WINDOW_SECONDS).allowed
+
+def test_keys_are_counted_separately(backend):
+    for _ in range(LIMIT):
+        backend.consume('ip:203.0.113.7', LIMIT, WINDOW_SECONDS)
+
+    assert not backend.consume('ip:203.0.113.7', LIMIT, WINDOW_SECONDS).allowed
+    assert backend.consume('ip:203.0.113.8', LIMIT, WINDOW_SECONDS).allowed
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        create_rate_limiter('nope')
+
+def test_a_backend_must_implement_the_whole_interface():
+    class ConsumeOnly(RateLimitBackend):
+        def consume(self, key, limit, window_seconds):
+            return None
+
+    with pytest.raises(TypeError):
+        ConsumeOnly()
+
+def test_token_bucket_refills_gradually(clock):
+    backend = TokenBucketBackend()
+    for _ in range(LIMIT):
+        backend.consume('ip:203.0.113.7', LIMIT, WINDOW_SECONDS)
+
+    clock[0] += WINDOW_SECONDS / LIMIT
+    assert backend.peek('ip:203.0.113.7', LIMIT, WINDOW_SECONDS).remaining == 1
+
+    clock[0] += WINDOW_SECONDS
+    assert backend.peek('ip:203.0.113.7', LIMIT, WINDOW_SECONDS).remaining == LIMIT
+
+def test_token_bucket_drops_the_oldest_keys(clock):
+    backend = TokenBucketBackend(max_keys=10)
+    for i in range(11):
+        clock[0] += 1
+        backend.consume(f'ip:{i}', LIMIT, WINDOW_SECONDS)
+
+    assert len(backend.buckets) <= 10
+    assert 'ip:0' not in backend.buckets
+    assert 'ip:10' in backend.buckets
+
+def test_sliding_window_releases_messages_as_they_age(clock):
+    backend = SlidingWindowLogBackend()
+    backend.consume('ip:203.0.113.7', LIMIT, WINDOW_SECONDS)
+    clock[0] += 60
+    for _ in range(LIMIT - 1):
+        backend.consume('ip:203.0.113.7', LIMIT, WINDOW_SECONDS)
+
+    result = backend.peek('ip:203.0.113.7', LIMIT, WINDOW_SECONDS)
+    assert not result.allowed
+    assert result.reset_at == clock[0] - 60 + WINDOW_SECONDS
+
+    clock[0] += WINDOW_SECONDS - 60
+    assert backend.peek('ip:203.0.113.7', LIMIT, WINDOW_SECONDS).remaining == 1
+
+def test_redis_counters_expire_with_the_window(fake_redis):
+    backend = RedisRateLimitBackend(client=fake_redis)
+    backend.consume('ip:203.0.113.7', LIMIT, WINDOW_SECONDS)
+
+    assert 0 < fake_redis.pttl('ratelimit:ip:203.0.113.7') <= WINDOW_SECONDS * 1000
+
+def test_redis_refund_after_the_window_expired(fake_redis):
+    backend = RedisRateLimitBackend(client=fake_redis)
+    backend.consume('ip:203.0.113.7', LIMIT, WINDOW_SECONDS)
+    fake_redis.delete('ratelimit:ip:203.0.113.7')
+
+    backend.refund('ip:203.0.113.7', LIMIT, WINDOW_SECONDS)
+
+    # The DECR recreated the key without a TTL; it must not outlive the window
+    assert fake_redis.get('ratelimit:ip:203.0.113.7') is None
+
+def test_database_counters_are_shared_between_workers(app):
+    workers = [DatabaseRateLimitBackend(), DatabaseRateLimitBackend()]
+    results = [workers[i % 2].consume('login-ip:203.0.113.7', LIMIT, WINDOW_SECONDS) for i in range(LIMIT + 1)]
+
+    assert [result.allowed for result in results] == [True, True, True, False]
+    assert db.session.query(RateLimitCounter.count).filter_by(key='login-ip:203.0.113.7').scalar() == LIMIT + 1
+
+def test_database_window_restarts_after_reset_time(app):
+    backend = DatabaseRateLimitBackend()
+    for _ in range(LIMIT + 1):
+        backend.consume('ip:203.0.113.7', LIMIT, WINDOW_SECONDS)
+    RateLimitCounter.query.update({RateLimitCounter.reset_time: datetime.now() - timedelta(seconds=1)})
+    db.session.commit()
+
+    assert backend.peek('ip:203.0.113.7', LIMIT, WINDOW_SECONDS).remaining == LIMIT
+    result = backend.consume('ip:203.0.113.7', LIMIT, WINDOW_SECONDS)
+    assert result.allowed
+    assert result.remaining == LIMIT - 1
+
+def test_database_deletes_expired_counters(app):
+    backend = DatabaseRateLimitBackend()
+    backend.consume('ip:203.0.113.7', LIMIT, WINDOW_SECONDS)
+    backend.consume('ip:203.0.113.8', LIMIT, WINDOW_SECONDS)
+    RateLimitCounter.query.filter_by(key='ip:203.0.113.7').update(
+        {RateLimitCounter.reset_time: datetime.now() - timedelta(seconds=1)}
+    )
+    db.session.commit()
+
+    assert db_rate_limit.delete_expired_counters() == 1
+    assert [counter.key for counter in RateLimitCounter.query.all()] == ['ip:203.0.113.8']
@@ -0,0 +1,421 @@
+"""
+Background job queue for chat turns.
+
+In job mode /api/chat does not wait for the AI provider: the prepared turn is
+stored as a row of the chat_jobs table and the request returns a job id at
+once. A pool of worker threads in each process claims jobs, highest priority
+first, runs the provider call and stores the reply; failed attempts are
+retried with exponential backoff. Clients fetch the result by long-polling or
+over Server-Sent Events. Web workers are therefore no longer tied up for the
+duration of an AI call, and the queue depth bounds how much work is accepted.
+
+Jobs are claimed with a single UPDATE ... RETURNING whose subquery uses
+FOR UPDATE SKIP LOCKED on PostgreSQL, so workers in different processes never
+run the same job. A claimed job is leased; if its worker dies, the job is
+picked up again once the lease expires.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask import Flask
+from flask_login import current_user
+from sqlalchemy import and_, delete, func, or_, select, update
+
+from models import db, ChatJob
+from utils.message_writer import make_chat_turn, submit_chat_turn
+from utils.rate_limiter import ANONYMOUS_TIER, DEFAULT_TIER, get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# Run every /api/chat request as a job ("1"), or only those sent with {"mode": "job"}
+CHAT_JOB_MODE = os.environ.get("CHAT_JOB_MODE", "0") == "1"
+
+# Worker threads per process
+CHAT_JOB_WORKERS = int(os.environ.get("CHAT_JOB_WORKERS", "2"))
+
+# Attempts per job, and the delay before the first retry (doubled after each failure)
+CHAT_JOB_MAX_ATTEMPTS = int(os.environ.get("CHAT_JOB_MAX_ATTEMPTS", "3"))
+CHAT_JOB_RETRY_BACKOFF = float(os.environ.get("CHAT_JOB_RETRY_BACKOFF", "2"))
+CHAT_JOB_MAX_BACKOFF = 60.0
+
+# Seconds a worker may run a job before it is handed to another worker
+CHAT_JOB_LEASE_SECONDS = int(os.environ.get("CHAT_JOB_LEASE_SECONDS", "120"))
+
+# Jobs waiting to run beyond which new jobs are refused (backpressure)
+CHAT_JOB_MAX_QUEUE_DEPTH = int(os.environ.get("CHAT_JOB_MAX_QUEUE_DEPTH", "100"))
+
+# Seconds between polls of an idle worker, or of a client waiting on a job
+CHAT_JOB_POLL_INTERVAL = float(os.environ.get("CHAT_JOB_POLL_INTERVAL", "1"))
+
+# Seconds finished jobs are kept for their clients to fetch
+CHAT_JOB_RETENTION = int(os.environ.get("CHAT_JOB_RETENTION", "3600"))
+
+# Priority of the jobs of each rate limit tier (higher runs first)
+CHAT_JOB_PRIORITIES: Dict[str, int] = {
+    'anonymous': 0,
+    'free': 5,
+    'pro': 10,
+}
+# Overrides, e.g. CHAT_JOB_PRIORITIES='{"pro": 20}'
+CHAT_JOB_PRIORITIES.update(json.loads(os.environ.get("CHAT_JOB_PRIORITIES", "{}")))
+
+# Job statuses
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+FINISHED_STATUSES = (JOB_SUCCEEDED, JOB_FAILED)
+
+# Runs the provider call of a job: (messages, use_cache) -> (response, provider)
+JobRunner = Callable[[List[Dict[str, str]], bool], Tuple[str, str]]
+
+def get_job_priority() -> int:
+    """Get the priority of a job submitted by the current user."""
+    if current_user.is_authenticated:
+        tier = getattr(current_user, 'tier', None) or DEFAULT_TIER
+    else:
+        tier = ANONYMOUS_TIER
+    return CHAT_JOB_PRIORITIES.get(tier, 0)
+
+def get_queue_depth() -> int:
+    """Get the number of jobs waiting to run."""
+    return db.session.query(func.count(ChatJob.id)).filter(ChatJob.status == JOB_QUEUED).scalar()
+
+def is_queue_full() -> bool:
+    """Check whether new jobs should be refused."""
+    return get_queue_depth() >= CHAT_JOB_MAX_QUEUE_DEPTH
+
+def enqueue_chat_job(
+    turn: Dict[str, Any],
+    conversation_id: Optional[int],
+    rate_limit_key: str,
+    rate_limit_tier: Dict[str, int]
+) -> int:
+    """
+    Store a prepared chat turn as a job for the current user.
+
+    Args:
+        turn: The turn returned by prepare_chat_turn
+        conversation_id: The conversation the reply is recorded in (authenticated users)
+        rate_limit_key: The rate limit key charged for the turn, refunded if the job fails
+        rate_limit_tier: The 'limit' and 'window_seconds' of that key's tier
+
+    Returns:
+        The job id
+    """
+    payload = {
+        'user_message': turn['user_message'],
+        'received_at': turn['received_at'].isoformat(),
+        'messages': turn['messages'],
+        'summary': turn['summary'],
+        'remaining': turn['remaining'],
+        'use_cache': turn['use_cache'],
+        'rate_limit_key': rate_limit_key,
+        'rate_limit_tier': rate_limit_tier,
+    }
+
+    job = ChatJob()
+    job.user_id = current_user.id if current_user.is_authenticated else None
+    job.conversation_id = conversation_id
+    job.status = JOB_QUEUED
+    job.priority = get_job_priority()
+    job.payload = json.dumps(payload, ensure_ascii=False)
+    job.max_attempts = CHAT_JOB_MAX_ATTEMPTS
+    job.available_at = datetime.utcnow()
+    db.session.add(job)
+    db.session.commit()
+
+    logger.debug("Queued chat job %s with priority %s", job.id, job.priority)
+    _wake_workers()
+    return job.id
+
+def claim_chat_job() -> Optional[Dict[str, Any]]:
+    """
+    Atomically claim the next runnable job: the highest-priority, oldest queued
+    job whose backoff has elapsed, or a running job whose lease has expired.
+
+    Returns:
+        The claimed job's columns, or None if there is nothing to run
+    """
+    now = datetime.utcnow()
+    candidate = (
+        select(ChatJob.id)
+        .where(or_(
+            and_(ChatJob.status == JOB_QUEUED, ChatJob.available_at <= now),
+            and_(ChatJob.status == JOB_RUNNING, ChatJob.locked_until < now),
+        ))
+        .order_by(ChatJob.priority.desc(), ChatJob.id)
+        .limit(1)
+        # PostgreSQL: concurrent claimers skip each other's row; SQLite
+        # serializes writers and ignores the clause
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    try:
+        row = db.session.execute(
+            update(ChatJob)
+            .where(ChatJob.id == candidate)
+            .values(
+                status=JOB_RUNNING,
+                attempts=ChatJob.attempts + 1,
+                locked_until=now + timedelta(seconds=CHAT_JOB_LEASE_SECONDS),
+            )
+            .returning(
+                ChatJob.id, ChatJob.user_id, ChatJob.conversation_id, ChatJob.payload,
+                ChatJob.attempts, ChatJob.max_attempts
+            )
+        ).first()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return dict(row._mapping) if row is not None else None
+
+def run_chat_job(job: Dict[str, Any], runner: JobRunner) -> None:
+    """
+    Run a claimed job and store its outcome.
+
+    On success the reply is stored with the job and, for authenticated users,
+    the chat turn is recorded in the same transaction. On failure the job is
+    retried after a backoff, or marked failed and its message refunded once
+    it is out of attempts.
+
+    Args:
+        job: A job returned by claim_chat_job
+        runner: Runs the provider call
+    """
+    payload = json.loads(job['payload'])
+    # Only the worker holding the lease may store the outcome
+    claimed = and_(ChatJob.id == job['id'], ChatJob.status == JOB_RUNNING, ChatJob.attempts == job['attempts'])
+
+    try:
+        ai_response, provider = runner(payload['messages'], payload['use_cache'])
+    except Exception as e:
+        error_message = str(e)
+        values: Dict[str, Any] = {'error': error_message[:50], 'locked_until': None}
+        if job['attempts'] < job['max_attempts']:
+            backoff = min(CHAT_JOB_RETRY_BACKOFF * 2 ** (job['attempts'] - 1), CHAT_JOB_MAX_BACKOFF)
+            # An overloaded provider says when it expects to have room
+            backoff = max(backoff, getattr(e, 'retry_after', 0))
+            values.update(status=JOB_QUEUED, available_at=datetime.utcnow() + timedelta(seconds=backoff))
+            logger.warning("Chat job %s failed (%s), retrying in %.1fs", job['id'], error_message, backoff)
+        else:
+            values.update(status=JOB_FAILED, finished_at=datetime.utcnow())
+            logger.error("Chat job %s failed after %s attempts: %s", job['id'], job['attempts'], error_message)
+
+        try:
+            stored = db.session.execute(update(ChatJob).where(claimed).values(**values)).rowcount
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        # Failed requests don't count against the quota
+        if stored and values['status'] == JOB_FAILED:
+            tier = payload['rate_limit_tier']
+            get_rate_limiter().refund(payload['rate_limit_key'], tier['limit'], tier['window_seconds'])
+        _notify_finished()
+        return
+
+    now = datetime.utcnow()
+    try:
+        stored = db.session.execute(
+            update(ChatJob).where(claimed).values(
+                status=JOB_SUCCEEDED, result=ai_response, provider=provider, error=None,
+                locked_until=None, finished_at=now
+            )
+        ).rowcount
+        if stored and job['user_id'] is not None:
+            # Committed together with the job unless write-behind queues it
+            submit_chat_turn(make_chat_turn(
+                job['user_id'],
+                job['conversation_id'],
+                [
+                    {'role': 'user', 'content': payload['user_message'], 'created_at': payload['received_at']},
+                    {'role': 'assistant', 'content': ai_response, 'created_at': now.isoformat()},
+                ],
+                payload['summary']
+            ))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if not stored:
+        logger.warning("Chat job %s was taken over by another worker, discarding its result", job['id'])
+    _notify_finished()
+
+def get_chat_job(job_id: int) -> Optional[ChatJob]:
+    """Get a job by id, bypassing the session's identity map so the status is current."""
+    return db.session.execute(
+        select(ChatJob).where(ChatJob.id == job_id).execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+
+def wait_for_chat_job(job_id: int, timeout: float) -> Optional[ChatJob]:
+    """
+    Wait until a job has finished or the timeout has elapsed.
+
+    Jobs finished in this process wake the waiter at once; others are seen at
+    the next poll. The database connection is released between polls.
+
+    Args:
+        job_id: The job id
+        timeout: Maximum number of seconds to wait
+
+    Returns:
+        The job in its latest state, or None if it does not exist
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        job = get_chat_job(job_id)
+        remaining = deadline - time.monotonic()
+        if job is None or job.status in FINISHED_STATUSES or remaining <= 0:
+            return job
+
+        db.session.rollback()
+        with _finished:
+            _finished.wait(min(CHAT_JOB_POLL_INTERVAL, remaining))
+
+def delete_finished_jobs(retention: int = CHAT_JOB_RETENTION) -> int:
+    """
+    Delete jobs that finished more than `retention` seconds ago.
+
+    Returns:
+        The number of deleted jobs
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=retention)
+    try:
+        deleted = db.session.execute(
+            delete(ChatJob).where(ChatJob.status.in_(FINISHED_STATUSES), ChatJob.finished_at < cutoff)
+        ).rowcount
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return deleted
+
+class ChatJobWorkerPool:
+    """Threads of one process claiming and running chat jobs."""
+
+    def __init__(
+        self,
+        app: Flask,
+        runner: JobRunner,
+        workers: int = CHAT_JOB_WORKERS,
+        poll_interval: float = CHAT_JOB_POLL_INTERVAL,
+    ):
+        """
+        Args:
+            app: The Flask app, for the database connection of the workers
+            runner: Runs the provider call of a job
+            workers: Number of worker threads
+            poll_interval: Seconds an idle worker waits before polling again
+        """
+        self.app = app
+        self.runner = runner
+        self.poll_interval = poll_interval
+        self.pid = os.getpid()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.last_cleanup = time.monotonic()
+        self.threads = [
+            threading.Thread(target=self._run, name=f"chat-job-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self) -> None:
+        """Start the worker threads."""
+        for thread in self.threads:
+            thread.start()
+        logger.info("Started %s chat job workers", len(self.threads))
+
+    def wake(self) -> None:
+        """Wake the idle workers, e.g. after a job was queued."""
+        self.wakeup.set()
+
+    def stop(self) -> None:
+        """Stop the workers after their current job."""
+        self.stopped = True
+        self.wakeup.set()
+
+    def _run(self) -> None:
+        while not self.stopped:
+            try:
+                with self.app.app_context():
+                    job = claim_chat_job()
+                    if job is not None:
+                        run_chat_job(job, self.runner)
+                    self._cleanup()
+            except Exception as e:
+                logger.error("Error in chat job worker: %s", e)
+                job = None
+
+            if job is None:
+                # Jitter so that idle workers don't poll in lockstep
+                self.wakeup.wait(self.poll_interval * random.uniform(0.5, 1.5))
+                self.wakeup.clear()
+
+    def _cleanup(self) -> None:
+        if time.monotonic() - self.last_cleanup < CHAT_JOB_RETENTION / 10:
+            return
+        self.last_cleanup = time.monotonic()
+        deleted = delete_finished_jobs()
+        if deleted:
+            logger.debug("Deleted %s finished chat jobs", deleted)
+
+_app: Optional[Flask] = None
+_runner: Optional[JobRunner] = None
+_pool: Optional[ChatJobWorkerPool] = None
+_pool_lock = threading.Lock()
+
+# Signalled when a worker of this process finishes a job
+_finished = threading.Condition()
+
+def init_chat_jobs(app: Flask, runner: JobRunner) -> None:
+    """
+    Set up the job queue for the app.
+
+    Workers are started lazily in each process, from the first request when
+    job mode is the default and otherwise from the first queued job.
+
+    Args:
+        app: The Flask app
+        runner: Runs the provider call of a job
+    """
+    global _app, _runner
+    _app = app
+    _runner = runner
+    if CHAT_JOB_MODE and CHAT_JOB_WORKERS > 0:
+        app.before_request(start_chat_job_workers)
+        logger.info("Chat requests are processed as background jobs")
+
+def start_chat_job_workers() -> Optional[ChatJobWorkerPool]:
+    """Start this process's job workers if they are not running yet."""
+    global _pool
+
+    if _app is None or _runner is None or CHAT_JOB_WORKERS <= 0:
+        return None
+
+    # Forked workers start their own pool
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ChatJobWorkerPool(_app, _runner)
+                _pool.start()
+    return _pool
+
+def _wake_workers() -> None:
+    pool = start_chat_job_workers()
+    if pool is not None:
+        pool.wake()
+
+def _notify_finished() -> None:
+    with _finished:
+        _finished.notify_all()
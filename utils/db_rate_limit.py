@@ -1,184 +1,253 @@
 """
-Utilities for managing rate limiting and message quotas using the database.
+Database storage for message quotas and other rate limit counters.
+
+Authenticated users are counted in the rate_limits table, by user id; other
+keys (anonymous clients, sign-in attempts) in the rate_limit_counters table,
+by key. Either way the counters are shared by every worker and instance.
+
+These are the primitives behind the "database" rate limit backend in
+utils.rate_limiter; routes should go through that module instead.
 """
-import time
+import os
+import random
 from datetime import datetime, timedelta
-from typing import Dict, Tuple, Optional
-from flask import session
-from flask_login import current_user
-from models import db, RateLimit, User
-
-# Constants for rate limiting
-FREE_TIER_LIMIT = 5  # Number of messages allowed in free tier
-RESET_PERIOD_HOURS = 3  # Reset period in hours
+from typing import Any, Optional, Tuple, Type
+from sqlalchemy import case
+from models import db, RateLimit, RateLimitCounter
 
-# Session key for rate limiting for non-authenticated users
-SESSION_LIMIT_KEY = 'message_limit'
+# Delete expired rate_limit_counters rows on average once every N consumes; 0 disables it
+RATE_LIMIT_CLEANUP_N_REQUESTS = int(os.environ.get("RATE_LIMIT_CLEANUP_N_REQUESTS", "1000"))
 
-def get_usage_info() -> Dict:
+def _consume(model: Type[db.Model], key_column: str, key: Any, limit: int, window_seconds: int) -> Tuple[int, datetime]:
     """
-    Get the current usage information from the database if user is authenticated,
-    or from the session if not.
-    
+    Check and consume one message of a counter in a single statement.
+
+    The counter is created, reset or incremented with one UPSERT ... RETURNING,
+    so concurrent requests cannot both pass the limit. A request over the limit
+    leaves the counter at limit + 1, which marks it as rejected.
+
+    Args:
+        model: RateLimit or RateLimitCounter
+        key_column: The unique column identifying the counter
+        key: Its value
+        limit: Number of messages allowed per window
+        window_seconds: Length of the window
+
     Returns:
-        A dictionary containing message count and reset time
-    """
-    # If user is authenticated, get from database
-    if current_user.is_authenticated:
-        rate_limit = RateLimit.query.filter_by(user_id=current_user.id).first()
-        
-        # If no rate limit record exists, create one
-        if not rate_limit:
-            reset_time = datetime.now() + timedelta(hours=RESET_PERIOD_HOURS)
-            rate_limit = RateLimit()
-            rate_limit.user_id = current_user.id
-            rate_limit.count = 0
-            rate_limit.reset_time = reset_time
-            db.session.add(rate_limit)
-            db.session.commit()
-        
-        return {
-            'count': rate_limit.count,
-            'reset_time': rate_limit.reset_time.timestamp()
-        }
-    
-    # Otherwise, get from session
-    if SESSION_LIMIT_KEY not in session:
-        reset_time = datetime.now() + timedelta(hours=RESET_PERIOD_HOURS)
-        session[SESSION_LIMIT_KEY] = {
-            'count': 0,
-            'reset_time': reset_time.timestamp()
+        A tuple with the counter value after the call and the reset time
+    """
+    now = datetime.now()
+    new_reset_time = now + timedelta(seconds=window_seconds)
+    table = model.__table__
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return _consume_with_row_lock(model, key_column, key, limit, now, new_reset_time)
+
+    window_expired = table.c.reset_time <= now
+    statement = (
+        insert(table)
+        .values({key_column: key, 'count': 1, 'reset_time': new_reset_time})
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c[key_column]],
+        set_={
+            'count': case(
+                (window_expired, 1),
+                (table.c.count < limit, table.c.count + 1),
+                else_=limit + 1
+            ),
+            'reset_time': case(
+                (window_expired, new_reset_time),
+                else_=table.c.reset_time
+            ),
         }
-        session.modified = True
-        
-    return session[SESSION_LIMIT_KEY]
-
-def increment_message_count() -> None:
-    """
-    Increment the message count in the database if user is authenticated,
-    or in the session if not.
-    """
-    # If user is authenticated, update in database
-    if current_user.is_authenticated:
-        rate_limit = RateLimit.query.filter_by(user_id=current_user.id).first()
-        
-        # If no rate limit record exists, create one with count=1
-        if not rate_limit:
-            reset_time = datetime.now() + timedelta(hours=RESET_PERIOD_HOURS)
-            rate_limit = RateLimit()
-            rate_limit.user_id = current_user.id
-            rate_limit.count = 1
-            rate_limit.reset_time = reset_time
-            db.session.add(rate_limit)
-        else:
-            rate_limit.count += 1
-            
-        db.session.commit()
-        return
-    
-    # Otherwise, update in session
-    usage_info = get_usage_info()
-    usage_info['count'] += 1
-    session[SESSION_LIMIT_KEY] = usage_info
-    session.modified = True
-
-def check_rate_limit() -> Tuple[bool, Optional[Dict]]:
-    """
-    Check if the user has exceeded their message limit.
-    
+    ).returning(table.c.count, table.c.reset_time)
+
+    row = db.session.execute(statement).one()
+    db.session.commit()
+    return row.count, row.reset_time
+
+def _consume_with_row_lock(
+    model: Type[db.Model],
+    key_column: str,
+    key: Any,
+    limit: int,
+    now: datetime,
+    new_reset_time: datetime
+) -> Tuple[int, datetime]:
+    """
+    Fallback for databases without UPSERT ... RETURNING: lock the counter row
+    for the duration of the read-modify-write.
+    """
+    rate_limit = (
+        model.query.filter_by(**{key_column: key})
+        .with_for_update()
+        .first()
+    )
+
+    if rate_limit is None:
+        rate_limit = model(**{key_column: key})
+        rate_limit.count = 1
+        rate_limit.reset_time = new_reset_time
+        db.session.add(rate_limit)
+    elif rate_limit.reset_time <= now:
+        rate_limit.count = 1
+        rate_limit.reset_time = new_reset_time
+    else:
+        rate_limit.count = min(rate_limit.count + 1, limit + 1)
+
+    count, reset_time = rate_limit.count, rate_limit.reset_time
+    db.session.commit()
+    return count, reset_time
+
+def _refund(model: Type[db.Model], key_column: str, key: Any, limit: int) -> None:
+    """
+    Give back a message consumed by _consume. A counter left at limit + 1 by
+    a rejected request counts as limit, so the refund is not lost.
+    """
+    model.query.filter(
+        getattr(model, key_column) == key,
+        model.count > 0
+    ).update(
+        {model.count: case((model.count > limit, limit), else_=model.count) - 1},
+        synchronize_session=False
+    )
+    db.session.commit()
+
+def _get_usage(model: Type[db.Model], key_column: str, key: Any) -> Tuple[int, Optional[datetime]]:
+    """
+    Get a counter's usage with a single read. An expired window is reported as
+    empty but only reset by the next _consume call.
+    """
+    row = (
+        db.session.query(model.count, model.reset_time)
+        .filter(getattr(model, key_column) == key)
+        .first()
+    )
+
+    if row is None or row.reset_time <= datetime.now():
+        return 0, None
+
+    return row.count, row.reset_time
+
+def _reset(model: Type[db.Model], key_column: str, key: Any) -> None:
+    """Delete a counter."""
+    model.query.filter_by(**{key_column: key}).delete()
+    db.session.commit()
+
+def consume_user_message(user_id: int, limit: int, window_seconds: int) -> Tuple[int, datetime]:
+    """
+    Check and consume one message for a user in a single statement.
+
+    Args:
+        user_id: The id of the authenticated user
+        limit: Number of messages allowed per window
+        window_seconds: Length of the window
+
     Returns:
-        A tuple containing:
-        - Boolean indicating if the limit is exceeded
-        - If limited, a dict with 'remaining_time' (seconds) to reset
-          and 'reset_time' (formatted string)
-    """
-    usage_info = get_usage_info()
-    
-    # Check if reset time has passed
-    reset_timestamp = usage_info['reset_time']
-    current_time = datetime.now().timestamp()
-    
-    # If reset time has passed, reset the counter
-    if current_time > reset_timestamp:
-        reset_time = datetime.now() + timedelta(hours=RESET_PERIOD_HOURS)
-        
-        # Reset in database or session based on authentication status
-        if current_user.is_authenticated:
-            rate_limit = RateLimit.query.filter_by(user_id=current_user.id).first()
-            if rate_limit:
-                rate_limit.count = 0
-                rate_limit.reset_time = reset_time
-                db.session.commit()
-            else:
-                # Should not happen, but handle it just in case
-                rate_limit = RateLimit()
-                rate_limit.user_id = current_user.id
-                rate_limit.count = 0
-                rate_limit.reset_time = reset_time
-                db.session.add(rate_limit)
-                db.session.commit()
-        else:
-            # Reset in session
-            usage_info = {
-                'count': 0,
-                'reset_time': reset_time.timestamp()
-            }
-            session[SESSION_LIMIT_KEY] = usage_info
-            session.modified = True
-    
-    # Get fresh usage info after possible reset
-    usage_info = get_usage_info()
-    
-    # Check if user has exceeded the limit
-    if usage_info['count'] >= FREE_TIER_LIMIT:
-        # Calculate remaining time
-        reset_time_dt = datetime.fromtimestamp(usage_info['reset_time'])
-        remaining_seconds = int((reset_time_dt - datetime.now()).total_seconds())
-        remaining_time = max(0, remaining_seconds)
-        
-        # Format reset time for display
-        formatted_reset_time = reset_time_dt.strftime("%H:%M:%S")
-        
-        return (True, {
-            'remaining_time': remaining_time,
-            'reset_time': formatted_reset_time,
-            'limit': FREE_TIER_LIMIT
-        })
-    
-    return (False, None)
-
-def get_remaining_messages() -> int:
-    """
-    Get the number of remaining messages in the current period.
-    
+        A tuple with the counter value after the call (limit + 1 when the
+        message was rejected) and the reset time
+    """
+    return _consume(RateLimit, 'user_id', user_id, limit, window_seconds)
+
+def refund_user_message(user_id: int, limit: int) -> None:
+    """
+    Give back a message consumed by consume_user_message, e.g. when the AI request failed.
+
+    Args:
+        user_id: The id of the authenticated user
+        limit: Number of messages allowed per window
+    """
+    _refund(RateLimit, 'user_id', user_id, limit)
+
+def get_user_usage(user_id: int) -> Tuple[int, Optional[datetime]]:
+    """
+    Get a user's usage with a single read.
+
+    Args:
+        user_id: The id of the authenticated user
+
     Returns:
-        Number of messages remaining
-    """
-    usage_info = get_usage_info()
-    return max(0, FREE_TIER_LIMIT - usage_info['count'])
-
-def reset_usage() -> None:
-    """
-    Reset the usage counter and timer. Used primarily for testing.
-    """
-    reset_time = datetime.now() + timedelta(hours=RESET_PERIOD_HOURS)
-    
-    if current_user.is_authenticated:
-        rate_limit = RateLimit.query.filter_by(user_id=current_user.id).first()
-        if rate_limit:
-            rate_limit.count = 0
-            rate_limit.reset_time = reset_time
-            db.session.commit()
-        else:
-            rate_limit = RateLimit()
-            rate_limit.user_id = current_user.id
-            rate_limit.count = 0
-            rate_limit.reset_time = reset_time
-            db.session.add(rate_limit)
-            db.session.commit()
-    else:
-        session[SESSION_LIMIT_KEY] = {
-            'count': 0,
-            'reset_time': reset_time.timestamp()
-        }
-        session.modified = True
\ No newline at end of file
+        A tuple with the message count and the reset time (None if the
+        user has no active window)
+    """
+    return _get_usage(RateLimit, 'user_id', user_id)
+
+def reset_user_usage(user_id: int) -> None:
+    """
+    Reset a user's usage counter. Used primarily for testing.
+
+    Args:
+        user_id: The id of the authenticated user
+    """
+    _reset(RateLimit, 'user_id', user_id)
+
+def consume_counter(key: str, limit: int, window_seconds: int) -> Tuple[int, datetime]:
+    """
+    Check and consume one message of a keyed counter in a single statement.
+
+    About one call in RATE_LIMIT_CLEANUP_N_REQUESTS also deletes the expired
+    counters, since most keys (client IPs, usernames) are never seen again.
+
+    Args:
+        key: The rate limit key, e.g. "ip:203.0.113.7"
+        limit: Number of messages allowed per window
+        window_seconds: Length of the window
+
+    Returns:
+        A tuple with the counter value after the call (limit + 1 when the
+        message was rejected) and the reset time
+    """
+    if RATE_LIMIT_CLEANUP_N_REQUESTS > 0 and random.randrange(RATE_LIMIT_CLEANUP_N_REQUESTS) == 0:
+        delete_expired_counters()
+    return _consume(RateLimitCounter, 'key', key, limit, window_seconds)
+
+def refund_counter(key: str, limit: int) -> None:
+    """
+    Give back a message consumed by consume_counter.
+
+    Args:
+        key: The rate limit key
+        limit: Number of messages allowed per window
+    """
+    _refund(RateLimitCounter, 'key', key, limit)
+
+def get_counter_usage(key: str) -> Tuple[int, Optional[datetime]]:
+    """
+    Get a keyed counter's usage with a single read.
+
+    Args:
+        key: The rate limit key
+
+    Returns:
+        A tuple with the message count and the reset time (None if the
+        key has no active window)
+    """
+    return _get_usage(RateLimitCounter, 'key', key)
+
+def reset_counter(key: str) -> None:
+    """
+    Forget a keyed counter, e.g. a username's failed sign-ins after a successful one.
+
+    Args:
+        key: The rate limit key
+    """
+    _reset(RateLimitCounter, 'key', key)
+
+def delete_expired_counters() -> int:
+    """
+    Delete the keyed counters whose window has ended.
+
+    Returns:
+        The number of counters deleted
+    """
+    deleted = RateLimitCounter.query.filter(
+        RateLimitCounter.reset_time <= datetime.now()
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
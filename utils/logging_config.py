@@ -0,0 +1,206 @@
+"""
+Logging configuration.
+
+Log calls never write to the output themselves: records go through a bounded
+queue to a background thread that formats and writes them, so a slow stderr
+cannot block a request and formatting is not paid on the request thread.
+When the queue is full, records are dropped and counted instead of waiting.
+
+Records are written as JSON lines (LOG_FORMAT=json) with the time, level,
+logger, message, the trace id of the request when it is traced, any extra
+fields and the exception; LOG_FORMAT=text writes plain lines for development.
+Levels are set for the whole app (LOG_LEVEL) and per module (LOG_LEVELS), and
+high-volume debug records can be sampled per module (LOG_SAMPLE_RATES).
+
+Log messages use %-style arguments (logger.debug("Sent %d messages", count)),
+which are only formatted for records that are written.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from utils.tracing import get_trace_id
+
+# Level of the app's loggers
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+# Per-module levels, e.g. LOG_LEVELS='{"services.provider_router": "DEBUG", "sqlalchemy.engine": "WARNING"}'
+LOG_LEVELS: Dict[str, str] = json.loads(os.environ.get("LOG_LEVELS", "{}"))
+
+# Output format: "json" or "text"
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+
+# Fraction of the debug records kept, per module (the longest matching prefix
+# applies), e.g. LOG_SAMPLE_RATES='{"services": 0.01}'
+LOG_SAMPLE_RATES: Dict[str, float] = json.loads(os.environ.get("LOG_SAMPLE_RATES", "{}"))
+
+# Records waiting to be written; more are dropped
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+# Format of the text output
+TEXT_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+# Attributes every LogRecord has; any other attribute is an extra field
+STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'trace_id'}
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line JSON objects."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id:
+            data['trace_id'] = trace_id
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(data, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of the debug records of the configured modules."""
+
+    def __init__(self, rates: Dict[str, float]):
+        """
+        Args:
+            rates: Fraction of debug records kept, by logger name prefix
+        """
+        super().__init__()
+        self.rates = rates
+        self.logger_rates: Dict[str, float] = {}
+
+    def _rate(self, name: str) -> float:
+        rate = self.logger_rates.get(name)
+        if rate is None:
+            prefixes = [prefix for prefix in self.rates if name == prefix or name.startswith(prefix + '.')]
+            rate = self.rates[max(prefixes, key=len)] if prefixes else 1.0
+            self.logger_rates[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or not self.rates:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+class QueueLogHandler(logging.Handler):
+    """
+    Hand records to a background thread that writes them with the target
+    handler. Each process (e.g. each forked worker) starts its own thread.
+    """
+
+    def __init__(self, target: logging.Handler, max_queue: int = LOG_QUEUE_SIZE):
+        """
+        Args:
+            target: Handler writing the records, called from the background thread
+            max_queue: Records waiting to be written; more are dropped
+        """
+        super().__init__()
+        self.target = target
+        self.max_queue = max_queue
+        self.pid: Optional[int] = None
+        self.queue: "queue.Queue[Optional[logging.LogRecord]]" = queue.Queue(maxsize=max_queue)
+        self.thread: Optional[threading.Thread] = None
+        self.start_lock = threading.Lock()
+        self.dropped = 0
+
+    def _start(self) -> None:
+        """Start the writer thread of this process."""
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.max_queue)
+            self.dropped = 0
+            self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.pid != os.getpid():
+            self._start()
+        # Captured here: the trace is a context variable of the request thread
+        record.trace_id = get_trace_id()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.target.handle(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': "Log queue full, dropped %d records", 'args': (dropped,),
+                }))
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.handleError(record)
+
+    def flush(self) -> None:
+        """Wait for the queued records to be written (called by logging at exit)."""
+        if self.pid != os.getpid() or self.thread is None:
+            return
+        try:
+            self.queue.put(None, timeout=1)
+        except queue.Full:
+            return
+        self.thread.join(timeout=2)
+        self.pid = None
+        self.target.flush()
+
+def configure_logging(
+    level: str = LOG_LEVEL,
+    levels: Optional[Dict[str, str]] = None,
+    fmt: str = LOG_FORMAT,
+    sample_rates: Optional[Dict[str, float]] = None,
+) -> None:
+    """
+    Route the process's logs through the background writer.
+
+    Args:
+        level: Level of the root logger
+        levels: Levels by logger name (defaults to LOG_LEVELS)
+        fmt: "json" or "text"
+        sample_rates: Fraction of debug records kept, by logger name prefix
+                      (defaults to LOG_SAMPLE_RATES)
+
+    Raises:
+        ValueError: If the format is unknown
+    """
+    if fmt not in ('json', 'text'):
+        raise ValueError(f"Unknown log format: {fmt}")
+
+    target = logging.StreamHandler(sys.stderr)
+    target.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    handler = QueueLogHandler(target)
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_RATES if sample_rates is None else sample_rates))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+        if isinstance(existing, QueueLogHandler):
+            existing.flush()
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    for name, module_level in (LOG_LEVELS if levels is None else levels).items():
+        logging.getLogger(name).setLevel(module_level)
@@ -0,0 +1,325 @@
+"""
+Message retention: compressed archive of old messages, and expiry.
+
+A background compactor applies a retention policy per user tier
+(MESSAGE_RETENTION_POLICIES):
+
+- messages older than archive_after_days are moved out of the messages table
+  into message_archives, as segments of up to MESSAGE_ARCHIVE_SEGMENT_SIZE
+  consecutive messages of a conversation stored as compressed JSON (zstd, or
+  zlib when the zstandard package is missing);
+- messages older than delete_after_days are deleted, and archived segments
+  once their newest message is.
+
+Archived messages keep their ids and are read back transparently when the
+history is paged back that far or an old conversation is resumed (see
+utils.session_utils). They are no longer found by message search.
+
+Each segment is archived in its own transaction, which only commits if it
+deleted every message it archived: a compactor in another process that
+archived the same messages first makes it roll back instead of writing a
+duplicate segment.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask import Flask
+from sqlalchemy import delete, or_, select
+
+from models import db, Message, MessageArchive, User
+from utils.metrics import MESSAGE_RETENTION
+from utils.rate_limiter import DEFAULT_TIER
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Retention of each user tier, in days: messages older than archive_after_days
+# are archived, messages and archives older than delete_after_days are deleted
+# (null: never). Other tiers follow the default tier's policy. Overrides, e.g.
+# MESSAGE_RETENTION_POLICIES='{"pro": {"archive_after_days": 60, "delete_after_days": null}}'
+MESSAGE_RETENTION_POLICIES: Dict[str, Dict[str, Optional[int]]] = {
+    'free': {'archive_after_days': 30, 'delete_after_days': 365},
+    'pro': {'archive_after_days': 90, 'delete_after_days': None},
+}
+MESSAGE_RETENTION_POLICIES.update(json.loads(os.environ.get("MESSAGE_RETENTION_POLICIES", "{}")))
+
+# Messages per archived segment
+MESSAGE_ARCHIVE_SEGMENT_SIZE = int(os.environ.get("MESSAGE_ARCHIVE_SEGMENT_SIZE", "200"))
+
+# Average seconds between compactor runs in each process; 0 disables the compactor
+MESSAGE_COMPACTION_INTERVAL = int(os.environ.get("MESSAGE_COMPACTION_INTERVAL", "3600"))
+
+# Conversations archived, and messages deleted, per tier in each batch of a run
+MESSAGE_COMPACTION_BATCH = int(os.environ.get("MESSAGE_COMPACTION_BATCH", "100"))
+
+# zstd compression level: segments are written once and read rarely
+ZSTD_LEVEL = 10
+
+# Compression of the segments: codec name -> (compress, decompress)
+ARCHIVE_CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    'zlib': (lambda data: zlib.compress(data, 9), zlib.decompress),
+}
+if zstandard is not None:
+    ARCHIVE_CODECS['zstd'] = (lambda data: zstandard.compress(data, ZSTD_LEVEL), zstandard.decompress)
+
+# Codec of new segments
+ARCHIVE_CODEC = 'zstd' if 'zstd' in ARCHIVE_CODECS else 'zlib'
+
+_compaction_pid: Optional[int] = None
+_compaction_lock = threading.Lock()
+
+def compress_messages(messages: List[Dict[str, Any]], codec: str = ARCHIVE_CODEC) -> bytes:
+    """
+    Serialize and compress the messages of a segment.
+
+    Raises:
+        ValueError: If the codec is unknown
+    """
+    if codec not in ARCHIVE_CODECS:
+        raise ValueError(f"Unknown archive codec: {codec}")
+    compress, _ = ARCHIVE_CODECS[codec]
+    return compress(json.dumps(messages, separators=(',', ':')).encode('utf-8'))
+
+def decompress_messages(data: bytes, codec: str) -> List[Dict[str, Any]]:
+    """
+    Read the messages of a segment.
+
+    Raises:
+        ValueError: If the codec is unknown (e.g. zstd without the zstandard package)
+    """
+    if codec not in ARCHIVE_CODECS:
+        raise ValueError(f"Unknown archive codec: {codec}")
+    _, decompress = ARCHIVE_CODECS[codec]
+    return json.loads(decompress(data))
+
+def load_archived_messages(
+    conversation_id: int,
+    before: Optional[int] = None,
+    limit: Optional[int] = None
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Read the archived messages of a conversation, from the newest back.
+
+    Args:
+        conversation_id: The conversation
+        before: Only return messages with an id lower than this one
+        limit: Maximum number of messages to return (None for all)
+
+    Returns:
+        A tuple with the messages (oldest first, with the keys of
+        Message.to_dict) and whether older archived messages exist
+    """
+    messages: List[Dict[str, Any]] = []
+    query = MessageArchive.query.filter_by(conversation_id=conversation_id)
+    if before is not None:
+        query = query.filter(MessageArchive.first_message_id < before)
+
+    # One segment at a time: a page usually needs only the newest one
+    older_than = None
+    while True:
+        if limit is not None and len(messages) > limit:
+            return messages[len(messages) - limit:], True
+        segments = query if older_than is None else query.filter(MessageArchive.last_message_id < older_than)
+        archive = segments.order_by(MessageArchive.last_message_id.desc()).first()
+        if archive is None:
+            return messages, False
+        if limit is not None and len(messages) == limit:
+            return messages, True
+
+        segment = [
+            dict(message, conversation_id=conversation_id)
+            for message in decompress_messages(archive.data, archive.codec)
+            if before is None or message['id'] < before
+        ]
+        messages = segment + messages
+        older_than = archive.first_message_id
+
+def archive_segment(conversation_id: int, cutoff: datetime, segment_size: int = MESSAGE_ARCHIVE_SEGMENT_SIZE) -> int:
+    """
+    Move the oldest messages of a conversation created before the cutoff into
+    one archived segment.
+
+    Only the start of the conversation is archived, up to the first newer
+    message, so that the archive and the messages table hold consecutive
+    ranges of ids.
+
+    Returns:
+        The number of messages archived (0 if none, or if another compactor
+        archived them first)
+    """
+    rows = db.session.execute(
+        select(Message.id, Message.user_id, Message.role, Message.content, Message.created_at)
+        .where(Message.conversation_id == conversation_id)
+        .order_by(Message.id)
+        .limit(segment_size)
+    ).all()
+    segment = []
+    for row in rows:
+        if row.created_at is None or row.created_at >= cutoff:
+            break
+        segment.append(row)
+    if not segment:
+        return 0
+
+    try:
+        db.session.add(MessageArchive(
+            user_id=segment[0].user_id,
+            conversation_id=conversation_id,
+            first_message_id=segment[0].id,
+            last_message_id=segment[-1].id,
+            message_count=len(segment),
+            codec=ARCHIVE_CODEC,
+            data=compress_messages([
+                {'id': row.id, 'role': row.role, 'content': row.content, 'created_at': row.created_at.isoformat()}
+                for row in segment
+            ]),
+            first_created_at=segment[0].created_at,
+            last_created_at=segment[-1].created_at,
+        ))
+        deleted = db.session.execute(
+            delete(Message).where(Message.id.in_([row.id for row in segment])),
+            execution_options={'synchronize_session': False}
+        ).rowcount
+        if deleted != len(segment):
+            db.session.rollback()
+            return 0
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    MESSAGE_RETENTION.labels(action='archived').inc(len(segment))
+    return len(segment)
+
+def _tier_user_ids(tier: str):
+    """Select the ids of the users a tier's policy applies to."""
+    condition = User.tier == tier
+    if tier == DEFAULT_TIER:
+        condition = or_(condition, User.tier.notin_(list(MESSAGE_RETENTION_POLICIES)))
+    return select(User.id).where(condition)
+
+def _archive_old_messages(user_ids, cutoff: datetime, batch_size: int) -> int:
+    """Archive a segment of each of a batch of conversations with messages older than the cutoff."""
+    conversation_ids = db.session.execute(
+        select(Message.conversation_id)
+        .where(Message.created_at < cutoff, Message.conversation_id.isnot(None), Message.user_id.in_(user_ids))
+        .distinct()
+        .limit(batch_size)
+    ).scalars().all()
+    return sum(archive_segment(conversation_id, cutoff) for conversation_id in conversation_ids)
+
+def _delete_expired_messages(user_ids, cutoff: datetime, batch_size: int) -> int:
+    """Delete a batch of the messages and archived segments older than the cutoff."""
+    try:
+        message_ids = db.session.execute(
+            select(Message.id).where(Message.created_at < cutoff, Message.user_id.in_(user_ids)).limit(batch_size)
+        ).scalars().all()
+        deleted = 0
+        if message_ids:
+            deleted += db.session.execute(
+                delete(Message).where(Message.id.in_(message_ids)),
+                execution_options={'synchronize_session': False}
+            ).rowcount
+
+        archives = db.session.execute(
+            select(MessageArchive.id, MessageArchive.message_count)
+            .where(MessageArchive.last_created_at < cutoff, MessageArchive.user_id.in_(user_ids))
+            .limit(batch_size)
+        ).all()
+        if archives:
+            db.session.execute(
+                delete(MessageArchive).where(MessageArchive.id.in_([archive.id for archive in archives])),
+                execution_options={'synchronize_session': False}
+            )
+            deleted += sum(archive.message_count for archive in archives)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if deleted:
+        MESSAGE_RETENTION.labels(action='deleted').inc(deleted)
+    return deleted
+
+def compact_messages(now: Optional[datetime] = None, batch_size: int = MESSAGE_COMPACTION_BATCH) -> Dict[str, int]:
+    """
+    Apply the retention policies to one batch of messages per tier.
+
+    Args:
+        now: Current time (defaults to utcnow)
+        batch_size: Conversations archived, and messages deleted, per tier
+
+    Returns:
+        The number of messages 'archived' and 'deleted'; the compactor runs
+        batches until both are 0
+    """
+    now = now or datetime.utcnow()
+    stats = {'archived': 0, 'deleted': 0}
+    for tier, policy in MESSAGE_RETENTION_POLICIES.items():
+        user_ids = _tier_user_ids(tier)
+        if policy.get('delete_after_days') is not None:
+            cutoff = now - timedelta(days=policy['delete_after_days'])
+            stats['deleted'] += _delete_expired_messages(user_ids, cutoff, batch_size)
+        if policy.get('archive_after_days') is not None:
+            cutoff = now - timedelta(days=policy['archive_after_days'])
+            stats['archived'] += _archive_old_messages(user_ids, cutoff, batch_size)
+    return stats
+
+def init_message_retention(app: Flask) -> None:
+    """
+    Set up the retention compactor for the app.
+
+    It is started lazily from the first request of each process, so that it
+    also runs in worker processes forked after the app was created.
+    """
+    if MESSAGE_COMPACTION_INTERVAL > 0:
+        app.before_request(lambda: start_message_compaction(app))
+
+def start_message_compaction(app: Flask, interval: int = MESSAGE_COMPACTION_INTERVAL) -> None:
+    """
+    Start the background thread applying the retention policies, once per process.
+
+    Args:
+        app: The Flask app
+        interval: Average number of seconds between runs
+    """
+    global _compaction_pid
+
+    if _compaction_pid == os.getpid():
+        return
+
+    with _compaction_lock:
+        if _compaction_pid == os.getpid():
+            return
+        _compaction_pid = os.getpid()
+
+    def run() -> None:
+        while True:
+            # Jitter so that workers don't compact in lockstep
+            time.sleep(interval * random.uniform(0.5, 1.5))
+            try:
+                with app.app_context():
+                    archived = deleted = 0
+                    while True:
+                        stats = compact_messages()
+                        archived += stats['archived']
+                        deleted += stats['deleted']
+                        if not stats['archived'] and not stats['deleted']:
+                            break
+                if archived or deleted:
+                    logger.info("Archived %d messages and deleted %d expired messages", archived, deleted)
+            except Exception as e:
+                logger.error("Error compacting messages: %s", e)
+
+    threading.Thread(target=run, name="message-compaction", daemon=True).start()
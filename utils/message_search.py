@@ -0,0 +1,251 @@
+"""
+Full-text search over the authenticated user's messages.
+
+Searches the index created by migration 0003: a GIN-indexed tsvector column
+on PostgreSQL and an FTS5 table on SQLite (local development). The database
+keeps the index up to date on every insert, so nothing is indexed here.
+
+Results are ranked by relevance (ts_rank_cd on PostgreSQL, BM25 on SQLite)
+and paged with a cursor holding the rank and id of the last result, so each
+page is a bounded index lookup whatever the number of messages. Matches are
+highlighted with <mark> in an HTML-escaped snippet of the message.
+"""
+import html
+import re
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+
+from models import db, Conversation, Message
+
+# Text search configuration of the PostgreSQL index (see migration 0003)
+TEXT_SEARCH_CONFIG = 'english'
+
+# Number of results per page
+SEARCH_PAGE_SIZE = 20
+
+# Longest accepted query, in characters
+MAX_SEARCH_QUERY_LENGTH = 200
+
+# Words around the matches in a highlighted snippet
+SNIPPET_WORDS = 24
+
+# Markers put around matches by the database, replaced by <mark> after escaping
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+SEARCH_TERM_PATTERN = re.compile(r"\w+")
+
+class MessageSearchBackend(ABC):
+    """Queries of one database's full-text index."""
+
+    @abstractmethod
+    def search(
+        self, user_id: int, query: str, conversation_id: Optional[int],
+        after: Optional[Tuple[float, int]], limit: int
+    ) -> List[Tuple[int, float]]:
+        """
+        Find the best matches of a query.
+
+        Args:
+            user_id: Owner of the messages searched
+            query: The search query, as typed by the user
+            conversation_id: Only search this conversation, if given
+            after: Rank and id of the last result of the previous page
+            limit: Maximum number of results
+
+        Returns:
+            Ids and ranks of the matching messages, best first
+        """
+
+    @abstractmethod
+    def highlight(self, query: str, message_ids: List[int]) -> Dict[int, str]:
+        """Get snippets of the messages with the matches between the highlight markers."""
+
+class PostgresMessageSearch(MessageSearchBackend):
+    """Search the GIN-indexed search_vector column of messages."""
+
+    def search(self, user_id, query, conversation_id, after, limit):
+        filters = ""
+        params: Dict[str, Any] = {'query': query, 'user_id': user_id, 'limit': limit}
+        if conversation_id is not None:
+            filters += " AND conversation_id = :conversation_id"
+            params['conversation_id'] = conversation_id
+        keyset = ""
+        if after is not None:
+            keyset = "WHERE rank < :rank OR (rank = :rank AND id < :id)"
+            params['rank'], params['id'] = after
+
+        rows = db.session.execute(text(f"""
+            SELECT id, rank FROM (
+                SELECT id, ts_rank_cd(search_vector, tsquery)::float8 AS rank
+                FROM messages, websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', :query) AS tsquery
+                WHERE user_id = :user_id AND search_vector @@ tsquery{filters}
+            ) AS hits
+            {keyset}
+            ORDER BY rank DESC, id DESC
+            LIMIT :limit
+        """), params)
+        return [(row.id, row.rank) for row in rows]
+
+    def highlight(self, query, message_ids):
+        rows = db.session.execute(text(f"""
+            SELECT id, ts_headline('{TEXT_SEARCH_CONFIG}', content,
+                                   websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', :query), :options) AS snippet
+            FROM messages WHERE id IN :ids
+        """).bindparams(bindparam('ids', expanding=True)), {
+            'query': query,
+            'ids': message_ids,
+            'options': (
+                f'StartSel="{HIGHLIGHT_START}", StopSel="{HIGHLIGHT_END}", '
+                f'MaxWords={SNIPPET_WORDS}, MinWords={SNIPPET_WORDS // 2}, '
+                'MaxFragments=2, FragmentDelimiter=" … "'
+            ),
+        })
+        return {row.id: row.snippet for row in rows}
+
+class SqliteMessageSearch(MessageSearchBackend):
+    """Search the messages_fts FTS5 table."""
+
+    @staticmethod
+    def _match_expression(query: str) -> Optional[str]:
+        """
+        Turn a query into an FTS5 expression matching all of its words, the
+        last one as a prefix (the user may still be typing it).
+        """
+        terms = SEARCH_TERM_PATTERN.findall(query)
+        if not terms:
+            return None
+        return ' '.join(f'"{term}"' for term in terms) + '*'
+
+    def search(self, user_id, query, conversation_id, after, limit):
+        expression = self._match_expression(query)
+        if expression is None:
+            return []
+
+        filters = ""
+        params: Dict[str, Any] = {'expression': expression, 'user_id': user_id, 'limit': limit}
+        if conversation_id is not None:
+            filters += " AND messages.conversation_id = :conversation_id"
+            params['conversation_id'] = conversation_id
+        if after is not None:
+            filters += " AND (hits.rank < :rank OR (hits.rank = :rank AND hits.id < :id))"
+            params['rank'], params['id'] = after
+
+        rows = db.session.execute(text(f"""
+            SELECT hits.id, hits.rank FROM (
+                SELECT rowid AS id, -bm25(messages_fts) AS rank
+                FROM messages_fts WHERE messages_fts MATCH :expression
+            ) AS hits
+            JOIN messages ON messages.id = hits.id
+            WHERE messages.user_id = :user_id{filters}
+            ORDER BY hits.rank DESC, hits.id DESC
+            LIMIT :limit
+        """), params)
+        return [(row.id, row.rank) for row in rows]
+
+    def highlight(self, query, message_ids):
+        rows = db.session.execute(text("""
+            SELECT rowid AS id, snippet(messages_fts, 0, :start, :end, '…', :words) AS snippet
+            FROM messages_fts WHERE messages_fts MATCH :expression AND rowid IN :ids
+        """).bindparams(bindparam('ids', expanding=True)), {
+            'expression': self._match_expression(query),
+            'ids': message_ids,
+            'start': HIGHLIGHT_START,
+            'end': HIGHLIGHT_END,
+            'words': SNIPPET_WORDS,
+        })
+        return {row.id: row.snippet for row in rows}
+
+SEARCH_BACKENDS = {
+    'postgresql': PostgresMessageSearch,
+    'sqlite': SqliteMessageSearch,
+}
+
+def get_search_backend() -> MessageSearchBackend:
+    """
+    Get the search backend of the app's database.
+
+    Raises:
+        ValueError: If full-text search is not available for the database
+    """
+    dialect = db.engine.dialect.name
+    if dialect not in SEARCH_BACKENDS:
+        raise ValueError(f"Unknown search backend: {dialect}")
+    return SEARCH_BACKENDS[dialect]()
+
+def encode_cursor(rank: float, message_id: int) -> str:
+    """Build the cursor of the page after a result, for API responses."""
+    return f"{rank!r}:{message_id}"
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    """
+    Read a cursor built by encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    rank, message_id = cursor.split(':', 1)
+    return float(rank), int(message_id)
+
+def format_highlight(snippet: str) -> str:
+    """Escape a snippet as HTML and turn the highlight markers into <mark> tags."""
+    return html.escape(snippet).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
+
+def search_messages(
+    user_id: int,
+    query: str,
+    conversation_id: Optional[int] = None,
+    after: Optional[Tuple[float, int]] = None,
+    limit: int = SEARCH_PAGE_SIZE
+) -> Tuple[List[Dict[str, Any]], Optional[Tuple[float, int]]]:
+    """
+    Search a user's messages, best matches first.
+
+    Args:
+        user_id: Owner of the messages searched
+        query: The search query, as typed by the user
+        conversation_id: Only search this conversation, if given
+        after: Rank and id of the last result of the previous page
+        limit: Maximum number of results
+
+    Returns:
+        A tuple with the results (the message with its conversation title,
+        highlighted snippet and rank) and the rank and id to continue after,
+        or None on the last page
+    """
+    backend = get_search_backend()
+
+    hits = backend.search(user_id, query, conversation_id, after, limit + 1)
+    page = hits[:limit]
+    if not page:
+        return [], None
+
+    ids = [message_id for message_id, _ in page]
+    messages = {
+        message.id: (message, title)
+        for message, title in db.session.query(Message, Conversation.title)
+        .outerjoin(Conversation, Conversation.id == Message.conversation_id)
+        .filter(Message.id.in_(ids))
+    }
+    snippets = backend.highlight(query, ids)
+
+    results = []
+    for message_id, rank in page:
+        if message_id not in messages:
+            # Deleted since the search
+            continue
+        message, title = messages[message_id]
+        result = message.to_dict()
+        result.update({
+            'conversation_title': title,
+            'highlight': format_highlight(
+                snippets.get(message_id) or ' '.join(message.content.split()[:SNIPPET_WORDS])
+            ),
+            'rank': rank,
+        })
+        results.append(result)
+
+    last_id, last_rank = page[-1]
+    return results, (last_rank, last_id) if len(hits) > limit else None
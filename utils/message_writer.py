@@ -0,0 +1,467 @@
+"""
+Persistence of chat turns.
+
+A chat turn (the user message, the AI reply, the conversation's title and
+timestamp and the rolling summary) is written in a single transaction instead
+of one commit per message.
+
+Optionally (MESSAGE_WRITE_BEHIND=1) turns are not written by the request at
+all: they are queued and bulk-inserted in micro-batches by a background
+thread. Every queued turn is first appended to a journal file that is only
+deleted once its batch has been committed, so turns are written at least
+once. Journal files are named after a random id of the process writing them,
+which holds an flock on each until it is deleted: a journal nobody holds a
+lock on was left behind by a process that died, and is replayed by the next
+process to start, which queues its turns again. The queue is flushed on
+shutdown. Reads may lag writes by up to MESSAGE_FLUSH_INTERVAL.
+
+A failed flush is retried with an exponential backoff. After
+MESSAGE_FLUSH_SPLIT_AFTER failures the turns are written one per transaction,
+so that one turn the database rejects does not hold back the others, and a turn
+that still fails MESSAGE_FLUSH_MAX_ATTEMPTS times is moved to a dead-letter
+file (dead_letter/ under the journal directory) and logged. While more than
+MESSAGE_QUEUE_MAX_SIZE turns are waiting, new turns are written synchronously.
+
+Journals are only replayed from the same directory: set MESSAGE_JOURNAL_DIR
+to a persistent local volume. The default, under the temporary directory, is
+lost with the machine or container (e.g. an instance scaled down), and with
+it the turns that were not flushed yet.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+
+from flask import Flask
+from sqlalchemy import case, insert, update
+
+from models import db, ChatSummary, Conversation, Message, DEFAULT_CONVERSATION_TITLE
+
+logger = logging.getLogger(__name__)
+
+# Queue turns and write them in batches from a background thread ("1" to enable)
+MESSAGE_WRITE_BEHIND = os.environ.get("MESSAGE_WRITE_BEHIND", "0") == "1"
+
+# Seconds between flushes, and the queue length that triggers an early flush
+MESSAGE_FLUSH_INTERVAL = float(os.environ.get("MESSAGE_FLUSH_INTERVAL", "0.2"))
+MESSAGE_FLUSH_BATCH_SIZE = int(os.environ.get("MESSAGE_FLUSH_BATCH_SIZE", "200"))
+
+# Turns waiting to be written (queued or failed) above which new turns are
+# written synchronously instead
+MESSAGE_QUEUE_MAX_SIZE = int(os.environ.get("MESSAGE_QUEUE_MAX_SIZE", "10000"))
+
+# Longest wait before retrying a failed flush; the wait doubles from
+# MESSAGE_FLUSH_INTERVAL with each consecutive failure
+MESSAGE_FLUSH_MAX_BACKOFF = float(os.environ.get("MESSAGE_FLUSH_MAX_BACKOFF", "30"))
+
+# Failed writes of a turn after which it is written in a transaction of its
+# own, and after which it is moved to the dead-letter file
+MESSAGE_FLUSH_SPLIT_AFTER = int(os.environ.get("MESSAGE_FLUSH_SPLIT_AFTER", "3"))
+MESSAGE_FLUSH_MAX_ATTEMPTS = int(os.environ.get("MESSAGE_FLUSH_MAX_ATTEMPTS", "6"))
+
+# Directory of the write-behind journals; must outlive the process (see above)
+MESSAGE_JOURNAL_DIR = os.environ.get(
+    "MESSAGE_JOURNAL_DIR", os.path.join(tempfile.gettempdir(), "chat_message_journal")
+)
+
+# Maximum length of a conversation title taken from its first message
+CONVERSATION_TITLE_LENGTH = 60
+
+def make_chat_turn(
+    user_id: int,
+    conversation_id: int,
+    messages: List[Dict[str, str]],
+    summary: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Build the JSON-serializable record of a chat turn.
+
+    Args:
+        user_id: The id of the authenticated user
+        conversation_id: The conversation the messages belong to
+        messages: Messages with 'role', 'content' and 'created_at' (ISO format) keys
+        summary: Optional rolling summary update ('content' and 'last_message_id')
+
+    Returns:
+        The turn record accepted by write_chat_turns and submit_chat_turn
+    """
+    return {
+        'user_id': user_id,
+        'conversation_id': conversation_id,
+        'messages': messages,
+        'summary': summary,
+    }
+
+def write_chat_turns(turns: List[Dict[str, Any]]) -> None:
+    """
+    Write chat turns in one transaction: bulk-insert their messages, then
+    update each conversation and its summary once.
+
+    Args:
+        turns: Turn records from make_chat_turn, oldest first
+    """
+    rows = [
+        {
+            'user_id': turn['user_id'],
+            'conversation_id': turn['conversation_id'],
+            'role': message['role'],
+            'content': message['content'],
+            'created_at': datetime.fromisoformat(message['created_at']),
+        }
+        for turn in turns
+        for message in turn['messages']
+    ]
+    if not rows:
+        return
+
+    conversations: Dict[int, Dict[str, Any]] = {}
+    for turn in turns:
+        state = conversations.setdefault(turn['conversation_id'], {
+            'user_id': turn['user_id'],
+            'title': None,
+            'summary': None,
+        })
+        if state['title'] is None:
+            state['title'] = next(
+                (message['content'][:CONVERSATION_TITLE_LENGTH] for message in turn['messages']
+                 if message['role'] == 'user'),
+                None
+            )
+        if turn.get('summary'):
+            state['summary'] = turn['summary']
+
+    try:
+        db.session.execute(insert(Message), rows)
+
+        now = datetime.utcnow()
+        for conversation_id, state in conversations.items():
+            values: Dict[str, Any] = {'updated_at': now}
+            # Name the conversation after its first message
+            if state['title']:
+                values['title'] = case(
+                    (Conversation.title == DEFAULT_CONVERSATION_TITLE, state['title']),
+                    else_=Conversation.title
+                )
+            db.session.execute(
+                update(Conversation).where(Conversation.id == conversation_id).values(**values)
+            )
+
+            if state['summary']:
+                summary = ChatSummary.query.filter_by(conversation_id=conversation_id).first()
+                if summary is None:
+                    summary = ChatSummary()
+                    summary.user_id = state['user_id']
+                    summary.conversation_id = conversation_id
+                    db.session.add(summary)
+                summary.content = state['summary']['content']
+                summary.last_message_id = state['summary']['last_message_id']
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    logger.debug("Wrote %s messages from %s chat turns", len(rows), len(turns))
+
+class MessageWriteBehind:
+    """Queue of chat turns flushed to the database in batches by a background thread."""
+
+    def __init__(
+        self,
+        app: Flask,
+        journal_dir: str = MESSAGE_JOURNAL_DIR,
+        interval: float = MESSAGE_FLUSH_INTERVAL,
+        batch_size: int = MESSAGE_FLUSH_BATCH_SIZE,
+        max_queue_size: int = MESSAGE_QUEUE_MAX_SIZE,
+        max_backoff: float = MESSAGE_FLUSH_MAX_BACKOFF,
+    ):
+        """
+        Args:
+            app: The Flask app, for the database connection of the flushes
+            journal_dir: Directory of the journal files
+            interval: Seconds between flushes
+            batch_size: Queue length that triggers an early flush
+            max_queue_size: Turns waiting to be written above which submit() refuses new ones
+            max_backoff: Longest wait before retrying a failed flush
+        """
+        self.app = app
+        self.journal_dir = journal_dir
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_queue_size = max_queue_size
+        self.max_backoff = max_backoff
+        self.pid = os.getpid()
+        # Names the journal segments: pids are reused, e.g. by every restart of a container
+        self.owner = uuid.uuid4().hex
+
+        self.queue: List[Dict[str, Any]] = []
+        # Turns whose last write failed, with their number of failed writes
+        self.failed: List[Tuple[int, Dict[str, Any]]] = []
+        self.failures = 0  # Consecutive failed flushes
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+        # Journal segments, kept open (and locked) until deleted: the one
+        # being appended to (the queued turns) and the sealed one of the
+        # failed turns
+        self.sequence = 0
+        self.sealed_segments: List[Tuple[str, TextIO]] = []
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.segment_path, self.segment = self._open_segment()
+
+        self.thread = threading.Thread(target=self._run, name="message-write-behind", daemon=True)
+
+    def _open_segment(self) -> Tuple[str, TextIO]:
+        """
+        Create the next journal segment, locked by this process. It is created
+        under a temporary name and renamed once locked, so that no other
+        process can take it for an orphan in between.
+        """
+        name = f"{self.owner}.{self.sequence:09d}.jsonl"
+        path = os.path.join(self.journal_dir, name)
+        staging = os.path.join(self.journal_dir, f".{name}.new")
+        segment = open(staging, 'a', encoding='utf-8')
+        fcntl.flock(segment.fileno(), fcntl.LOCK_EX)
+        os.rename(staging, path)
+        self.sequence += 1
+        return path, segment
+
+    def start(self) -> None:
+        """Queue the turns of orphaned journals and start the flusher thread."""
+        self.replay_orphaned_journals()
+        self.thread.start()
+
+    def submit(self, turn: Dict[str, Any]) -> bool:
+        """
+        Journal a chat turn and queue it for the next flush.
+
+        Args:
+            turn: A turn record from make_chat_turn
+
+        Returns:
+            False if too many turns are waiting to be written; the turn was
+            not queued
+        """
+        line = json.dumps(turn, ensure_ascii=False)
+        with self.lock:
+            if len(self.queue) + len(self.failed) >= self.max_queue_size:
+                return False
+            self.segment.write(line + "\n")
+            self.segment.flush()
+            self.queue.append(turn)
+            queued = len(self.queue)
+
+        if queued >= self.batch_size:
+            self.wakeup.set()
+        return True
+
+    def flush(self, force: bool = False) -> None:
+        """
+        Write the queued turns, and retry the failed ones once their backoff
+        has passed. Turns that fail are journaled again and kept for a retry,
+        or moved to the dead-letter file after MESSAGE_FLUSH_MAX_ATTEMPTS.
+
+        Args:
+            force: Retry the failed turns without waiting for the backoff
+        """
+        with self.flush_lock:
+            with self.lock:
+                if not self.queue and not self.failed:
+                    return
+                if self.failed and not force and time.monotonic() < self.retry_at:
+                    return
+                batch = self.failed + [(0, turn) for turn in self.queue]
+                self.queue, self.failed = [], []
+
+                # Seal the segments; new turns go to a fresh one
+                segments = self.sealed_segments + [(self.segment_path, self.segment)]
+                self.sealed_segments = []
+                self.segment_path, self.segment = self._open_segment()
+
+            if max(attempts for attempts, _ in batch) < MESSAGE_FLUSH_SPLIT_AFTER:
+                failed = self._write_batch(batch)
+            else:
+                failed = self._write_each(batch)
+
+            with self.lock:
+                if failed:
+                    # Journaled again before their old segments are deleted
+                    path, segment = self._open_segment()
+                    segment.writelines(json.dumps(turn, ensure_ascii=False) + "\n" for _, turn in failed)
+                    segment.flush()
+                    self.sealed_segments = [(path, segment)]
+                    self.failed = failed
+                    self.failures += 1
+                    self.retry_at = time.monotonic() + min(self.interval * 2 ** self.failures, self.max_backoff)
+                else:
+                    self.failures = 0
+
+            for path, segment in segments:
+                # Deleted before the lock is released, so nobody replays it
+                os.remove(path)
+                segment.close()
+
+    def _write_batch(self, batch: List[Tuple[int, Dict[str, Any]]]) -> List[Tuple[int, Dict[str, Any]]]:
+        """Write turns in one transaction; returns them all, with one more failure, if it fails."""
+        try:
+            with self.app.app_context():
+                write_chat_turns([turn for _, turn in batch])
+        except Exception as e:
+            logger.error("Error writing %s queued chat turns, will retry: %s", len(batch), e)
+            return [(attempts + 1, turn) for attempts, turn in batch]
+        return []
+
+    def _write_each(self, batch: List[Tuple[int, Dict[str, Any]]]) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        Write turns one per transaction. Returns the ones that failed, except
+        those that reached MESSAGE_FLUSH_MAX_ATTEMPTS, which are dead-lettered.
+        """
+        failed = []
+        for attempts, turn in batch:
+            try:
+                with self.app.app_context():
+                    write_chat_turns([turn])
+            except Exception as e:
+                if attempts + 1 >= MESSAGE_FLUSH_MAX_ATTEMPTS:
+                    self._dead_letter(turn, e)
+                else:
+                    logger.error("Error writing a chat turn of conversation %s, will retry: %s",
+                                 turn.get('conversation_id'), e)
+                    failed.append((attempts + 1, turn))
+        return failed
+
+    def _dead_letter(self, turn: Dict[str, Any], error: Exception) -> None:
+        """Append a turn that cannot be written to this process's dead-letter file."""
+        directory = os.path.join(self.journal_dir, "dead_letter")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.owner}.jsonl")
+        record = {'turn': turn, 'error': str(error), 'failed_at': datetime.utcnow().isoformat()}
+        with open(path, 'a', encoding='utf-8') as dead_letter:
+            dead_letter.write(json.dumps(record, ensure_ascii=False) + "\n")
+        logger.error(
+            "Gave up writing a chat turn of conversation %s after %s attempts, moved it to %s: %s",
+            turn.get('conversation_id'), MESSAGE_FLUSH_MAX_ATTEMPTS, path, error
+        )
+
+    def close(self) -> None:
+        """
+        Stop the flusher thread and write everything still queued. Segments
+        that could not be written are unlocked, for the next process to replay.
+        """
+        # The exit handlers of a forked child include its parent's
+        if self.stopped or self.pid != os.getpid():
+            return
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=5)
+        self.flush(force=True)
+        with self.lock:
+            if not self.queue:
+                os.remove(self.segment_path)
+            self.segment.close()
+            for _, segment in self.sealed_segments:
+                segment.close()
+
+    def _run(self) -> None:
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def replay_orphaned_journals(self) -> None:
+        """
+        Queue the turns of the journal segments no live process holds a lock
+        on, to be written (and retried, or dead-lettered) like this process's own.
+        """
+        for name in sorted(os.listdir(self.journal_dir)):
+            if not name.endswith('.jsonl') or name.startswith(self.owner):
+                continue
+            path = os.path.join(self.journal_dir, name)
+            try:
+                journal = open(path, encoding='utf-8')
+            except FileNotFoundError:
+                continue
+
+            with journal:
+                try:
+                    fcntl.flock(journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Its process is alive and will write it
+                    continue
+                if os.fstat(journal.fileno()).st_nlink == 0:
+                    # Written, and deleted, since it was listed
+                    continue
+
+                turns = []
+                for line in journal:
+                    try:
+                        turns.append(json.loads(line))
+                    except ValueError:
+                        # A torn last line from a crash mid-write
+                        continue
+
+                # Journaled in this process's segment before the orphan is deleted
+                with self.lock:
+                    self.segment.writelines(json.dumps(turn, ensure_ascii=False) + "\n" for turn in turns)
+                    self.segment.flush()
+                    self.queue.extend(turns)
+                os.remove(path)
+            logger.info("Recovered %s chat turns from message journal %s", len(turns), name)
+
+_app: Optional[Flask] = None
+_write_behind: Optional[MessageWriteBehind] = None
+_write_behind_lock = threading.Lock()
+
+def init_message_writer(app: Flask) -> None:
+    """Set up chat turn persistence for the app (write-behind if enabled)."""
+    global _app
+    _app = app
+    if MESSAGE_WRITE_BEHIND:
+        logger.info("Chat turns are written behind in batches")
+        if "MESSAGE_JOURNAL_DIR" not in os.environ:
+            logger.warning(
+                "MESSAGE_JOURNAL_DIR is not set: unflushed chat turns are lost with this machine's %s",
+                MESSAGE_JOURNAL_DIR
+            )
+
+def _get_write_behind() -> Optional[MessageWriteBehind]:
+    """Get this process's write-behind queue, starting it on first use."""
+    global _write_behind
+
+    if not MESSAGE_WRITE_BEHIND or _app is None:
+        return None
+
+    # Forked workers start their own queue and journal
+    if _write_behind is None or _write_behind.pid != os.getpid():
+        with _write_behind_lock:
+            if _write_behind is None or _write_behind.pid != os.getpid():
+                _write_behind = MessageWriteBehind(_app)
+                _write_behind.start()
+                atexit.register(_write_behind.close)
+    return _write_behind
+
+def submit_chat_turn(turn: Dict[str, Any]) -> None:
+    """
+    Persist a chat turn: queue it when write-behind is enabled (and its queue
+    is not full), otherwise write it now in one transaction.
+
+    Args:
+        turn: A turn record from make_chat_turn
+    """
+    write_behind = _get_write_behind()
+    if write_behind is not None:
+        if write_behind.submit(turn):
+            return
+        logger.warning("Too many chat turns waiting to be written behind, writing this one now")
+    write_chat_turns([turn])
@@ -0,0 +1,172 @@
+"""
+Prometheus metrics.
+
+Covers the hot path of a chat turn: request latency per route, time to first
+token and total latency per AI provider, estimated token counts and cost, fallbacks
+between providers and breaker transitions, rate limit rejections, database
+queries and session store I/O per request, and cache hits and misses.
+
+Under gunicorn every worker process writes its samples to files in
+PROMETHEUS_MULTIPROC_DIR (set up by gunicorn.conf.py) and /metrics aggregates
+them; without that variable the metrics of the current process are served.
+"""
+import os
+import time
+from typing import Callable, Tuple
+
+from flask import Flask, g, has_app_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Buckets for request and provider latencies (AI calls take seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+# Buckets for database and session store operations
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time to serve a request, including a streamed body',
+    ['method', 'route', 'status'], buckets=LATENCY_BUCKETS
+)
+REQUEST_DB_QUERIES = Histogram(
+    'http_request_db_queries', 'Database queries issued while serving a request',
+    ['route'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+)
+REQUEST_DB_SECONDS = Histogram(
+    'http_request_db_seconds', 'Time spent in database queries while serving a request',
+    ['route'], buckets=FAST_BUCKETS
+)
+SESSION_IO_SECONDS = Histogram(
+    'session_store_duration_seconds', 'Time to load or save a session',
+    ['operation'], buckets=FAST_BUCKETS
+)
+
+PROVIDER_TTFT = Histogram(
+    'ai_provider_ttft_seconds', 'Time from sending a streamed request to its first token',
+    ['provider'], buckets=LATENCY_BUCKETS
+)
+PROVIDER_LATENCY = Histogram(
+    'ai_provider_latency_seconds', 'Time from sending a request to the complete response',
+    ['provider'], buckets=LATENCY_BUCKETS
+)
+PROVIDER_REQUESTS = Counter(
+    'ai_provider_requests_total', 'Provider calls by outcome (success, error, cached, answered, overloaded)',
+    ['provider', 'outcome']
+)
+PROVIDER_TOKENS = Counter(
+    'ai_provider_tokens_total', 'Estimated tokens sent to (prompt) and received from (completion) providers',
+    ['provider', 'kind']
+)
+PROVIDER_COST = Counter(
+    'ai_provider_cost_total', 'Estimated cost of provider calls, from the configured token prices',
+    ['provider']
+)
+PROVIDER_FALLBACKS = Counter(
+    'ai_provider_fallbacks_total', 'Requests served by another provider than the first one tried',
+    ['from_provider', 'to_provider']
+)
+BREAKER_TRANSITIONS = Counter(
+    'ai_breaker_transitions_total', 'Circuit breaker state changes',
+    ['provider', 'state']
+)
+
+RATE_LIMIT_REJECTIONS = Counter(
+    'rate_limit_rejections_total', 'Chat messages and sign-in attempts refused by the rate limiter',
+    ['identity']
+)
+MESSAGE_RETENTION = Counter(
+    'message_retention_total', 'Messages moved to the compressed archive or deleted by the retention policies',
+    ['action']
+)
+CACHE_REQUESTS = Counter(
+    'cache_requests_total', 'Cache lookups by result (hit or miss)',
+    ['cache', 'result']
+)
+
+class RequestStats:
+    """Database activity of one request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+
+def _route() -> str:
+    """The route pattern of the current request, bounded in cardinality."""
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    started = conn.info['query_started'].pop()
+    stats = g.get('request_stats') if has_app_context() else None
+    if stats is not None:
+        stats.queries += 1
+        stats.query_seconds += time.perf_counter() - started
+
+def _on_query_error(context) -> None:
+    # A failed query never reaches after_cursor_execute
+    started = context.connection.info.get('query_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+def _timed(operation: str, func: Callable) -> Callable:
+    def wrapper(*args, **kwargs):
+        with SESSION_IO_SECONDS.labels(operation=operation).time():
+            return func(*args, **kwargs)
+    return wrapper
+
+def init_metrics(app: Flask) -> None:
+    """
+    Instrument the app: request latency and database activity per route, and
+    session store I/O. Must be called after the session store is configured.
+    """
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _on_query_error)
+
+    interface = app.session_interface
+    interface.open_session = _timed('open', interface.open_session)
+    interface.save_session = _timed('save', interface.save_session)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        stats = g.request_stats
+        method, route, status = request.method, _route(), str(response.status_code)
+
+        # Observed when the body has been sent, so streamed responses count in full
+        def observe() -> None:
+            REQUEST_LATENCY.labels(method=method, route=route, status=status).observe(
+                time.perf_counter() - started
+            )
+            REQUEST_DB_QUERIES.labels(route=route).observe(stats.queries)
+            REQUEST_DB_SECONDS.labels(route=route).observe(stats.query_seconds)
+
+        response.call_on_close(observe)
+        return response
+
+def generate_metrics() -> Tuple[bytes, str]:
+    """
+    Render the metrics in the Prometheus text format, aggregated over all
+    worker processes in multiprocess mode.
+
+    Returns:
+        A tuple with the body and its content type
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,130 @@
+"""
+Password hashing off the request threads.
+
+Password hashes are deliberately slow and memory-hard, so computing them on a
+web worker lets a burst of logins (e.g. credential stuffing) take every worker
+away from the chat routes. Hashes are computed instead by a small pool of
+processes per web worker. At most PASSWORD_HASH_MAX_PENDING hashes are in
+flight; callers wait briefly for a slot and are refused with
+PASSWORD_HASH_BUSY when the pool is saturated, so auth work cannot grow
+without bound.
+
+The hashing processes are spawned, and like any spawned process they import
+the main script again: it must not create the app outside an
+``if __name__ == "__main__"`` block, which is why the servers load the app
+from wsgi.py and main.py only creates it under that guard.
+
+Hashes are generated with PASSWORD_HASH_METHOD. A stored hash made with
+other parameters still verifies, and needs_rehash() tells the login to store
+a new one, so raising the cost upgrades users as they sign in.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from utils.tracing import trace_span
+
+logger = logging.getLogger(__name__)
+
+# Hash method with its parameters, as werkzeug writes it at the start of the
+# hash (e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:1000000")
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+
+# Hashing processes per web worker; 0 hashes on the calling thread
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+
+# Hashes queued or running at once, and how long a caller waits for a slot
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", "8"))
+PASSWORD_HASH_WAIT_SECONDS = float(os.environ.get("PASSWORD_HASH_WAIT_SECONDS", "2"))
+
+# Longest a single hash may take
+PASSWORD_HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", "10"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_pid: Optional[int] = None
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+_pool_lock = threading.Lock()
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Get the hashing pool of this process, starting it on first use."""
+    global _pool, _pool_pid, _slots
+
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                # Spawned rather than forked: web workers run threads, and the
+                # children only need werkzeug. Not from a fork server, which a
+                # process forked after starting it cannot use
+                _pool = ProcessPoolExecutor(
+                    max_workers=PASSWORD_HASH_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+                _slots = threading.BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+                _pool_pid = os.getpid()
+                logger.info("Started %d password hashing processes", PASSWORD_HASH_WORKERS)
+    return _pool
+
+def _drop_pool(pool: ProcessPoolExecutor) -> None:
+    """Stop a broken pool so that the next call starts a new one."""
+    global _pool_pid
+
+    logger.error("Password hashing pool is broken, restarting it")
+    with _pool_lock:
+        if _pool is pool:
+            _pool_pid = None
+    pool.shutdown(wait=False)
+
+def _run(function: Callable[..., Any], *args: Any) -> Any:
+    """
+    Run a hashing function in the pool.
+
+    Raises:
+        Exception: PASSWORD_HASH_BUSY if no slot frees up in time
+    """
+    if PASSWORD_HASH_WORKERS <= 0:
+        return function(*args)
+
+    pool = _get_pool()
+    slots = _slots
+    if not slots.acquire(timeout=PASSWORD_HASH_WAIT_SECONDS):
+        raise Exception("PASSWORD_HASH_BUSY")
+    try:
+        future = pool.submit(function, *args)
+    except BaseException as e:
+        slots.release()
+        if isinstance(e, BrokenProcessPool):
+            _drop_pool(pool)
+        raise
+    # The slot is freed when the hash finishes, not when the caller stops
+    # waiting for it: a hash that timed out still holds a process
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FutureTimeoutError:
+        # Not started yet: take it off the queue, which frees the slot
+        future.cancel()
+        raise
+    except BrokenProcessPool:
+        # A hashing process died; the next call starts a new pool
+        _drop_pool(pool)
+        raise
+
+def hash_password(password: str) -> str:
+    """Hash a password with the configured method."""
+    with trace_span('auth.hash_password'):
+        return _run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+def verify_password(password_hash: str, password: str) -> bool:
+    """Check a password against a stored hash."""
+    with trace_span('auth.verify_password'):
+        return _run(check_password_hash, password_hash, password)
+
+def needs_rehash(password_hash: str) -> bool:
+    """Whether a stored hash was made with other parameters than the configured ones."""
+    return password_hash.split('$', 1)[0] != PASSWORD_HASH_METHOD
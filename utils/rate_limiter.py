@@ -0,0 +1,484 @@
+"""
+Pluggable rate limiting for message quotas.
+
+The backend is selected with RATE_LIMIT_BACKEND:
+    database        - counters in the application database, shared by all workers (default)
+    memory          - in-process token bucket, for single-node deploys
+    sliding_window  - in-process sliding-window log, for single-node deploys
+    redis           - fixed windows in any Redis-protocol store shared by all workers
+
+Quotas are keyed by user id for authenticated users and by client IP for
+anonymous users, so clearing the session cookie no longer resets the quota.
+Limits are configured per tier.
+
+Sign-in attempts are throttled with the same backend, per client IP and per
+username (LOGIN_RATE_LIMITS), before any password hash is computed.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from flask import request
+from flask_login import current_user
+
+from utils.db_rate_limit import (
+    consume_counter, consume_user_message, get_counter_usage, get_user_usage,
+    refund_counter, refund_user_message, reset_counter, reset_user_usage
+)
+from utils.metrics import RATE_LIMIT_REJECTIONS
+from utils.tracing import trace_span
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "database")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# Messages allowed per window for each tier
+DEFAULT_TIER = 'free'
+ANONYMOUS_TIER = 'anonymous'
+RATE_LIMIT_TIERS: Dict[str, Dict[str, int]] = {
+    'anonymous': {'limit': 5, 'window_seconds': 3 * 3600},
+    'free': {'limit': 5, 'window_seconds': 3 * 3600},
+    'pro': {'limit': 100, 'window_seconds': 3 * 3600},
+}
+# Overrides, e.g. RATE_LIMIT_TIERS='{"pro": {"limit": 200, "window_seconds": 3600}}'
+RATE_LIMIT_TIERS.update(json.loads(os.environ.get("RATE_LIMIT_TIERS", "{}")))
+
+# Sign-in attempts allowed per window, for each client IP and each username.
+# Successful sign-ins are not counted.
+LOGIN_RATE_LIMITS: Dict[str, Dict[str, int]] = {
+    'ip': {'limit': 20, 'window_seconds': 900},
+    'username': {'limit': 5, 'window_seconds': 900},
+}
+LOGIN_RATE_LIMITS.update(json.loads(os.environ.get("LOGIN_RATE_LIMITS", "{}")))
+
+# Maximum number of keys tracked by the in-process backends
+MEMORY_BACKEND_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MEMORY_MAX_KEYS", "100000"))
+
+class RateLimitResult:
+    """Outcome of a rate limit check."""
+
+    def __init__(self, allowed: bool, remaining: int, reset_at: Optional[float], limit: int):
+        """
+        Args:
+            allowed: Whether the message was (or would be) allowed
+            remaining: Messages left in the current window
+            reset_at: Timestamp when a message becomes available again, if known
+            limit: Messages allowed per window
+        """
+        self.allowed = allowed
+        self.remaining = remaining
+        self.reset_at = reset_at
+        self.limit = limit
+
+    def limit_info(self) -> Dict[str, Any]:
+        """
+        Build the details shown to a rate limited user.
+
+        Returns:
+            A dict with 'remaining_time' (seconds) to reset, 'reset_time'
+            (formatted string) and the 'limit'
+        """
+        reset_at = self.reset_at or time.time()
+        return {
+            'remaining_time': max(0, int(reset_at - time.time())),
+            'reset_time': datetime.fromtimestamp(reset_at).strftime("%H:%M:%S"),
+            'limit': self.limit
+        }
+
+class RateLimitBackend(ABC):
+    """Interface shared by the rate limit backends."""
+
+    @abstractmethod
+    def consume(self, key: str, limit: int, window_seconds: int) -> RateLimitResult:
+        """Check the limit and consume one message in a single step."""
+
+    @abstractmethod
+    def peek(self, key: str, limit: int, window_seconds: int) -> RateLimitResult:
+        """Get the current state without consuming anything."""
+
+    @abstractmethod
+    def refund(self, key: str, limit: int, window_seconds: int) -> None:
+        """Give back a message consumed by consume()."""
+
+    @abstractmethod
+    def reset(self, key: str) -> None:
+        """Forget all usage for a key."""
+
+class TokenBucketBackend(RateLimitBackend):
+    """
+    In-process token bucket. Each key holds up to `limit` tokens that refill
+    continuously over the window, so quota comes back gradually instead of all
+    at once. Counters are per process and cost no I/O.
+    """
+
+    def __init__(self, max_keys: int = MEMORY_BACKEND_MAX_KEYS):
+        self.max_keys = max_keys
+        self.buckets: Dict[str, Tuple[float, float]] = {}  # key -> (tokens, updated_at)
+        self.lock = threading.Lock()
+
+    def _refill(self, key: str, limit: int, window_seconds: int, now: float) -> float:
+        tokens, updated_at = self.buckets.get(key, (float(limit), now))
+        rate = limit / window_seconds
+        return min(float(limit), tokens + (now - updated_at) * rate)
+
+    def _result(self, allowed: bool, tokens: float, limit: int, window_seconds: int, now: float) -> RateLimitResult:
+        rate = limit / window_seconds
+        reset_at = now + max(0.0, 1 - tokens) / rate
+        return RateLimitResult(allowed, int(math.floor(tokens)), reset_at, limit)
+
+    def _prune(self, now: float) -> None:
+        """
+        Drop the least recently used tenth of the buckets once too many keys
+        are tracked. A dropped key starts again from a full bucket.
+        """
+        if len(self.buckets) <= self.max_keys:
+            return
+        by_age = sorted(self.buckets.items(), key=lambda item: item[1][1])
+        for key, _ in by_age[:len(self.buckets) - self.max_keys + self.max_keys // 10]:
+            del self.buckets[key]
+
+    def consume(self, key: str, limit: int, window_seconds: int) -> RateLimitResult:
+        now = time.time()
+        with self.lock:
+            tokens = self._refill(key, limit, window_seconds, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            self._prune(now)
+        return self._result(allowed, tokens, limit, window_seconds, now)
+
+    def peek(self, key: str, limit: int, window_seconds: int) -> RateLimitResult:
+        now = time.time()
+        with self.lock:
+            tokens = self._refill(key, limit, window_seconds, now)
+        return self._result(tokens >= 1, tokens, limit, window_seconds, now)
+
+    def refund(self, key: str, limit: int, window_seconds: int) -> None:
+        now = time.time()
+        with self.lock:
+            tokens = self._refill(key, limit, window_seconds, now)
+            self.buckets[key] = (min(float(limit), tokens + 1), now)
+
+    def reset(self, key: str) -> None:
+        with self.lock:
+            self.buckets.pop(key, None)
+
+class SlidingWindowLogBackend(RateLimitBackend):
+    """
+    In-process sliding-window log. Keeps the timestamps of the messages sent in
+    the last window, so the limit holds over any window-length interval.
+    """
+
+    def __init__(self, max_keys: int = MEMORY_BACKEND_MAX_KEYS):
+        self.max_keys = max_keys
+        self.logs: Dict[str, Deque[float]] = {}
+        self.lock = threading.Lock()
+
+    def _trim(self, key: str, window_seconds: int, now: float) -> Deque[float]:
+        log = self.logs.get(key)
+        if log is None:
+            log = self.logs[key] = deque()
+        while log and log[0] <= now - window_seconds:
+            log.popleft()
+        return log
+
+    def _result(self, allowed: bool, log: Deque[float], limit: int, window_seconds: int, now: float) -> RateLimitResult:
+        reset_at = log[0] + window_seconds if log else now + window_seconds
+        return RateLimitResult(allowed, max(0, limit - len(log)), reset_at, limit)
+
+    def _prune(self, window_seconds: int, now: float) -> None:
+        if len(self.logs) <= self.max_keys:
+            return
+        for key in [key for key, log in self.logs.items() if not log or log[-1] <= now - window_seconds]:
+            del self.logs[key]
+
+    def consume(self, key: str, limit: int, window_seconds: int) -> RateLimitResult:
+        now = time.time()
+        with self.lock:
+            log = self._trim(key, window_seconds, now)
+            allowed = len(log) < limit
+            if allowed:
+                log.append(now)
+            self._prune(window_seconds, now)
+            return self._result(allowed, log, limit, window_seconds, now)
+
+    def peek(self, key: str, limit: int, window_seconds: int) -> RateLimitResult:
+        now = time.time()
+        with self.lock:
+            log = self._trim(key, window_seconds, now)
+            return self._result(len(log) < limit, log, limit, window_seconds, now)
+
+    def refund(self, key: str, limit: int, window_seconds: int) -> None:
+        with self.lock:
+            log = self.logs.get(key)
+            if log:
+                log.pop()
+
+    def reset(self, key: str) -> None:
+        with self.lock:
+            self.logs.pop(key, None)
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """
+    Fixed-window counters in a Redis-protocol store shared by every worker and
+    instance. Each check is a single MULTI/EXEC round trip; a rejected one
+    takes its increment back with a second one, so the counter does not climb
+    past the limit and a later refund still frees a message.
+    """
+
+    def __init__(self, client=None, url: str = REDIS_URL, prefix: str = 'ratelimit:'):
+        """
+        Args:
+            client: A redis-py compatible client (e.g. a local stand-in for tests);
+                    created from `url` when omitted
+            url: Redis connection URL
+            prefix: Prefix for the counter keys
+        """
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def _result(self, count: int, ttl_ms: int, limit: int, window_seconds: int) -> RateLimitResult:
+        ttl = ttl_ms / 1000 if ttl_ms and ttl_ms > 0 else window_seconds
+        return RateLimitResult(count <= limit, max(0, limit - count), time.time() + ttl, limit)
+
+    def consume(self, key: str, limit: int, window_seconds: int) -> RateLimitResult:
+        redis_key = self.prefix + key
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.set(redis_key, 0, ex=window_seconds, nx=True)
+        pipeline.incr(redis_key)
+        pipeline.pttl(redis_key)
+        _, count, ttl_ms = pipeline.execute()
+        if int(count) > limit:
+            self._decrement(redis_key)
+        return self._result(int(count), ttl_ms, limit, window_seconds)
+
+    def peek(self, key: str, limit: int, window_seconds: int) -> RateLimitResult:
+        redis_key = self.prefix + key
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.get(redis_key)
+        pipeline.pttl(redis_key)
+        count, ttl_ms = pipeline.execute()
+        count = int(count or 0)
+        result = self._result(count, ttl_ms, limit, window_seconds)
+        result.allowed = count < limit
+        return result
+
+    def _decrement(self, redis_key: str) -> None:
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.decr(redis_key)
+        pipeline.pttl(redis_key)
+        _, ttl_ms = pipeline.execute()
+        # The window expired in between, and DECR recreated the key without a TTL
+        if ttl_ms == -1:
+            self.client.delete(redis_key)
+
+    def refund(self, key: str, limit: int, window_seconds: int) -> None:
+        self._decrement(self.prefix + key)
+
+    def reset(self, key: str) -> None:
+        self.client.delete(self.prefix + key)
+
+class DatabaseRateLimitBackend(RateLimitBackend):
+    """
+    Counters in the application database (see utils.db_rate_limit), shared by
+    every worker and instance: users in the rate_limits table, other keys
+    (anonymous clients, sign-in attempts) in the rate_limit_counters table.
+    """
+
+    @staticmethod
+    def _user_id(key: str) -> Optional[int]:
+        if key.startswith('user:'):
+            return int(key[len('user:'):])
+        return None
+
+    def consume(self, key: str, limit: int, window_seconds: int) -> RateLimitResult:
+        user_id = self._user_id(key)
+        if user_id is None:
+            count, reset_time = consume_counter(key, limit, window_seconds)
+        else:
+            count, reset_time = consume_user_message(user_id, limit, window_seconds)
+        return RateLimitResult(count <= limit, max(0, limit - count), reset_time.timestamp(), limit)
+
+    def peek(self, key: str, limit: int, window_seconds: int) -> RateLimitResult:
+        user_id = self._user_id(key)
+        if user_id is None:
+            count, reset_time = get_counter_usage(key)
+        else:
+            count, reset_time = get_user_usage(user_id)
+        reset_at = reset_time.timestamp() if reset_time else None
+        return RateLimitResult(count < limit, max(0, limit - count), reset_at, limit)
+
+    def refund(self, key: str, limit: int, window_seconds: int) -> None:
+        user_id = self._user_id(key)
+        if user_id is None:
+            refund_counter(key, limit)
+        else:
+            refund_user_message(user_id, limit)
+
+    def reset(self, key: str) -> None:
+        user_id = self._user_id(key)
+        if user_id is None:
+            reset_counter(key)
+        else:
+            reset_user_usage(user_id)
+
+RATE_LIMIT_BACKENDS = {
+    'database': DatabaseRateLimitBackend,
+    'memory': TokenBucketBackend,
+    'sliding_window': SlidingWindowLogBackend,
+    'redis': RedisRateLimitBackend,
+}
+
+_rate_limiter: Optional[RateLimitBackend] = None
+
+def create_rate_limiter(name: str) -> RateLimitBackend:
+    """
+    Create a rate limit backend by name.
+
+    Raises:
+        ValueError: If the backend name is unknown
+    """
+    if name not in RATE_LIMIT_BACKENDS:
+        raise ValueError(f"Unknown rate limit backend: {name}")
+    return RATE_LIMIT_BACKENDS[name]()
+
+def get_rate_limiter() -> RateLimitBackend:
+    """Get the rate limit backend configured for this process."""
+    global _rate_limiter
+
+    if _rate_limiter is None:
+        _rate_limiter = create_rate_limiter(RATE_LIMIT_BACKEND)
+        logger.info("Using %s rate limit backend", RATE_LIMIT_BACKEND)
+    return _rate_limiter
+
+def get_rate_limit_identity() -> Tuple[str, Dict[str, int]]:
+    """
+    Get the rate limit key and tier limits for the current request.
+
+    Returns:
+        A tuple with the key and the tier's 'limit' and 'window_seconds'
+    """
+    if current_user.is_authenticated:
+        tier = getattr(current_user, 'tier', None) or DEFAULT_TIER
+        key = f"user:{current_user.id}"
+    else:
+        tier = ANONYMOUS_TIER
+        key = f"ip:{request.remote_addr}"
+
+    return key, RATE_LIMIT_TIERS.get(tier, RATE_LIMIT_TIERS[DEFAULT_TIER])
+
+def consume_message() -> Tuple[bool, Dict[str, Any]]:
+    """
+    Check the limit and consume one message in the same call.
+
+    Returns:
+        A tuple containing:
+        - Boolean indicating if the limit is exceeded (nothing was consumed)
+        - A usage dict with 'remaining' messages and, if limited, 'limit_info'
+    """
+    key, tier = get_rate_limit_identity()
+    with trace_span('rate_limit.consume', backend=RATE_LIMIT_BACKEND):
+        result = get_rate_limiter().consume(key, tier['limit'], tier['window_seconds'])
+
+    if not result.allowed:
+        logger.info("Rate limit exceeded for %s", key)
+        # Labelled by the kind of identity (user or ip), not the identity itself
+        RATE_LIMIT_REJECTIONS.labels(identity=key.split(':', 1)[0]).inc()
+    return not result.allowed, {
+        'remaining': result.remaining,
+        'limit_info': None if result.allowed else result.limit_info()
+    }
+
+def refund_message() -> None:
+    """Give back a message consumed by consume_message, e.g. when the AI request failed."""
+    key, tier = get_rate_limit_identity()
+    get_rate_limiter().refund(key, tier['limit'], tier['window_seconds'])
+
+def get_rate_limit_status() -> Tuple[bool, Optional[Dict], int]:
+    """
+    Get the rate limit state without consuming anything.
+
+    Returns:
+        A tuple containing:
+        - Boolean indicating if the limit is exceeded
+        - If limited, a dict with 'remaining_time' (seconds) to reset,
+          'reset_time' (formatted string) and the 'limit'
+        - Number of messages remaining
+    """
+    key, tier = get_rate_limit_identity()
+    result = get_rate_limiter().peek(key, tier['limit'], tier['window_seconds'])
+
+    return (not result.allowed, None if result.allowed else result.limit_info(), result.remaining)
+
+def get_remaining_messages() -> int:
+    """
+    Get the number of remaining messages in the current period.
+
+    Returns:
+        Number of messages remaining
+    """
+    _, _, remaining = get_rate_limit_status()
+    return remaining
+
+def reset_usage() -> None:
+    """Reset the usage counter for the current user or client. Used primarily for testing."""
+    key, _ = get_rate_limit_identity()
+    get_rate_limiter().reset(key)
+
+def _login_rate_limits(username: str) -> List[Tuple[str, Dict[str, int]]]:
+    """Get the keys and limits a sign-in attempt counts against."""
+    return [
+        (f"login-ip:{request.remote_addr}", LOGIN_RATE_LIMITS['ip']),
+        (f"login-user:{username.strip().lower()}", LOGIN_RATE_LIMITS['username']),
+    ]
+
+def consume_login_attempt(username: str) -> Optional[RateLimitResult]:
+    """
+    Count a sign-in attempt for the client IP and the username. Attempts are
+    counted before the password is checked, so concurrent guesses cannot get
+    past the limit; successful ones are given back by reset_login_attempts().
+
+    Args:
+        username: The username being signed in to
+
+    Returns:
+        None if the attempt is allowed, otherwise the exceeded limit
+    """
+    limiter = get_rate_limiter()
+    consumed = []
+    for key, limits in _login_rate_limits(username):
+        result = limiter.consume(key, limits['limit'], limits['window_seconds'])
+        if not result.allowed:
+            # A refused attempt does not count against the other keys
+            for consumed_key, consumed_limits in consumed:
+                limiter.refund(consumed_key, consumed_limits['limit'], consumed_limits['window_seconds'])
+            logger.info("Sign-in attempts exceeded for %s", key)
+            RATE_LIMIT_REJECTIONS.labels(identity=key.split(':', 1)[0]).inc()
+            return result
+        consumed.append((key, limits))
+    return None
+
+def refund_login_attempt(username: str) -> None:
+    """Give back an attempt counted by consume_login_attempt whose password was not checked."""
+    limiter = get_rate_limiter()
+    for key, limits in _login_rate_limits(username):
+        limiter.refund(key, limits['limit'], limits['window_seconds'])
+
+def reset_login_attempts(username: str) -> None:
+    """After a successful sign-in: give back the attempt and forget the username's failures."""
+    limiter = get_rate_limiter()
+    (ip_key, ip_limits), (user_key, _) = _login_rate_limits(username)
+    limiter.refund(ip_key, ip_limits['limit'], ip_limits['window_seconds'])
+    limiter.reset(user_key)
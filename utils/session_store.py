@@ -0,0 +1,129 @@
+"""
+Server-side session storage.
+
+Sessions are stored through Flask-Session in a backend chosen with the
+SESSION_BACKEND environment variable:
+
+    sqlalchemy  - a table in the application database (default), shared by
+                  all instances
+    redis       - any Redis-protocol store, with native expiry
+    filesystem  - files under flask_session/ (local development only; not
+                  shared between instances)
+
+Session data is serialized with msgpack (or JSON) instead of pickle. Backends
+without native expiry delete expired sessions on about one request in
+SESSION_CLEANUP_N_REQUESTS (Flask-Session's own cleanup).
+
+The sessions table of the SQL backend is created by the migrations (0002), not
+when the app is created.
+"""
+import logging
+import os
+from typing import Callable, Dict
+
+from flask import Flask
+from flask_session import Session
+from flask_session.base import ServerSideSessionInterface
+from flask_session.defaults import Defaults
+from flask_session.sqlalchemy.sqlalchemy import SqlAlchemySessionInterface, create_session_model
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# Session backend: "sqlalchemy", "redis" or "filesystem"
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "sqlalchemy")
+
+# Redis URL for the "redis" backend
+SESSION_REDIS_URL = os.environ.get(
+    "SESSION_REDIS_URL", os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+)
+
+# Serialization of session data: "msgpack" or "json"
+SESSION_SERIALIZATION_FORMAT = os.environ.get("SESSION_SERIALIZATION_FORMAT", "msgpack")
+
+# Rewrite the stored session on every request to push back its expiry ("1"),
+# or only when it changes. Rewriting costs a write (a commit with the SQL
+# backend) per request; without it a session expires PERMANENT_SESSION_LIFETIME
+# after its last change.
+SESSION_REFRESH_EACH_REQUEST = os.environ.get("SESSION_REFRESH_EACH_REQUEST", "0") == "1"
+
+# Delete expired sessions on average once every N requests (backends without
+# native expiry); 0 disables it, leaving the `flask session_cleanup` command
+SESSION_CLEANUP_N_REQUESTS = int(os.environ.get("SESSION_CLEANUP_N_REQUESTS", "1000"))
+
+class MigratedSqlAlchemySessionInterface(SqlAlchemySessionInterface):
+    """
+    Flask-Session's SQL backend on the sessions table of the migrations.
+
+    The stock interface creates its table in its constructor, i.e. whenever
+    the app is created; this one only maps it.
+    """
+
+    def __init__(self, app: Flask):
+        config = app.config
+        self.client = config["SESSION_SQLALCHEMY"]
+        self.sql_session_model = create_session_model(self.client, config["SESSION_SQLALCHEMY_TABLE"])
+        ServerSideSessionInterface.__init__(
+            self,
+            app,
+            key_prefix=config.get("SESSION_KEY_PREFIX", Defaults.SESSION_KEY_PREFIX),
+            use_signer=config.get("SESSION_USE_SIGNER", Defaults.SESSION_USE_SIGNER),
+            permanent=config.get("SESSION_PERMANENT", Defaults.SESSION_PERMANENT),
+            sid_length=config.get("SESSION_ID_LENGTH", Defaults.SESSION_ID_LENGTH),
+            serialization_format=config["SESSION_SERIALIZATION_FORMAT"],
+            cleanup_n_requests=config["SESSION_CLEANUP_N_REQUESTS"],
+        )
+
+def _configure_sqlalchemy(app: Flask) -> None:
+    app.config.update(
+        SESSION_TYPE="sqlalchemy",
+        SESSION_SQLALCHEMY=db,
+        SESSION_SQLALCHEMY_TABLE="sessions",
+    )
+    app.session_interface = MigratedSqlAlchemySessionInterface(app)
+
+def _configure_redis(app: Flask) -> None:
+    import redis
+    app.config.update(
+        SESSION_TYPE="redis",
+        SESSION_REDIS=redis.Redis.from_url(SESSION_REDIS_URL),
+    )
+    Session(app)
+
+def _configure_filesystem(app: Flask) -> None:
+    app.config.update(
+        SESSION_TYPE="filesystem",
+        SESSION_FILE_DIR=os.path.join(os.getcwd(), "flask_session"),
+    )
+    Session(app)
+
+# Session backends by name
+SESSION_BACKENDS: Dict[str, Callable[[Flask], None]] = {
+    'sqlalchemy': _configure_sqlalchemy,
+    'redis': _configure_redis,
+    'filesystem': _configure_filesystem,
+}
+
+def configure_session_store(app: Flask, backend: str = SESSION_BACKEND) -> None:
+    """
+    Configure server-side sessions for the app.
+
+    Must be called after the database extension has been initialized.
+
+    Args:
+        app: The Flask app
+        backend: Name of the session backend
+
+    Raises:
+        ValueError: If the backend is unknown
+    """
+    configure = SESSION_BACKENDS.get(backend)
+    if configure is None:
+        raise ValueError(f"Unknown session backend: {backend}")
+
+    app.config.setdefault("SESSION_SERIALIZATION_FORMAT", SESSION_SERIALIZATION_FORMAT)
+    app.config.setdefault("SESSION_CLEANUP_N_REQUESTS", SESSION_CLEANUP_N_REQUESTS or None)
+    app.config["SESSION_REFRESH_EACH_REQUEST"] = SESSION_REFRESH_EACH_REQUEST
+    configure(app)
+
+    logger.info("Using the %s session backend", backend)
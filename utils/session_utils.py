@@ -2,16 +2,157 @@
 Utilities for managing chat session and database data.
 """
 import logging
-from typing import List, Dict, Any
-from flask import session
+import os
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Tuple
+from flask import Response, current_app, session
 from flask_login import current_user
-from models import db, Message, User
+from models import db, ChatSummary, Conversation, Message, MessageArchive, User, DEFAULT_CONVERSATION_TITLE
+from utils.message_archive import load_archived_messages
+from utils.message_writer import make_chat_turn, submit_chat_turn
 
 logger = logging.getLogger(__name__)
 
 # Session key for chat history for non-authenticated users
 CHAT_HISTORY_KEY = 'chat_history'
 
+# Session key for the number of old messages dropped from the session history
+CHAT_HISTORY_OFFSET_KEY = 'chat_history_offset'
+
+# Maximum number of messages kept in the session for non-authenticated users
+ANON_HISTORY_MAX_MESSAGES = int(os.environ.get("ANON_HISTORY_MAX_MESSAGES", "50"))
+
+# Session key for the rolling context summary for non-authenticated users
+CHAT_SUMMARY_KEY = 'chat_summary'
+
+# Session key for the conversation authenticated users are chatting in
+ACTIVE_CONVERSATION_KEY = 'active_conversation_id'
+
+# Session key for the chat jobs of non-authenticated users (job id -> delivered)
+CHAT_JOBS_KEY = 'chat_jobs'
+
+# Maximum number of chat jobs remembered in the session
+ANON_MAX_PENDING_JOBS = 20
+
+# Number of messages loaded per page of history
+HISTORY_PAGE_SIZE = 30
+
+def get_active_conversation_id(create: bool = False) -> Optional[int]:
+    """
+    Get the id of the conversation the authenticated user is chatting in.
+    
+    The id is remembered in the session; otherwise the user's most recent
+    conversation is used.
+    
+    Args:
+        create: Start a new conversation if the user has none
+        
+    Returns:
+        The conversation id, or None if there is none and create is False
+    """
+    # The session may outlive a login, so the remembered id is tied to the user
+    active = session.get(ACTIVE_CONVERSATION_KEY)
+    if active and active['user_id'] == current_user.id:
+        return active['conversation_id']
+    
+    conversation = (
+        Conversation.query.filter_by(user_id=current_user.id)
+        .order_by(Conversation.id.desc())
+        .first()
+    )
+    if conversation is None:
+        if not create:
+            return None
+        conversation = start_new_conversation()
+    
+    set_active_conversation_id(conversation.id)
+    return conversation.id
+
+def set_active_conversation_id(conversation_id: int) -> None:
+    """Remember the conversation the authenticated user is chatting in."""
+    session[ACTIVE_CONVERSATION_KEY] = {'user_id': current_user.id, 'conversation_id': conversation_id}
+    session.modified = True
+
+def start_new_conversation() -> Conversation:
+    """
+    Create a new conversation for the authenticated user and make it active.
+    
+    Returns:
+        The new conversation
+    """
+    conversation = Conversation()
+    conversation.user_id = current_user.id
+    db.session.add(conversation)
+    db.session.commit()
+    
+    set_active_conversation_id(conversation.id)
+    logger.debug("Started conversation %s for user %s", conversation.id, current_user.username)
+    return conversation
+
+def get_conversation(conversation_id: int) -> Optional[Conversation]:
+    """Get one of the authenticated user's conversations by id."""
+    return Conversation.query.filter_by(id=conversation_id, user_id=current_user.id).first()
+
+def get_conversations(before: Optional[int] = None, limit: int = HISTORY_PAGE_SIZE) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Get a page of the authenticated user's conversations, newest first.
+    
+    Args:
+        before: Only return conversations with an id lower than this one
+        limit: Maximum number of conversations to return
+        
+    Returns:
+        A tuple with the conversations and whether older ones exist
+    """
+    query = Conversation.query.filter_by(user_id=current_user.id)
+    if before is not None:
+        query = query.filter(Conversation.id < before)
+    conversations = query.order_by(Conversation.id.desc()).limit(limit + 1).all()
+    
+    return [conversation.to_dict() for conversation in conversations[:limit]], len(conversations) > limit
+
+def get_chat_history_page(
+    conversation_id: Optional[int] = None,
+    before: Optional[int] = None,
+    limit: int = HISTORY_PAGE_SIZE
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Get a page of chat history using keyset pagination on the message id.
+    Messages moved to the archive by the retention compactor are read back
+    from it (see utils.message_archive).
+    
+    Args:
+        conversation_id: Conversation to read (defaults to the active one).
+                         Ignored for non-authenticated users.
+        before: Only return messages with an id lower than this one
+        limit: Maximum number of messages to return
+        
+    Returns:
+        A tuple with the messages (oldest first) and whether older ones exist
+    """
+    if current_user.is_authenticated:
+        if conversation_id is None:
+            conversation_id = get_active_conversation_id()
+            if conversation_id is None:
+                return [], False
+        
+        query = Message.query.filter_by(user_id=current_user.id, conversation_id=conversation_id)
+        if before is not None:
+            query = query.filter(Message.id < before)
+        messages = query.order_by(Message.id.desc()).limit(limit + 1).all()
+        
+        page = [msg.to_dict() for msg in reversed(messages[:limit])]
+        if len(messages) > limit:
+            return page, True
+        
+        # Older messages may have been moved to the archive
+        archived, has_more = load_archived_messages(
+            conversation_id, before=page[0]['id'] if page else before, limit=limit - len(page)
+        )
+        return archived + page, has_more
+    
+    return get_chat_history(), False
+
 def get_chat_history() -> List[Dict[str, Any]]:
     """
     Get the current chat history from the database if user is authenticated,
@@ -20,10 +161,20 @@ def get_chat_history() -> List[Dict[str, Any]]:
     Returns:
         A list of message objects with 'role' and 'content' keys
     """
-    # If user is authenticated, get messages from database
+    # If user is authenticated, get messages of the active conversation from database
     if current_user.is_authenticated:
-        messages = Message.query.filter_by(user_id=current_user.id).order_by(Message.created_at).all()
-        return [{'role': msg.role, 'content': msg.content} for msg in messages]
+        conversation_id = get_active_conversation_id()
+        if conversation_id is None:
+            return []
+        messages = (
+            Message.query.filter_by(user_id=current_user.id, conversation_id=conversation_id)
+            .order_by(Message.id)
+            .all()
+        )
+        archived, _ = load_archived_messages(conversation_id, before=messages[0].id if messages else None)
+        return [
+            {'role': msg['role'], 'content': msg['content']} for msg in archived
+        ] + [{'role': msg.role, 'content': msg.content} for msg in messages]
     
     # Otherwise, get from session
     if CHAT_HISTORY_KEY not in session:
@@ -31,6 +182,90 @@ def get_chat_history() -> List[Dict[str, Any]]:
         
     return session[CHAT_HISTORY_KEY]
 
+def get_recent_chat_history(limit: int) -> List[Dict[str, Any]]:
+    """
+    Get the most recent messages of the chat history.
+    
+    Unlike get_chat_history, this only loads the tail of the conversation.
+    
+    Args:
+        limit: Maximum number of messages to return
+        
+    Returns:
+        A list of message objects with 'id', 'role' and 'content' keys, oldest
+        first. The 'id' increases over the conversation, so it can be used to
+        track which messages have been summarized.
+    """
+    if current_user.is_authenticated:
+        conversation_id = get_active_conversation_id()
+        if conversation_id is None:
+            return []
+        messages = (
+            Message.query.filter_by(user_id=current_user.id, conversation_id=conversation_id)
+            .order_by(Message.id.desc())
+            .limit(limit)
+            .all()
+        )
+        recent = [{'id': msg.id, 'role': msg.role, 'content': msg.content} for msg in reversed(messages)]
+        if len(recent) < limit:
+            # The start of a resumed conversation may have been archived
+            archived, _ = load_archived_messages(
+                conversation_id, before=recent[0]['id'] if recent else None, limit=limit - len(recent)
+            )
+            recent = [{'id': msg['id'], 'role': msg['role'], 'content': msg['content']} for msg in archived] + recent
+        return recent
+    
+    # Ids count from the start of the conversation, including dropped messages
+    chat_history = session.get(CHAT_HISTORY_KEY, [])
+    start = max(0, len(chat_history) - limit)
+    offset = session.get(CHAT_HISTORY_OFFSET_KEY, 0) + start
+    return [
+        {'id': offset + index + 1, 'role': message['role'], 'content': message['content']}
+        for index, message in enumerate(chat_history[start:])
+    ]
+
+def get_chat_summary() -> Dict[str, Any]:
+    """
+    Get the rolling summary of messages evicted from the AI context window.
+    
+    Returns:
+        A dictionary with the summary 'content' and the 'last_message_id'
+        folded into it (0 if nothing has been summarized yet)
+    """
+    if current_user.is_authenticated:
+        conversation_id = get_active_conversation_id()
+        summary = ChatSummary.query.filter_by(conversation_id=conversation_id).first()
+        if summary is None:
+            return {'content': '', 'last_message_id': 0}
+        return {'content': summary.content, 'last_message_id': summary.last_message_id}
+    
+    return session.get(CHAT_SUMMARY_KEY, {'content': '', 'last_message_id': 0})
+
+def save_chat_summary(content: str, last_message_id: int) -> None:
+    """
+    Store the rolling summary alongside the chat history.
+    
+    Args:
+        content: The summary text
+        last_message_id: The id of the newest message folded into the summary
+    """
+    if current_user.is_authenticated:
+        conversation_id = get_active_conversation_id(create=True)
+        summary = ChatSummary.query.filter_by(conversation_id=conversation_id).first()
+        if summary is None:
+            summary = ChatSummary()
+            summary.user_id = current_user.id
+            summary.conversation_id = conversation_id
+            db.session.add(summary)
+        summary.content = content
+        summary.last_message_id = last_message_id
+        db.session.commit()
+        logger.debug("Updated chat summary for user %s up to message %s", current_user.username, last_message_id)
+        return
+    
+    session[CHAT_SUMMARY_KEY] = {'content': content, 'last_message_id': last_message_id}
+    session.modified = True
+
 def add_message_to_history(role: str, content: str) -> None:
     """
     Add a message to the chat history in the database if user is authenticated,
@@ -40,15 +275,26 @@ def add_message_to_history(role: str, content: str) -> None:
         role: The role of the message sender ('user' or 'assistant')
         content: The message content
     """
-    # If user is authenticated, add to database
+    # If user is authenticated, add to the active conversation in the database
     if current_user.is_authenticated:
+        conversation = db.session.get(Conversation, get_active_conversation_id(create=True))
+        if conversation is None:
+            conversation = start_new_conversation()
+        
         message = Message()
         message.user_id = current_user.id
+        message.conversation_id = conversation.id
         message.role = role
         message.content = content
         db.session.add(message)
+        
+        # Name the conversation after its first message
+        if role == 'user' and conversation.title == DEFAULT_CONVERSATION_TITLE:
+            conversation.title = content[:60]
+        conversation.updated_at = datetime.utcnow()
+        
         db.session.commit()
-        logger.debug(f"Added {role} message to database for user {current_user.username}")
+        logger.debug("Added %s message to database for user %s", role, current_user.username)
         return
     
     # Otherwise, add to session
@@ -58,24 +304,132 @@ def add_message_to_history(role: str, content: str) -> None:
         'content': content
     })
     
+    # Keep the session small: drop the oldest messages beyond the cap
+    overflow = len(chat_history) - ANON_HISTORY_MAX_MESSAGES
+    if overflow > 0:
+        chat_history = chat_history[overflow:]
+        session[CHAT_HISTORY_OFFSET_KEY] = session.get(CHAT_HISTORY_OFFSET_KEY, 0) + overflow
+    
     # Update session
     session[CHAT_HISTORY_KEY] = chat_history
     session.modified = True
     
-    logger.debug(f"Added {role} message to session chat history. Total messages: {len(chat_history)}")
+    logger.debug("Added %s message to session chat history. Total messages: %s", role, len(chat_history))
+
+def record_chat_turn(
+    user_message: str,
+    ai_response: str,
+    summary: Optional[Dict[str, Any]] = None,
+    user_created_at: Optional[datetime] = None
+) -> None:
+    """
+    Store both messages of a chat turn, and the updated rolling summary, at once.
+    
+    For authenticated users this is a single database transaction (or a queued
+    write when write-behind is enabled); otherwise the session is updated.
+    
+    Args:
+        user_message: The user's message
+        ai_response: The AI response
+        summary: Optional summary update with 'content' and 'last_message_id' keys
+        user_created_at: When the user message was received (defaults to now)
+    """
+    now = datetime.utcnow()
+    
+    if current_user.is_authenticated:
+        turn = make_chat_turn(
+            current_user.id,
+            get_active_conversation_id(create=True),
+            [
+                {'role': 'user', 'content': user_message, 'created_at': (user_created_at or now).isoformat()},
+                {'role': 'assistant', 'content': ai_response, 'created_at': now.isoformat()},
+            ],
+            summary
+        )
+        submit_chat_turn(turn)
+        logger.debug("Recorded chat turn for user %s", current_user.username)
+        return
+    
+    # Otherwise, add to session
+    add_message_to_history('user', user_message)
+    add_message_to_history('assistant', ai_response)
+    if summary:
+        save_chat_summary(summary['content'], summary['last_message_id'])
 
 def clear_chat_history() -> None:
     """
-    Clear all messages from the chat history in the database if user is authenticated,
-    or from the session if not.
+    Clear all messages from the active conversation in the database if user is
+    authenticated, or from the session if not.
     """
     if current_user.is_authenticated:
-        Message.query.filter_by(user_id=current_user.id).delete()
+        conversation_id = get_active_conversation_id()
+        if conversation_id is None:
+            return
+        Message.query.filter_by(user_id=current_user.id, conversation_id=conversation_id).delete()
+        MessageArchive.query.filter_by(user_id=current_user.id, conversation_id=conversation_id).delete()
+        ChatSummary.query.filter_by(conversation_id=conversation_id).delete()
         db.session.commit()
-        logger.debug(f"Cleared chat history for user {current_user.username} from database")
+        logger.debug("Cleared chat history for user %s from database", current_user.username)
         return
     
     # Clear session chat history
     session[CHAT_HISTORY_KEY] = []
+    session.pop(CHAT_HISTORY_OFFSET_KEY, None)
+    session.pop(CHAT_SUMMARY_KEY, None)
     session.modified = True
     logger.debug("Session chat history cleared")
+
+def establish_session() -> None:
+    """
+    Make the response being built issue the session cookie of an anonymous user.
+    
+    A streamed response sends its headers before the body is generated, and
+    an empty or unmodified session sets no cookie: the turn the body records
+    in a brand-new session would be saved under an id the client never gets.
+    Call this before returning a response whose body modifies the session.
+    """
+    if current_user.is_authenticated:
+        return
+    session.setdefault(CHAT_HISTORY_KEY, [])
+    session.modified = True
+
+def persist_session() -> None:
+    """
+    Write the session to the server-side store immediately.
+    
+    The session is normally saved when the response is finalized, which for a
+    streamed response happens before the body is generated. Call this after
+    modifying the session from inside a streaming generator; the cookie must
+    already have been issued (see establish_session).
+    """
+    app = current_app._get_current_object()
+    session.modified = True
+    app.session_interface.save_session(app, session, Response())
+
+def remember_anonymous_job(job_id: int) -> None:
+    """Record in the session that a chat job belongs to this anonymous user."""
+    jobs = session.get(CHAT_JOBS_KEY, {})
+    jobs[str(job_id)] = False
+    # Only the most recent jobs can be fetched
+    while len(jobs) > ANON_MAX_PENDING_JOBS:
+        jobs.pop(next(iter(jobs)))
+    session[CHAT_JOBS_KEY] = jobs
+    session.modified = True
+
+def get_anonymous_job_state(job_id: int) -> Optional[bool]:
+    """
+    Get whether an anonymous user's chat job has been delivered.
+    
+    Returns:
+        True if its turn was recorded in the session, False if not yet, or
+        None if the job does not belong to this session
+    """
+    return session.get(CHAT_JOBS_KEY, {}).get(str(job_id))
+
+def mark_anonymous_job_delivered(job_id: int) -> None:
+    """Record that an anonymous user's chat job has been added to the session history."""
+    jobs = session.get(CHAT_JOBS_KEY, {})
+    if str(job_id) in jobs:
+        jobs[str(job_id)] = True
+        session[CHAT_JOBS_KEY] = jobs
+        session.modified = True
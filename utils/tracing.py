@@ -0,0 +1,447 @@
+"""
+Request tracing and profiling.
+
+A sampled fraction of requests (TRACE_SAMPLE_RATE) is traced: spans record the
+request, its route handler, every SQL query, session loads and saves, rate
+limit checks and AI provider calls, with their timings. Finished traces are
+exported by a background thread, either appended as JSON lines to TRACE_FILE
+or sent to an OpenTelemetry collector over OTLP/HTTP (JSON encoding). Traced
+responses carry an X-Trace-Id header.
+
+Admins listed in PROFILE_ADMINS can add ?profile=1 to a request to have it
+traced and run under a profiler (pyinstrument when installed, cProfile
+otherwise). The profile summary is attached to JSON responses and to the
+trace's root span.
+
+Outside a traced request every hook costs a context variable lookup.
+"""
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import queue
+import random
+import secrets
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import httpx
+from flask import Flask, g, request
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.wsgi import ClosingIterator
+
+logger = logging.getLogger(__name__)
+
+# Trace a sample of the requests ("1" to enable)
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "0") == "1"
+
+# Fraction of the requests traced
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))
+
+# Where traces go: "file" (JSON lines) or "otlp" (an OTLP/HTTP collector)
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "file")
+TRACE_FILE = os.environ.get("TRACE_FILE", os.path.join(tempfile.gettempdir(), "traces.jsonl"))
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "ai-chat")
+
+# Finished traces waiting for export; more are dropped
+TRACE_MAX_QUEUE = int(os.environ.get("TRACE_MAX_QUEUE", "1000"))
+
+# Longest SQL statement recorded on a span
+TRACE_STATEMENT_LENGTH = 500
+
+# Usernames allowed to profile requests with ?profile=1 (comma-separated)
+PROFILE_ADMINS = {name.strip() for name in os.environ.get("PROFILE_ADMINS", "").split(",") if name.strip()}
+
+# Lines of the cProfile summary
+PROFILE_TOP_FUNCTIONS = 30
+
+class Trace:
+    """The spans of one traced request."""
+
+    def __init__(self, forced: bool = False):
+        """
+        Args:
+            forced: Whether the request was traced for ?profile=1 rather than sampled
+        """
+        self.trace_id = secrets.token_hex(16)
+        self.spans: List['Span'] = []
+        self.lock = threading.Lock()
+        self.forced = forced
+        self.discarded = False
+
+class Span:
+    """A timed operation within a trace."""
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """Record an attribute (a string, number or boolean)."""
+        self.attributes[key] = value
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        """Finish the span; ending the root span exports the trace. Idempotent."""
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        with self.trace.lock:
+            self.trace.spans.append(self)
+        if self.parent_id is None and not self.trace.discarded:
+            _get_exporter().submit(self.trace)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the span to a JSON-serializable dictionary."""
+        return {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_ns': self.start_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+# The innermost active span of the current request
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar('current_span', default=None)
+
+def start_trace(name: str, forced: bool = False, **attributes: Any) -> Span:
+    """Start the root span of a new trace (not made current)."""
+    return Span(Trace(forced), name, None, attributes)
+
+def start_span(name: str, **attributes: Any) -> Optional[Span]:
+    """
+    Start a child of the current span without making it current, for
+    operations that outlive a block of code (e.g. a stream being consumed).
+
+    Returns:
+        The span, which must be ended, or None outside a traced request
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+@contextmanager
+def trace_span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """
+    Record a block of code as a child of the current span, which it becomes
+    for the duration of the block. Does nothing outside a traced request.
+
+    Args:
+        name: Name of the operation
+        **attributes: Attributes of the span
+    """
+    span = start_span(name, **attributes)
+    if span is None:
+        yield None
+        return
+
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.end(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+
+def get_trace_id() -> Optional[str]:
+    """Get the id of the current trace, or None if the request is not traced."""
+    span = _current_span.get()
+    return span.trace.trace_id if span is not None else None
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def _otlp_span(trace: Trace, span: Span) -> Dict[str, Any]:
+    data = {
+        'traceId': trace.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        # SERVER for the request, INTERNAL for the rest
+        'kind': 2 if span.parent_id is None else 1,
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns),
+        'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in span.attributes.items()],
+        'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+    }
+    if span.parent_id is not None:
+        data['parentSpanId'] = span.parent_id
+    return data
+
+class TraceExporter:
+    """Background thread writing finished traces to a file or an OTLP collector."""
+
+    def __init__(
+        self,
+        exporter: str = TRACE_EXPORTER,
+        path: str = TRACE_FILE,
+        endpoint: str = TRACE_OTLP_ENDPOINT,
+        max_queue: int = TRACE_MAX_QUEUE,
+    ):
+        """
+        Args:
+            exporter: "file" or "otlp"
+            path: JSON lines file of the "file" exporter
+            endpoint: URL of the OTLP/HTTP traces endpoint
+            max_queue: Finished traces waiting for export; more are dropped
+
+        Raises:
+            ValueError: If the exporter is unknown
+        """
+        if exporter not in ('file', 'otlp'):
+            raise ValueError(f"Unknown trace exporter: {exporter}")
+        self.exporter = exporter
+        self.path = path
+        self.endpoint = endpoint
+        self.pid = os.getpid()
+        self.queue: "queue.Queue[Trace]" = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self.thread.start()
+
+    def submit(self, trace: Trace) -> None:
+        """Queue a finished trace for export, dropping it if the queue is full."""
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            logger.warning("Trace queue full, dropping trace %s", trace.trace_id)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self.exporter == 'otlp':
+                    self._send(batch)
+                else:
+                    self._write(batch)
+            except Exception as e:
+                logger.error("Error exporting %s traces: %s", len(batch), e)
+
+    def _write(self, traces: List[Trace]) -> None:
+        with open(self.path, 'a', encoding='utf-8') as file:
+            for trace in traces:
+                spans = sorted(trace.spans, key=lambda span: span.start_ns)
+                file.write(json.dumps({
+                    'trace_id': trace.trace_id,
+                    'spans': [span.to_dict() for span in spans],
+                }, default=str) + "\n")
+
+    def _send(self, traces: List[Trace]) -> None:
+        payload = {
+            'resourceSpans': [{
+                'resource': {'attributes': [
+                    {'key': 'service.name', 'value': {'stringValue': TRACE_SERVICE_NAME}},
+                ]},
+                'scopeSpans': [{
+                    'scope': {'name': __name__},
+                    'spans': [_otlp_span(trace, span) for trace in traces for span in trace.spans],
+                }],
+            }],
+        }
+        response = httpx.post(self.endpoint, json=payload, timeout=10)
+        response.raise_for_status()
+
+_exporter: Optional[TraceExporter] = None
+_exporter_lock = threading.Lock()
+
+def _get_exporter() -> TraceExporter:
+    """Get this process's exporter, starting it on first use."""
+    global _exporter
+
+    # Forked workers start their own exporter thread
+    if _exporter is None or _exporter.pid != os.getpid():
+        with _exporter_lock:
+            if _exporter is None or _exporter.pid != os.getpid():
+                _exporter = TraceExporter()
+    return _exporter
+
+class TracingMiddleware:
+    """
+    WSGI middleware starting the root span of sampled requests, so that the
+    session load that precedes the Flask request hooks is part of the trace.
+    The span ends when the response body has been sent.
+    """
+
+    def __init__(self, wsgi_app: Callable, sample_rate: float = TRACE_SAMPLE_RATE):
+        self.wsgi_app = wsgi_app
+        self.sample_rate = sample_rate if TRACING_ENABLED else 0.0
+
+    def __call__(self, environ, start_response):
+        sampled = random.random() < self.sample_rate
+        profile = bool(PROFILE_ADMINS) and 'profile=1' in environ.get('QUERY_STRING', '').split('&')
+        if not sampled and not profile:
+            return self.wsgi_app(environ, start_response)
+
+        root = start_trace(
+            f"{environ['REQUEST_METHOD']} {environ.get('PATH_INFO', '/')}",
+            forced=not sampled,
+            **{'http.method': environ['REQUEST_METHOD'], 'http.target': environ.get('PATH_INFO', '/')}
+        )
+        token = _current_span.set(root)
+
+        def traced_start_response(status, headers, exc_info=None):
+            root.set_attribute('http.status_code', int(status.split(' ', 1)[0]))
+            if not root.trace.discarded:
+                headers.append(('X-Trace-Id', root.trace.trace_id))
+            return start_response(status, headers, exc_info)
+
+        def finish() -> None:
+            try:
+                _current_span.reset(token)
+            except ValueError:
+                # Closed from another context than the one that started the request
+                _current_span.set(None)
+            root.end()
+
+        try:
+            body = self.wsgi_app(environ, traced_start_response)
+        except BaseException as e:
+            _current_span.reset(token)
+            root.end(e)
+            raise
+
+        # The span stays current while a streamed body is generated
+        return ClosingIterator(body, finish)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    span = start_span('db.query', **{'db.statement': statement[:TRACE_STATEMENT_LENGTH]})
+    conn.info.setdefault('trace_spans', []).append(span)
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    span = conn.info['trace_spans'].pop()
+    if span is not None:
+        span.end()
+
+def _on_query_error(context) -> None:
+    spans = context.connection.info.get('trace_spans') if context.connection is not None else None
+    if spans:
+        span = spans.pop()
+        if span is not None:
+            span.end(context.original_exception)
+
+def _traced(name: str, func: Callable) -> Callable:
+    def wrapper(*args, **kwargs):
+        with trace_span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+def _start_profiler():
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    profiler = Profiler()
+    profiler.start()
+    return profiler
+
+def _stop_profiler(profiler) -> str:
+    """Stop a profiler and render its summary as text."""
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        return output.getvalue()
+    profiler.stop()
+    return profiler.output_text()
+
+def init_tracing(app: Flask) -> None:
+    """
+    Instrument the app for tracing and profiling, if enabled. Must be called
+    after the session store is configured.
+    """
+    if not TRACING_ENABLED and not PROFILE_ADMINS:
+        return
+
+    app.wsgi_app = TracingMiddleware(app.wsgi_app)
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _on_query_error)
+
+    interface = app.session_interface
+    interface.open_session = _traced('session.load', interface.open_session)
+    interface.save_session = _traced('session.save', interface.save_session)
+
+    @app.before_request
+    def start_handler_span():
+        root = _current_span.get()
+        if root is None:
+            return
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        root.name = f"{request.method} {route}"
+        root.set_attribute('http.route', route)
+
+        if request.args.get('profile') == '1':
+            if current_user.is_authenticated and current_user.username in PROFILE_ADMINS:
+                g.profiler = _start_profiler()
+            elif root.trace.forced:
+                # Only admins can have a request traced on demand
+                root.trace.discarded = True
+
+        handler = start_span('handler', endpoint=request.endpoint or '')
+        g.trace_handler = (handler, _current_span.set(handler))
+
+    @app.after_request
+    def end_handler_span(response):
+        handler = g.pop('trace_handler', None)
+        if handler is not None:
+            span, token = handler
+            _current_span.reset(token)
+            span.end()
+
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            summary = _stop_profiler(profiler)
+            _current_span.get().set_attribute('profile', summary)
+            if response.is_json and not response.is_streamed:
+                data = response.get_json()
+                if isinstance(data, dict):
+                    data['profile'] = summary
+                    response.set_data(json.dumps(data))
+        return response
+
+    @app.teardown_request
+    def end_failed_handler_span(error):
+        handler = g.pop('trace_handler', None)
+        if handler is not None:
+            span, token = handler
+            _current_span.reset(token)
+            span.end(error)
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            _stop_profiler(profiler)
+
+    if TRACING_ENABLED:
+        logger.info("Tracing %.2f%% of requests, exported to %s", TRACE_SAMPLE_RATE * 100, TRACE_EXPORTER)
@@ -0,0 +1,140 @@
+"""
+Cache of user identities for Flask-Login.
+
+Flask-Login loads the user on every authenticated request, including each
+usage poll from the chat page. Instead of querying the full User row (password
+hash included) each time, the identity fields are cached as a lightweight
+CachedUser: in a per-process LRU with a short TTL and, optionally, in Redis
+shared by the workers. Cached entries are invalidated when a User row is
+updated or deleted through the ORM.
+"""
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from flask_login import UserMixin
+from sqlalchemy import event
+
+from models import db, User
+from services.response_cache import MemoryCache, RedisCache
+from utils.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# Lifetime of cached identities: per process, and in the shared tier
+USER_CACHE_LOCAL_TTL = int(os.environ.get("USER_CACHE_LOCAL_TTL", "60"))
+USER_CACHE_SHARED_TTL = int(os.environ.get("USER_CACHE_SHARED_TTL", "900"))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get("USER_CACHE_MAX_ENTRIES", "10000"))
+
+# Shared tier: Redis URL, empty to keep the cache in memory only
+USER_CACHE_REDIS_URL = os.environ.get("USER_CACHE_REDIS_URL", "")
+
+class CachedUser(UserMixin):
+    """Identity of an authenticated user, without the password hash or relationships."""
+
+    def __init__(self, id: int, username: str, email: str, tier: str, created_at: Optional[datetime]):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.tier = tier
+        self.created_at = created_at
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the identity to a JSON-serializable dictionary."""
+        return {
+            'id': self.id,
+            'username': self.username,
+            'email': self.email,
+            'tier': self.tier,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'CachedUser':
+        """Build an identity from the output of to_dict."""
+        created_at = data.get('created_at')
+        return cls(
+            data['id'],
+            data['username'],
+            data['email'],
+            data['tier'],
+            datetime.fromisoformat(created_at) if created_at else None,
+        )
+
+    def __repr__(self):
+        return f'<CachedUser {self.username}>'
+
+_memory = MemoryCache(max_entries=USER_CACHE_MAX_ENTRIES)
+_shared = RedisCache(url=USER_CACHE_REDIS_URL, prefix='user:') if USER_CACHE_REDIS_URL else None
+
+def _load_from_database(user_id: int) -> Optional[CachedUser]:
+    row = (
+        db.session.query(User.id, User.username, User.email, User.tier, User.created_at)
+        .filter(User.id == user_id)
+        .first()
+    )
+    if row is None:
+        return None
+    return CachedUser(row.id, row.username, row.email, row.tier, row.created_at)
+
+def get_cached_user(user_id: int) -> Optional[CachedUser]:
+    """
+    Get a user's identity, reading through the cache tiers.
+
+    Args:
+        user_id: The id of the user
+
+    Returns:
+        The user's identity, or None if the user does not exist
+    """
+    key = str(user_id)
+    user = _memory.get(key)
+    if user is not None:
+        CACHE_REQUESTS.labels(cache='user', result='hit').inc()
+        return user
+
+    if _shared is not None:
+        try:
+            data = _shared.get(key)
+            if data is not None:
+                user = CachedUser.from_dict(json.loads(data))
+        except Exception as e:
+            logger.warning("Shared user cache unavailable: %s", e)
+
+    CACHE_REQUESTS.labels(cache='user', result='miss' if user is None else 'hit').inc()
+    if user is None:
+        user = _load_from_database(user_id)
+        if user is None:
+            return None
+        if _shared is not None:
+            try:
+                _shared.set(key, json.dumps(user.to_dict()), USER_CACHE_SHARED_TTL)
+            except Exception as e:
+                logger.warning("Shared user cache unavailable: %s", e)
+
+    _memory.set(key, user, USER_CACHE_LOCAL_TTL)
+    return user
+
+def invalidate_user(user_id: int) -> None:
+    """
+    Drop a user's cached identity. Other processes drop their local copy
+    within USER_CACHE_LOCAL_TTL.
+
+    Args:
+        user_id: The id of the user
+    """
+    key = str(user_id)
+    _memory.delete(key)
+    if _shared is not None:
+        try:
+            _shared.delete(key)
+        except Exception as e:
+            logger.warning("Shared user cache unavailable: %s", e)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_on_change(mapper, connection, target) -> None:
+    """Invalidate the cache when a User row changes through the ORM (bulk query updates are not seen)."""
+    invalidate_user(target.id)
@@ -0,0 +1,11 @@
+"""
+WSGI entry point: the app instance the servers load.
+
+    gunicorn --bind 0.0.0.0:5000 --preload wsgi:app
+
+Kept out of main.py: processes started by multiprocessing (the password
+hashing pool) re-import the main script, and must not build an app.
+"""
+from app import create_app
+
+app = create_app()